@@ -0,0 +1,307 @@
+"""保存済みのプロンプトテンプレートを、S3上のCSVにまとめて適用するバッチ処理（画面を使わない定期実行用）
+
+対象のファイル（日付・キーの指定・キーの範囲）と、テンプレートのすべての組み合わせを処理する。
+ファイルの読込・差分抽出・日付フィルタ・キーワード検索・AI日付整形はテンプレートによらないため、ファイルごとに1回だけ行い、
+その結果に対して各テンプレートのAIプロンプト処理を実行する。ファイルは複数のプロセスで並列に処理し、
+1つのファイルのテンプレートはスレッドで並列に実行する（AIの応答待ちが大半のため）。
+AI呼び出しのレート制限（AI_REQUESTS_PER_MINUTE）と同時実行数（AI_MAX_CONCURRENCY）はプロセス数で分け合う。
+
+結果は __batch/<実行ID>/<ファイルのキー>/<テンプレートID>.csv に、実行全体のまとめは __batch/<実行ID>/manifest.json に保存する。
+
+使い方:
+    python batch_runner.py                                        # 今日（UTC）保存されたファイルに全テンプレートを適用する
+    python batch_runner.py --date 2024-04-01 --template 建設工事    # テンプレートを名前またはIDで選ぶ（複数指定可）
+    python batch_runner.py --key-prefix exports/ --start-after exports/2024-03 --end-before exports/2024-04
+    python batch_runner.py --key exports/a.csv --options options.json  # 差分抽出・キーワードなどの設定（画面のフォームと同じ項目）
+    python batch_runner.py --date 2024-04-01 --workers 4 --dry-run   # 対象のファイルとテンプレートだけを表示する
+
+options.jsonの例:
+    {"diff_mode": "seen_ever", "diff_key_column": "案件番号", "ai_date_format_enabled": "on", "ai_date_format_column": "公示日"}
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import traceback
+import importlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+DEFAULT_WORKERS = 2
+DEFAULT_TEMPLATE_THREADS = 4
+# /api/processのフォームと同じ項目（ai_promptはテンプレートの内容を使う）
+BATCH_FORM_FIELDS = (
+    'filter_date_column_1', 'filter_date_value_1', 'filter_date_column_2', 'filter_date_value_2',
+    'ai_date_format_enabled', 'ai_date_format_column',
+    'keyword_column', 'keywords', 'search_type', 'keyword_match_mode', 'keyword_normalize',
+    'diff_key_column', 'diff_include_changed', 'previous_file_key', 'diff_mode',
+)
+
+def load_app():
+    return importlib.import_module('main')
+
+def configure_environment(workers):
+    """mainを読み込む前に、AI呼び出しの上限をプロセス数で分ける（子プロセスはこの環境変数を引き継ぐ）"""
+    load_dotenv()
+    requests_per_minute = float(os.environ.get("AI_REQUESTS_PER_MINUTE", "60"))
+    max_concurrency = int(os.environ.get("AI_MAX_CONCURRENCY", "4"))
+    os.environ['AI_REQUESTS_PER_MINUTE'] = str(requests_per_minute / workers)
+    os.environ['AI_MAX_CONCURRENCY'] = str(max(1, max_concurrency // workers))
+    # ジョブの記録は進捗の計測にだけ使うため、画面のジョブとは分ける
+    os.environ['JOB_STORE_BACKEND'] = 'memory'
+
+def load_form_data(path):
+    """設定のJSONを読み込み、フォームと同じ形式（チェックボックスは'on'）にする"""
+    form_data = {field: None for field in BATCH_FORM_FIELDS}
+    if not path:
+        return form_data
+    with open(path, encoding='utf-8') as f:
+        options = json.load(f)
+    if not isinstance(options, dict):
+        raise ValueError(f"設定ファイル({path})はJSONのオブジェクトで指定してください。")
+    unknown = [name for name in options if name not in BATCH_FORM_FIELDS]
+    if unknown:
+        raise ValueError(f"設定ファイル({path})に不明な項目があります: {', '.join(unknown)}")
+    for name, value in options.items():
+        if value is True:
+            value = 'on'
+        elif value is False:
+            value = None
+        form_data[name] = value
+    return form_data
+
+def list_keys_in_range(app_module, prefix, start_after, end_before):
+    """プレフィックスとキーの範囲（start_afterより後、end_beforeより前）に含まれるCSVを返す"""
+    paginate_args = {'Bucket': app_module.S3_BUCKET_NAME, 'Prefix': prefix or ''}
+    if start_after:
+        paginate_args['StartAfter'] = start_after
+    keys = []
+    for page in app_module.s3_client.get_paginator('list_objects_v2').paginate(**paginate_args):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if not app_module.is_listable_file(key):
+                continue
+            if start_after and key <= start_after:
+                continue
+            if end_before and key >= end_before:
+                continue
+            keys.append(key)
+    return keys
+
+def resolve_file_keys(app_module, args):
+    """指定されたキー・日付・キーの範囲から対象のファイルを集める（重複は除き、指定順を保つ）"""
+    keys = list(args.key)
+    for date_str in args.date:
+        files = sorted(app_module.list_files_for_date(date_str), key=lambda entry: entry['last_modified'])
+        keys.extend(entry['key'] for entry in files)
+    if args.key_prefix is not None or args.start_after or args.end_before:
+        keys.extend(list_keys_in_range(app_module, args.key_prefix, args.start_after, args.end_before))
+    return list(dict.fromkeys(keys))
+
+def select_templates(templates, selectors):
+    """名前またはIDで指定されたテンプレートを返す（指定がなければすべて）"""
+    if not selectors:
+        return list(templates)
+    selected = []
+    for selector in selectors:
+        matches = [template for template in templates if selector in (template.get('id'), template.get('name'))]
+        if not matches:
+            raise ValueError(f"テンプレート「{selector}」が見つかりません。")
+        selected.extend(template for template in matches if template not in selected)
+    return selected
+
+def result_key(app_module, run_id, file_key, template):
+    file_stem = file_key[:-len('.csv')] if file_key.endswith('.csv') else file_key
+    return f"{app_module.BATCH_RESULT_S3_PREFIX}{run_id}/{file_stem}/{template['id']}.csv"
+
+def upload_result(app_module, df, key):
+    """結果をCSV（画面からのダウンロードと同じ形式）として書き出してS3に保存し、サイズを返す"""
+    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as spool_file:
+        path = spool_file.name
+    try:
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+        app_module.s3_client.upload_file(path, app_module.S3_BUCKET_NAME, key, ExtraArgs={'ContentType': 'text/csv'},
+                                         Config=app_module.S3_TRANSFER_CONFIG)
+        return os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+def apply_template(app_module, run_id, file_key, df, template):
+    """絞り込み済みのDataFrameにテンプレートのAIプロンプト処理を行い、結果を保存する"""
+    started = time.perf_counter()
+    profiler = app_module.JobProfiler(f"batch-{uuid.uuid4()}")
+    job = {'file': file_key, 'templateId': template['id'], 'templateName': template['name'], 'templateVersion': template.get('version'),
+           'resultKey': None, 'rowCount': 0, 'resultSize': 0, 'failedBatches': 0, 'log': [], 'stages': [], 'error': None}
+    try:
+        result_df = df
+        if not df.empty:
+            with profiler.stage('ai_filter', 'AIプロンプト処理', rows_in=len(df)) as stage:
+                result_df = app_module.run_ai_row_filter(df, template['content'], job['log'], stage)
+                stage.rows_out = len(result_df)
+        key = result_key(app_module, run_id, file_key, template)
+        with profiler.stage('write_result', '結果の書き出し', rows_in=len(result_df)):
+            job['resultSize'] = upload_result(app_module, result_df, key)
+        job['resultKey'] = key
+        job['rowCount'] = len(result_df)
+    except Exception as e:
+        traceback.print_exc()
+        job['error'] = f"テンプレートの適用に失敗しました: {str(e)}"
+    job['failedBatches'] = sum(metrics.counters['failedBatches'] for metrics in profiler.stages)
+    job['stages'] = [metrics.as_dict() for metrics in profiler.stages]
+    job['seconds'] = round(time.perf_counter() - started, 2)
+    return job
+
+def process_file(run_id, file_key, templates, form_data, template_threads):
+    """1つのファイルを1回だけ読み込んで絞り込み、その結果に各テンプレートを並列に適用する
+
+    (ファイルの集計, テンプレートごとの結果のリスト)を返す。
+    """
+    app_module = load_app()
+    started = time.perf_counter()
+    job_id = f"batch-{uuid.uuid4()}"
+    profiler = app_module.JobProfiler(job_id)
+    file_summary = {'key': file_key, 'rowCount': 0, 'log': [], 'stages': [], 'failedBatches': 0, 'error': None}
+    df_latest = None
+    try:
+        with app_module.open_s3_csv_stream(file_key) as latest_file_stream:
+            filtered = app_module.filter_latest_file(job_id, started, profiler, latest_file_stream, os.path.basename(file_key), None, form_data)
+        if filtered is None:
+            # 差分抽出に失敗した場合は、画面と同じくジョブの記録に中断の理由が残る
+            job = app_module.job_store.get(job_id) or {}
+            file_summary['log'] = (job.get('result') or {}).get('log', [])
+            file_summary['error'] = "差分抽出に失敗したため、このファイルは処理しませんでした。"
+        else:
+            df_latest, processing_log, date_format_allowed = filtered
+            if date_format_allowed:
+                app_module.run_ai_date_format(df_latest, form_data, processing_log, profiler)
+            file_summary['log'] = processing_log
+            file_summary['rowCount'] = len(df_latest)
+    except Exception as e:
+        traceback.print_exc()
+        file_summary['error'] = f"ファイルの読込・絞り込みに失敗しました: {str(e)}"
+    file_summary['failedBatches'] = sum(metrics.counters['failedBatches'] for metrics in profiler.stages)
+    file_summary['stages'] = [metrics.as_dict() for metrics in profiler.stages]
+
+    if df_latest is None:
+        jobs = [{'file': file_key, 'templateId': template['id'], 'templateName': template['name'], 'templateVersion': template.get('version'),
+                 'resultKey': None, 'rowCount': 0, 'resultSize': 0, 'failedBatches': 0, 'log': [], 'stages': [], 'seconds': 0,
+                 'error': file_summary['error']} for template in templates]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(template_threads, len(templates)))) as executor:
+            jobs = list(executor.map(lambda template: apply_template(app_module, run_id, file_key, df_latest, template), templates))
+    file_summary['seconds'] = round(time.perf_counter() - started, 2)
+    return file_summary, jobs
+
+def init_worker():
+    """子プロセスでmainを読み込んでおく（Geminiの初期化などは各プロセスで1回だけ行う）"""
+    load_app()
+
+def run_files(run_id, file_keys, templates, form_data, workers, template_threads):
+    """ファイルを並列に処理し、終わった順に(ファイルの集計, テンプレートごとの結果)を返す"""
+    if workers == 1:
+        for file_key in file_keys:
+            yield process_file(run_id, file_key, templates, form_data, template_threads)
+        return
+    # fork後のスレッド（AIの呼び出しやS3の転送）の状態を引き継がないよう、子プロセスは新しく起動する
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker) as executor:
+        futures = [executor.submit(process_file, run_id, file_key, templates, form_data, template_threads) for file_key in file_keys]
+        for future in as_completed(futures):
+            yield future.result()
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済みのテンプレートをS3上のCSVにまとめて適用する")
+    parser.add_argument('--date', action='append', default=[], help="対象のファイルを保存した日付（YYYY-MM-DD、UTC。複数指定可）")
+    parser.add_argument('--key', action='append', default=[], help="対象のファイルのキー（複数指定可）")
+    parser.add_argument('--key-prefix', help="このプレフィックスで始まるキーを対象にする")
+    parser.add_argument('--start-after', help="このキーより後（辞書順）のキーを対象にする")
+    parser.add_argument('--end-before', help="このキーより前（辞書順）のキーを対象にする")
+    parser.add_argument('--template', action='append', default=[], help="適用するテンプレートの名前またはID（複数指定可。省略時はすべて）")
+    parser.add_argument('--options', help="差分抽出・日付フィルタ・キーワード検索などの設定（JSON）")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="ファイルを並列に処理するプロセス数")
+    parser.add_argument('--template-threads', type=int, default=DEFAULT_TEMPLATE_THREADS, help="1つのファイルでテンプレートを並列に適用するスレッド数")
+    parser.add_argument('--run-id', help="実行ID（結果の保存先に使う。省略時は日時から作る）")
+    parser.add_argument('--dry-run', action='store_true', help="対象のファイルとテンプレートを表示するだけで処理しない")
+    args = parser.parse_args()
+    if args.workers < 1 or args.template_threads < 1:
+        parser.error("--workers と --template-threads は1以上を指定してください。")
+    if not (args.date or args.key or args.key_prefix is not None or args.start_after or args.end_before):
+        args.date = [datetime.now(timezone.utc).date().isoformat()]
+
+    configure_environment(args.workers)
+    app_module = load_app()
+    if not app_module.s3_client:
+        print("エラー: S3が設定されていません。")
+        return 1
+    if not app_module.model:
+        print("エラー: AI機能が設定されていません。（GEMINI_API_KEYを確認してください）")
+        return 1
+
+    try:
+        form_data = load_form_data(args.options)
+        templates, _ = app_module.template_store.get()
+        templates = select_templates(templates, args.template)
+        file_keys = resolve_file_keys(app_module, args)
+    except Exception as e:
+        print(f"エラー: {e}")
+        return 1
+    if not templates:
+        print("エラー: 適用するテンプレートがありません。")
+        return 1
+
+    run_id = args.run_id or f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{uuid.uuid4().hex[:8]}"
+    workers = min(args.workers, max(1, len(file_keys)))
+    print(f"--- バッチ処理を開始します（実行ID: {run_id}、{len(file_keys)}ファイル × {len(templates)}テンプレート、{workers}プロセス） ---")
+    for file_key in file_keys:
+        print(f"  ファイル: {file_key}")
+    for template in templates:
+        print(f"  テンプレート: {template['name']} ({template['id']})")
+    if args.dry_run:
+        return 0
+
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    files = []
+    jobs = []
+    for number, (file_summary, file_jobs) in enumerate(run_files(run_id, file_keys, templates, form_data, workers, args.template_threads), start=1):
+        files.append(file_summary)
+        jobs.extend(file_jobs)
+        failed = sum(1 for job in file_jobs if job['error'])
+        status = f"エラー{failed}件 ❌" if failed else "完了 ✅"
+        print(f"[{number}/{len(file_keys)}] {file_summary['key']}: {file_summary['rowCount']}行 × {len(file_jobs)}テンプレート {status} ({file_summary['seconds']:.1f}秒)")
+        for job in file_jobs:
+            if job['error']:
+                print(f"    {job['templateName']}: {job['error']}")
+
+    failed_jobs = sum(1 for job in jobs if job['error'])
+    failed_batches = sum(file_summary['failedBatches'] for file_summary in files) + sum(job['failedBatches'] for job in jobs)
+    manifest = {
+        'runId': run_id,
+        'startedAt': started_at.isoformat(),
+        'completedAt': datetime.now(timezone.utc).isoformat(),
+        'seconds': round(time.perf_counter() - started, 2),
+        'selection': {'dates': args.date, 'keys': args.key, 'keyPrefix': args.key_prefix, 'startAfter': args.start_after, 'endBefore': args.end_before},
+        'templates': [{'id': template['id'], 'name': template['name'], 'version': template.get('version')} for template in templates],
+        'formData': form_data,
+        'workers': workers,
+        'failedJobs': failed_jobs,
+        'failedBatches': failed_batches,
+        'files': files,
+        'jobs': jobs,
+    }
+    manifest_key = f"{app_module.BATCH_RESULT_S3_PREFIX}{run_id}/manifest.json"
+    app_module.s3_client.put_object(Bucket=app_module.S3_BUCKET_NAME, Key=manifest_key,
+                                    Body=json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'), ContentType='application/json')
+    print(f"\n{len(jobs) - failed_jobs}/{len(jobs)}件の処理が完了しました。（{manifest['seconds']:.1f}秒）まとめ: {manifest_key}")
+    if failed_batches:
+        print(f"警告: {failed_batches}件のAIバッチが失敗しました。該当する行はAI処理前のデータのまま結果に含まれています。")
+    return 1 if failed_jobs else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,586 @@
+"""CSV処理のベンチマーク（GeminiとS3はローカルの代替を使うため、外部サービスなしで同じ条件を再現できる）
+
+入札案件を模した合成CSV（和暦の日付を含む）を行数・文字コードごとに生成し、
+/api/process・/api/chat・S3関連のエンドポイントをFlaskのテストクライアント経由で実行して、
+処理時間のパーセンタイル、スループット、段階ごとの処理時間とメモリ使用量を計測する。
+
+使い方:
+    python benchmark.py                                   # 1万行・10万行・100万行 × UTF-8・cp932 を計測する
+    python benchmark.py --sizes 10000 --repeat 3          # 小さいデータで手早く計測する
+    python benchmark.py --model-latency 0.2               # AIの応答時間を変えて計測する
+    python benchmark.py --save-baseline                   # 結果を基準値として保存する
+    python benchmark.py --baseline benchmark_baseline.json  # 基準値より遅くなった項目があれば終了コード1を返す
+"""
+import os
+import io
+import sys
+import re
+import json
+import time
+import argparse
+import shutil
+import hashlib
+import platform
+import tempfile
+import threading
+import importlib
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+# メモリ使用量の計測はUnix系のみ
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_SIZES = "10000,100000,1000000"
+DEFAULT_ENCODINGS = "utf-8,cp932"
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), "csv_helper_benchmark")
+DEFAULT_BASELINE_PATH = "benchmark_baseline.json"
+DEFAULT_OUTPUT_PATH = "benchmark_results.json"
+BENCHMARK_BUCKET = "benchmark"
+GENERATE_BLOCK_ROWS = 10000  # 乱数はこの行数のブロック単位で作る（行数の違うファイルでも同じ案件番号は同じ内容になる）
+PREVIOUS_FILE_SHARE = 0.9  # 前回ファイルに含める行の割合（残りが新規案件になる）
+CHANGED_ROW_INTERVAL = 50  # この間隔で前回ファイルから予定価格が変わった行を作る
+STATUS_POLL_SECONDS = 0.05
+REGRESSION_MIN_SECONDS = 0.05  # これより短い処理時間の差は誤差として扱う
+
+# ★★★ 合成データ（入札案件のCSV） ★★★
+AGENCIES = ['国土交通省 関東地方整備局', '東京都 財務局', '大阪府 都市整備部', '横浜市 道路局', '札幌市 建設局',
+            '福岡県 県土整備部', '防衛省 北関東防衛局', '総務省 情報流通行政局', '名古屋市 上下水道局', '京都府 教育委員会']
+REGIONS = ['北海道', '東北', '関東', '中部', '近畿', '中国', '四国', '九州・沖縄']
+CATEGORIES = ['土木一式工事', '建築一式工事', '電気工事', '管工事', '舗装工事', '物品購入', '役務の提供', '情報処理', '測量', '清掃']
+SUBJECTS = ['庁舎空調設備更新', '道路舗装補修', 'PC導入', 'サーバー刷新', '複合機賃貸借', '河川護岸整備',
+            '学校給食調理業務委託', '橋梁点検', '公用車リース', 'ネットワーク保守', '上水道管更新', '公園清掃業務']
+SUMMARY_WORDS = ['保守', '更新', '点検', '賃貸借', '設計', '改修', '委託', 'システム', '調達', '整備', '運用', '撤去']
+# 公示日は表記を混在させる（ルールで整形できる和暦・西暦と、AIに送られる曖昧な表記）
+DATE_STYLES = ['reiwa', 'reiwa_short', 'heisei', 'slash', 'iso', 'vague']
+DATE_STYLE_WEIGHTS = [0.35, 0.15, 0.05, 0.2, 0.2, 0.05]
+VAGUE_SUFFIXES = ['上旬', '中旬', '下旬', '頃']
+
+def format_publication_dates(rng, dates):
+    """日付の配列を、和暦・西暦・曖昧な表記が混在した文字列に変換する"""
+    styles = rng.choice(DATE_STYLES, size=len(dates), p=DATE_STYLE_WEIGHTS)
+    years, months, days = dates.year.to_numpy(), dates.month.to_numpy(), dates.day.to_numpy()
+    values = []
+    for style, year, month, day in zip(styles, years, months, days):
+        if style == 'reiwa':
+            values.append(f"令和{year - 2018}年{month}月{day}日")
+        elif style == 'reiwa_short':
+            values.append(f"R{year - 2018}.{month}.{day}")
+        elif style == 'heisei':
+            values.append(f"平成{year - 1988}年{month}月{day}日")
+        elif style == 'slash':
+            values.append(f"{year}/{month:02d}/{day:02d}")
+        elif style == 'iso':
+            values.append(f"{year}-{month:02d}-{day:02d}")
+        else:
+            values.append(f"令和{year - 2018}年{month}月{VAGUE_SUFFIXES[day % len(VAGUE_SUFFIXES)]}")
+    return values
+
+def generate_tender_block(seed, start_id, rows, revision):
+    """案件番号start_idからrows行分のDataFrameを作る（start_idとrowsが同じなら常に同じ内容になる）"""
+    rng = np.random.default_rng([seed, start_id])
+    ids = np.arange(start_id, start_id + rows)
+    base_dates = pd.Timestamp('2024-04-01') + pd.to_timedelta(rng.integers(0, 730, size=rows), unit='D')
+    # 平成の表記は平成31年（2019年）4月までに限る
+    heisei_dates = pd.Timestamp('2018-04-01') + pd.to_timedelta(rng.integers(0, 390, size=rows), unit='D')
+    publication = pd.DatetimeIndex(np.where(rng.random(rows) < 0.05, heisei_dates, base_dates))
+    deadline = publication + pd.to_timedelta(rng.integers(14, 60, size=rows), unit='D')
+    prices = rng.integers(100, 500000, size=rows) * 1000
+    # 前回ファイルから内容が変わった案件（キー列は同じで予定価格だけが違う）
+    if revision:
+        prices = np.where(ids % CHANGED_ROW_INTERVAL == 0, prices + 1000 * revision, prices)
+    summary_words = np.asarray(SUMMARY_WORDS)[rng.integers(0, len(SUMMARY_WORDS), size=(rows, 3))]
+    subjects = np.asarray(SUBJECTS)[rng.integers(0, len(SUBJECTS), size=rows)]
+    return pd.DataFrame({
+        '案件番号': [f"T{i:08d}" for i in ids],
+        '案件名': [f"{subject}（第{i % 97 + 1}期）" for subject, i in zip(subjects, ids)],
+        '発注機関': np.asarray(AGENCIES)[rng.integers(0, len(AGENCIES), size=rows)],
+        '地域': np.asarray(REGIONS)[rng.integers(0, len(REGIONS), size=rows)],
+        '業種': np.asarray(CATEGORIES)[rng.integers(0, len(CATEGORIES), size=rows)],
+        '公示日': format_publication_dates(rng, publication),
+        '入札締切日': deadline.strftime('%Y-%m-%d'),
+        '予定価格': [f"{price:,}" for price in prices],
+        '概要': ['・'.join(words) + 'に関する案件' for words in summary_words],
+    })
+
+def generate_tender_csv(path, rows, encoding, seed, revision=0):
+    """合成CSVを書き出す（同じ引数なら同じ内容になるため、既にある場合は再利用する）"""
+    if os.path.exists(path):
+        return path
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding=encoding, newline='') as f:
+        for start in range(0, rows, GENERATE_BLOCK_ROWS):
+            block = generate_tender_block(seed, start, GENERATE_BLOCK_ROWS, revision)
+            block.iloc[:rows - start].to_csv(f, index=False, header=start == 0)
+    os.replace(temp_path, path)
+    return path
+
+# ★★★ Geminiの代替（応答時間を指定できる決定的な応答） ★★★
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+class FakeResponse:
+    def __init__(self, text, prompt):
+        self.text = text
+        # トークン数は日本語の文字数をもとにした概算
+        self.usage_metadata = FakeUsage(len(prompt) // 2, len(text) // 2)
+
+class FakeGeminiModel:
+    """model.generate_contentの代替。プロンプトの種類を見分けて、それらしい応答を返す"""
+
+    VAGUE_DAYS = {'上旬': 1, '中旬': 11, '下旬': 21, '頃': 15}
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, prompt, **kwargs):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if '# 変換対象のJSON配列' in prompt:
+            text = self._format_dates(json.loads(prompt.rsplit('# 変換対象のJSON配列', 1)[1].strip()))
+        elif '行番号（インデックス）' in prompt:
+            text = self._filter_rows(prompt)
+        elif 'クエリプラン（JSON）' in prompt:
+            text = json.dumps({
+                'answerable': True, 'filters': [], 'group_by': ['地域'],
+                'aggregates': [{'column': None, 'func': 'count', 'as': '件数'}],
+                'sort': {'by': '件数', 'desc': True}, 'limit': 10,
+            }, ensure_ascii=False)
+        else:
+            text = "集計結果をもとに回答します。地域別の件数は上記の表のとおりです。"
+        return FakeResponse(text, prompt)
+
+    def _format_dates(self, values):
+        formatted = {}
+        for value in values:
+            matched = re.match(r'令和(\d+)年(\d+)月(上旬|中旬|下旬|頃)', value)
+            if matched:
+                year, month = int(matched.group(1)) + 2018, int(matched.group(2))
+                formatted[value] = f"{year}-{month:02d}-{self.VAGUE_DAYS[matched.group(3)]:02d}"
+            else:
+                formatted[value] = ""
+        return json.dumps(formatted, ensure_ascii=False)
+
+    def _filter_rows(self, prompt):
+        # 「保守」を含む行を合致とする（行番号は各行の先頭にある）
+        csv_text = prompt.split('```csv', 1)[1].split('```', 1)[0]
+        matched = [int(line.split(',', 1)[0]) for line in csv_text.strip().splitlines()[1:]
+                   if '保守' in line and line.split(',', 1)[0].isdigit()]
+        return json.dumps(matched)
+
+# ★★★ S3の代替（ローカルのディレクトリに保存する） ★★★
+def s3_error(code, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'S3')
+
+class FileSystemS3Paginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix='', PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        keys = self.client.list_keys(Prefix)
+        for i in range(0, len(keys), page_size):
+            yield {'Contents': [self.client.object_summary(key) for key in keys[i:i + page_size]], 'KeyCount': len(keys[i:i + page_size])}
+
+class FileSystemS3Client:
+    """アプリが使うS3 APIの一部（条件付き書き込み・Range付き読み込みを含む）をローカルのファイルで再現する"""
+
+    def __init__(self, root):
+        self.root = root
+        self.etags = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def _etag(self, key):
+        if key not in self.etags:
+            with open(self._path(key), 'rb') as f:
+                self.etags[key] = f'"{hashlib.md5(f.read()).hexdigest()}"'
+        return self.etags[key]
+
+    def _write(self, key, source):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.md5()
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            while True:
+                data = source.read(1024 * 1024)
+                if not data:
+                    break
+                digest.update(data)
+                f.write(data)
+        os.replace(temp_path, path)
+        self.etags[key] = f'"{digest.hexdigest()}"'
+        return self.etags[key]
+
+    def _check_conditions(self, key, IfMatch=None, IfNoneMatch=None):
+        exists = os.path.exists(self._path(key))
+        if IfNoneMatch == '*' and exists:
+            raise s3_error('PreconditionFailed', 412)
+        if IfMatch and (not exists or self._etag(key) != IfMatch):
+            raise s3_error('PreconditionFailed', 412)
+        return exists
+
+    def list_keys(self, prefix=''):
+        keys = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(directory, filename), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def object_summary(self, key):
+        stat = os.stat(self._path(key))
+        return {'Key': key, 'Size': stat.st_size, 'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc), 'ETag': self._etag(key)}
+
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        source = io.BytesIO(Body) if isinstance(Body, (bytes, bytearray)) else Body
+        with self.lock:
+            self._check_conditions(Key, IfMatch=IfMatch, IfNoneMatch=IfNoneMatch)
+            return {'ETag': self._write(Key, source)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        with self.lock:
+            self._write(Key, Fileobj)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.upload_fileobj(f, Bucket, Key)
+
+    def head_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        with self.lock:
+            if not os.path.exists(self._path(Key)):
+                raise s3_error('404', 404)
+            self._check_conditions(Key, IfMatch=IfMatch)
+            summary = self.object_summary(Key)
+        return {'ContentLength': summary['Size'], 'ETag': summary['ETag'], 'LastModified': summary['LastModified']}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, IfNoneMatch=None, **kwargs):
+        with self.lock:
+            if not os.path.exists(self._path(Key)):
+                raise s3_error('NoSuchKey', 404)
+            self._check_conditions(Key, IfMatch=IfMatch)
+            summary = self.object_summary(Key)
+        if IfNoneMatch and IfNoneMatch == summary['ETag']:
+            raise s3_error('304', 304)
+        size = summary['Size']
+        f = open(self._path(Key), 'rb')
+        response = {'ETag': summary['ETag'], 'LastModified': summary['LastModified'], 'ContentLength': size}
+        if Range:
+            start, end = Range.split('=', 1)[1].split('-')
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+            if start >= size:
+                f.close()
+                raise s3_error('InvalidRange', 416)
+            f.seek(start)
+            data = f.read(end - start + 1)
+            f.close()
+            response.update(Body=StreamingBody(io.BytesIO(data), len(data)), ContentLength=len(data), ContentRange=f"bytes {start}-{end}/{size}")
+            return response
+        response['Body'] = StreamingBody(f, size)
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.etags.pop(Key, None)
+            try:
+                os.remove(self._path(Key))
+            except FileNotFoundError:
+                pass
+
+    def get_paginator(self, operation_name):
+        return FileSystemS3Paginator(self)
+
+# ★★★ 計測 ★★★
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def summarize_seconds(values):
+    values = np.asarray(values, dtype=float)
+    return {
+        'p50': round(float(np.percentile(values, 50)), 4),
+        'p95': round(float(np.percentile(values, 95)), 4),
+        'p99': round(float(np.percentile(values, 99)), 4),
+        'mean': round(float(values.mean()), 4),
+        'runs': len(values),
+    }
+
+class ScenarioRecorder:
+    """シナリオごとの処理時間・スループット・段階ごとの計測値を集める"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, scenario, seconds, units=None, unit_name=None, stages=None):
+        sample = self.samples.setdefault(scenario, {'seconds': [], 'units': units, 'unitName': unit_name, 'stages': {}})
+        sample['seconds'].append(seconds)
+        for stage in stages or []:
+            stage_sample = sample['stages'].setdefault(stage['stage'], {'seconds': [], 'peakRssBytes': 0, 'rowsIn': stage['rowsIn'], 'rowsOut': stage['rowsOut'], 'modelCalls': []})
+            stage_sample['seconds'].append(stage['seconds'])
+            stage_sample['modelCalls'].append(stage.get('modelCalls', 0))
+            stage_sample['peakRssBytes'] = max(stage_sample['peakRssBytes'], stage.get('peakRssBytes') or 0)
+
+    def summary(self):
+        results = {}
+        for scenario, sample in self.samples.items():
+            latency = summarize_seconds(sample['seconds'])
+            result = {'latency': latency}
+            if sample['units']:
+                result['throughput'] = {'value': round(sample['units'] / latency['p50'], 2) if latency['p50'] else None, 'unit': f"{sample['unitName']}/s"}
+            if sample['stages']:
+                result['stages'] = {
+                    name: {**summarize_seconds(stage['seconds']), 'rowsIn': stage['rowsIn'], 'rowsOut': stage['rowsOut'],
+                           'peakRssBytes': stage['peakRssBytes'], 'modelCalls': int(np.median(stage['modelCalls']))}
+                    for name, stage in sample['stages'].items()
+                }
+            results[scenario] = result
+        return results
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+def check_response(response, scenario):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{scenario} が失敗しました (HTTP {response.status_code}): {response.get_data(as_text=True)[:500]}")
+    return response
+
+def clear_cache_namespace(cache, namespace):
+    """PersistentLRUCacheの名前空間の値を、SQLiteとメモリ上のLRUキャッシュの両方から削除する"""
+    with cache.lock:
+        connection = cache._connect()
+        connection.execute(f"DELETE FROM {cache.table} WHERE namespace = ?", (namespace,))
+        connection.commit()
+        for cache_key in [cache_key for cache_key in cache.memory.keys() if cache_key[0] == namespace]:
+            cache.memory.pop(cache_key, None)
+
+def clear_ai_caches(app_module):
+    """キャッシュの効いていない初回の処理を計測するため、AI結果とプロファイルのキャッシュ、ジョブのチェックポイントを削除する"""
+    clear_cache_namespace(app_module.date_format_cache, app_module.DATE_FORMAT_CACHE_NAMESPACE)
+    clear_cache_namespace(app_module.row_filter_cache, app_module.row_filter_cache_namespace(PROCESS_FORM['ai_prompt']))
+    clear_cache_namespace(app_module.dataset_profile_cache, app_module.DATASET_PROFILE_CACHE_NAMESPACE)
+    shutil.rmtree(app_module.CHECKPOINT_DIR, ignore_errors=True)
+
+PROCESS_FORM = {
+    'diff_key_column': '案件番号',
+    'diff_include_changed': 'on',
+    'filter_date_column_1': '入札締切日',
+    'filter_date_value_1': '2025-01-01',
+    'keyword_column': '概要',
+    'keywords': '保守\n点検\n更新',
+    'search_type': 'OR',
+    'keyword_normalize': 'on',
+    'ai_date_format_enabled': 'on',
+    'ai_date_format_column': '公示日',
+    'ai_prompt': '概要に「保守」を含む案件だけを残してください。',
+}
+CHAT_QUESTION = '地域ごとの案件数を多い順に教えてください。'
+
+def run_process(client, latest_path, previous_key, scenario, recorder, rows):
+    def submit_and_wait():
+        with open(latest_path, 'rb') as f:
+            response = check_response(client.post('/api/process', data={
+                **PROCESS_FORM, 'previous_file_key': previous_key, 'latest_file': (f, os.path.basename(latest_path)),
+            }, content_type='multipart/form-data'), scenario)
+        job_id = response.get_json()['job_id']
+        while True:
+            status = client.get(f'/api/process_status/{job_id}')
+            payload = status.get_json()
+            if payload['status'] != 'processing':
+                check_response(status, scenario)
+                return payload
+            time.sleep(STATUS_POLL_SECONDS)
+
+    payload, seconds = timed(submit_and_wait)
+    recorder.add(scenario, seconds, units=rows, unit_name='rows', stages=payload.get('metrics'))
+    return payload
+
+def run_size(client, app_module, args, recorder, rows, encoding):
+    label = f"{rows}rows/{encoding}"
+    data_dir = os.path.join(args.workdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    previous_rows = int(rows * PREVIOUS_FILE_SHARE)
+    previous_path = generate_tender_csv(os.path.join(data_dir, f"tender_{rows}_{encoding}_{args.seed}_previous.csv"), previous_rows, encoding, args.seed)
+    latest_path = generate_tender_csv(os.path.join(data_dir, f"tender_{rows}_{encoding}_{args.seed}_latest.csv"), rows, encoding, args.seed, revision=1)
+    latest_bytes = os.path.getsize(latest_path)
+    previous_key = f"benchmark_{rows}_{encoding}_previous.csv"
+    latest_key = f"benchmark_{rows}_{encoding}_latest.csv"
+    today = datetime.now(timezone.utc).date().isoformat()
+
+    for run in range(args.repeat):
+        clear_ai_caches(app_module)
+        print(f"  {label} {run + 1}/{args.repeat}回目")
+
+        # S3への保存（行ハッシュインデックスとParquetのコピーの作成を含む）
+        for path, key in ((previous_path, previous_key), (latest_path, latest_key)):
+            with open(path, 'rb') as f:
+                response, seconds = timed(lambda: check_response(client.post('/api/save_latest_file', data={
+                    'file_to_save': (f, key), 'diff_key_column': PROCESS_FORM['diff_key_column'],
+                }, content_type='multipart/form-data'), 's3.save_latest_file'))
+            if key == latest_key:
+                recorder.add(f"s3.save_latest_file/{label}", seconds, units=latest_bytes / 1e6, unit_name='MB')
+
+        _, seconds = timed(lambda: check_response(client.get(f'/api/files_by_date?date={today}'), 's3.files_by_date'))
+        recorder.add(f"s3.files_by_date/{label}", seconds)
+        _, seconds = timed(lambda: check_response(client.get(f'/api/load_file_by_key?key={latest_key}&preview=5'), 's3.load_file_by_key'))
+        recorder.add(f"s3.load_file_by_key_preview/{label}", seconds)
+
+        # 差分抽出（S3の行ハッシュインデックス）→ 日付 → キーワード → AI日付整形 → AIプロンプト処理
+        payload = run_process(client, latest_path, previous_key, f"process/{label}", recorder, rows)
+        download, seconds = timed(lambda: check_response(client.get(payload['downloadUrl'], headers={'Accept-Encoding': 'gzip'}), 'process_result'))
+        recorder.add(f"process_result/{label}", seconds, units=len(download.get_data()) / 1e6, unit_name='MB')
+
+        # チャット（S3上のファイル全体のプロファイル作成と、クエリプランのローカル実行）
+        dataset, seconds = timed(lambda: check_response(client.post('/api/datasets', json={'file_key': latest_key}), 'datasets'))
+        recorder.add(f"chat.register_dataset/{label}", seconds, units=rows, unit_name='rows')
+        dataset_id = dataset.get_json()['datasetId']
+        _, seconds = timed(lambda: check_response(client.post('/api/chat', json={'dataset_id': dataset_id, 'question': CHAT_QUESTION}), 'chat'))
+        recorder.add(f"chat.query/{label}", seconds, units=rows, unit_name='rows')
+
+# ★★★ 基準値との比較 ★★★
+def compare_with_baseline(results, baseline, tolerance):
+    """p50の処理時間が基準値より(1 + tolerance)倍以上遅くなった項目を返す"""
+    regressions = []
+
+    def check(name, current, previous):
+        if previous is None or current is None:
+            return
+        if current > previous * (1 + tolerance) and current - previous > REGRESSION_MIN_SECONDS:
+            regressions.append(f"{name}: {previous:.3f}秒 -> {current:.3f}秒 (+{(current / previous - 1) * 100 if previous else float('inf'):.0f}%)")
+
+    for scenario, result in results.items():
+        baseline_result = baseline.get('results', {}).get(scenario)
+        if not baseline_result:
+            continue
+        check(scenario, result['latency']['p50'], baseline_result['latency']['p50'])
+        for stage, stage_result in result.get('stages', {}).items():
+            baseline_stage = baseline_result.get('stages', {}).get(stage)
+            if baseline_stage:
+                check(f"{scenario} [{stage}]", stage_result['p50'], baseline_stage['p50'])
+    return regressions
+
+def print_results(results):
+    for scenario, result in results.items():
+        latency = result['latency']
+        throughput = result.get('throughput')
+        throughput_text = f"  {throughput['value']:,.1f} {throughput['unit']}" if throughput and throughput['value'] else ""
+        print(f"{scenario:<48} p50 {latency['p50']:8.3f}秒  p95 {latency['p95']:8.3f}秒  p99 {latency['p99']:8.3f}秒{throughput_text}")
+        for stage, stage_result in result.get('stages', {}).items():
+            rss = f"  最大RSS {stage_result['peakRssBytes'] / 1024 / 1024:,.0f}MB" if stage_result['peakRssBytes'] else ""
+            calls = f"  AI呼び出し{stage_result['modelCalls']}回" if stage_result['modelCalls'] else ""
+            print(f"    {stage:<20} p50 {stage_result['p50']:8.3f}秒  {stage_result['rowsIn']:>9}行 -> {stage_result['rowsOut']:>9}行{rss}{calls}")
+
+def configure_environment(args):
+    """mainを読み込む前に、キャッシュ・スプール・ジョブ管理の保存先をベンチマーク用のディレクトリに向ける"""
+    os.environ['AI_CACHE_DB_PATH'] = os.path.join(args.workdir, 'ai_cache.sqlite3')
+    os.environ['RESULT_SPOOL_DIR'] = os.path.join(args.workdir, 'results')
+    os.environ['UPLOAD_SPOOL_DIR'] = os.path.join(args.workdir, 'uploads')
+    os.environ['CHECKPOINT_DIR'] = os.path.join(args.workdir, 'checkpoints')
+    os.environ['CHECKPOINT_STORAGE'] = 'local'
+    os.environ['JOB_STORE_BACKEND'] = 'memory'
+    os.environ['RESULT_STORAGE'] = 'local'
+    os.environ['AI_REQUESTS_PER_MINUTE'] = str(args.requests_per_minute)
+    os.environ['CSV_COMPACT_DTYPES'] = 'on' if args.compact else 'off'
+    # .envの実際の接続情報は使わない
+    for name in ('GEMINI_API_KEY', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'S3_BUCKET_NAME'):
+        os.environ[name] = ''
+
+def main():
+    parser = argparse.ArgumentParser(description="CSV処理のベンチマーク（GeminiとS3はローカルの代替を使用）")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="計測する行数（カンマ区切り）")
+    parser.add_argument('--encodings', default=DEFAULT_ENCODINGS, help="計測する文字コード（カンマ区切り）")
+    parser.add_argument('--repeat', type=int, default=5, help="各シナリオの実行回数")
+    parser.add_argument('--seed', type=int, default=20240401, help="合成データの乱数シード")
+    parser.add_argument('--model-latency', type=float, default=0.05, help="AIの代替の応答時間（秒）")
+    parser.add_argument('--requests-per-minute', type=float, default=600000, help="AI呼び出しのレート制限")
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help="合成データ・S3の代替・キャッシュを置くディレクトリ")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_PATH, help="計測結果を書き出すJSONファイル")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="比較する基準値のJSONファイル")
+    parser.add_argument('--save-baseline', action='store_true', help="今回の結果を基準値として保存する")
+    parser.add_argument('--compact', action='store_true', help="省メモリモード（CSV_COMPACT_DTYPES=on）で計測する")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="基準値に対して許容する遅延の割合")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    app_module = importlib.import_module('main')
+    app_module.model = FakeGeminiModel(latency=args.model_latency)
+    app_module.s3_client = FileSystemS3Client(os.path.join(args.workdir, 's3', BENCHMARK_BUCKET))
+    app_module.S3_BUCKET_NAME = BENCHMARK_BUCKET
+    client = app_module.app.test_client()
+
+    recorder = ScenarioRecorder()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    encodings = [encoding.strip() for encoding in args.encodings.split(',') if encoding.strip()]
+    print(f"--- ベンチマークを開始します（{len(sizes)}サイズ × {len(encodings)}文字コード × {args.repeat}回） ---")
+    started = time.perf_counter()
+    for rows in sizes:
+        for encoding in encodings:
+            run_size(client, app_module, args, recorder, rows, encoding)
+
+    results = recorder.summary()
+    report = {
+        'createdAt': datetime.now(timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpuCount': os.cpu_count(),
+        },
+        'settings': {
+            'sizes': sizes, 'encodings': encodings, 'repeat': args.repeat, 'seed': args.seed,
+            'modelLatency': args.model_latency, 'compact': args.compact, 'csvChunkSize': app_module.CSV_CHUNK_SIZE, 'jobMaxWorkers': app_module.JOB_MAX_WORKERS,
+        },
+        'totalSeconds': round(time.perf_counter() - started, 2),
+        'peakRssBytes': peak_rss_bytes(),
+        'modelCalls': app_module.model.calls,
+        'results': results,
+    }
+    print_results(results)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"計測結果を {args.output} に保存しました。")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"基準値を {args.baseline} に保存しました。")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        baseline_settings = baseline.get('settings', {})
+        if baseline_settings.get('modelLatency') != args.model_latency or baseline_settings.get('compact', False) != args.compact:
+            print("警告: 基準値とAIの応答時間・省メモリモードの設定が異なるため、比較結果は参考値です。")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n[基準値との比較: 遅延あり ❌] (許容: +{args.tolerance * 100:.0f}%)")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\n[基準値との比較: 問題なし ✅]")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
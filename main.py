@@ -1,17 +1,50 @@
 import os
 import io
+import codecs
 import pandas as pd
+import numpy as np
 import google.generativeai as genai
 import json
 import boto3
 from botocore.exceptions import ClientError
-from flask import Flask, request, jsonify, render_template_string, Response
+from boto3.s3.transfer import TransferConfig
+from flask import Flask, request, jsonify, render_template_string, Response, send_file
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 import traceback
 import threading
 import uuid
-from datetime import datetime
+import time
+import sqlite3
+import tempfile
+import random
+import hashlib
+import unicodedata
+import re
+import sys
+import math
+import shutil
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+import zlib
+from cachetools import LRUCache, TTLCache
+from pandas.api.types import union_categoricals
+
+# Parquetでの保存は任意機能（pyarrowがない環境ではCSVのみで動作する）
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# メモリ使用量の計測はUnix系のみ（resourceがない環境では記録しない）
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -26,13 +59,16 @@ AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
 S3_POINTER_FILE_KEY = "__latest_filename_pointer.txt" 
 S3_TEMPLATES_KEY = "prompt_templates.json" # ★★★ テンプレート保存用のファイル名 ★★★
+GEMINI_MODEL_NAME = "gemini-2.5-flash-lite"  # 最新の軽量モデル
+S3_ROW_INDEX_SUFFIX = ".rowindex.npz"  # 保存したCSVごとの行ハッシュインデックス（サイドカー）の拡張子
+S3_PARQUET_SUFFIX = ".parquet"  # 保存したCSVごとの列指向・圧縮コピーの拡張子
 
 # --- AIモデルとS3クライアントの初期化 ---
 model = None
 try:
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash-lite') # 最新の軽量モデルに変更
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
         print("Geminiモデルが正常に初期化されました。")
     else:
         print("警告: GEMINI_API_KEYが設定されていません。AI機能は無効になります。")
@@ -53,19 +89,1648 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY and S3_BUCKET_NAME:
 else:
     print("警告: S3接続情報が不足しているため、S3連携機能は無効になります。")
 
+# ★★★ S3とのストリーミング転送 ★★★
+# 大きなファイルでもワーカーのメモリ使用量が一定になるよう、アップロードはマルチパート、ダウンロードは分割して転送する
+S3_MULTIPART_THRESHOLD_MB = int(os.environ.get("S3_MULTIPART_THRESHOLD_MB", "16"))
+S3_MULTIPART_CHUNK_MB = int(os.environ.get("S3_MULTIPART_CHUNK_MB", "16"))
+S3_MAX_TRANSFER_CONCURRENCY = int(os.environ.get("S3_MAX_TRANSFER_CONCURRENCY", "4"))
+S3_STREAM_CHUNK_SIZE = 1024 * 1024
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_CHUNK_MB * 1024 * 1024,
+    max_concurrency=S3_MAX_TRANSFER_CONCURRENCY,
+)
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "csv_helper_uploads"))
+
+class S3ObjectStream(io.RawIOBase):
+    """S3のオブジェクトを読み込み用のファイルとして扱うためのストリーム
+
+    本体は必要な分だけ順に読み込み、seekされた場合はその位置からRange指定で取得し直す。
+    読み込み途中でオブジェクトが上書きされても混ざらないよう、最初に取得したETagを条件にする。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.position = 0
+        self.body = None
+        self.etag = None
+        self.size = None
+        self.at_end = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            # Parquetのフッターのように末尾から読む場合は、先にサイズだけを取得する
+            if self.size is None:
+                head_object_args = {'Bucket': S3_BUCKET_NAME, 'Key': self.key}
+                if self.etag:
+                    head_object_args['IfMatch'] = self.etag
+                head = s3_client.head_object(**head_object_args)
+                self.size = head['ContentLength']
+                self.etag = self.etag or head['ETag']
+            offset += self.size
+        if offset != self.position:
+            self._close_body()
+            self.position = offset
+            self.at_end = False
+        return self.position
+
+    def _open_body(self):
+        get_object_args = {'Bucket': S3_BUCKET_NAME, 'Key': self.key}
+        if self.etag:
+            get_object_args['IfMatch'] = self.etag
+        if self.position:
+            get_object_args['Range'] = f"bytes={self.position}-"
+        try:
+            s3_object = s3_client.get_object(**get_object_args)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                self.at_end = True
+                return
+            raise
+        self.etag = s3_object['ETag']
+        self.body = s3_object['Body']
+
+    def _close_body(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def readinto(self, buffer):
+        if self.at_end:
+            return 0
+        if self.body is None:
+            self._open_body()
+            if self.at_end:
+                return 0
+        data = self.body.read(len(buffer))
+        if not data:
+            self.at_end = True
+            return 0
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+def open_s3_csv_stream(key):
+    """S3上のCSVを、全体をメモリに読み込まずにpandasへ渡せるストリームとして開く"""
+    return io.BufferedReader(S3ObjectStream(key), buffer_size=S3_STREAM_CHUNK_SIZE)
+
+def spool_upload(file_storage):
+    """アップロードされたファイルをメモリに読み込まず一時ファイルへ書き出し、そのパスを返す"""
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    spool_file = tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, suffix='.csv', delete=False)
+    try:
+        file_storage.save(spool_file, buffer_size=S3_STREAM_CHUNK_SIZE)
+    finally:
+        spool_file.close()
+    return spool_file.name
+
+def s3_download_response(s3_object, filename):
+    """S3オブジェクトの本体を分割して返すレスポンスを作る"""
+    return Response(
+        s3_object['Body'].iter_chunks(S3_STREAM_CHUNK_SIZE),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment;filename={filename}', 'Content-Length': str(s3_object['ContentLength'])}
+    )
+
 # ★★★ 非同期処理用のジョブ管理 ★★★
-jobs = {}  # {job_id: {'status': 'processing'|'completed'|'error', 'result': {...}, 'error': '...'}}
-jobs_lock = threading.Lock()
+# ジョブの記録: {'status': 'processing'|'completed'|'error', 'result': {...}, 'error': '...', 'progress': {...}, 'started_at': ..., 'completed_at': ...}
+# gunicornの複数ワーカーから同じジョブを参照できるよう、既定では同じホストのワーカーで共有するSQLiteに保存する
+JOB_STORE_BACKEND = os.environ.get("JOB_STORE_BACKEND", "sqlite")  # memory / sqlite / filesystem
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(tempfile.gettempdir(), "csv_helper_jobs"))
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", str(6 * 60 * 60)))  # 完了したジョブを保持する秒数
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", str(24 * 60 * 60)))  # 処理中のまま放置されたジョブを削除するまでの秒数
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "2"))  # 同時に実行するジョブ数
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", "8"))  # 実行待ちにできるジョブ数
+JOB_EVICTION_INTERVAL_SECONDS = 60
+# 進捗の配信で、更新の通知がなくてもジョブの記録を読み直す間隔（別のワーカーでの更新を拾うため、共有ストアでは短くする）
+JOB_EVENTS_RECHECK_SECONDS = float(os.environ.get("JOB_EVENTS_RECHECK_SECONDS", "15" if JOB_STORE_BACKEND == 'memory' else "2"))
+JOB_EVENTS_MAX_SECONDS = int(os.environ.get("JOB_EVENTS_MAX_SECONDS", "600"))  # 1つの接続で配信する最大秒数（超えたらブラウザが再接続する）
+JOB_EVENTS_RETRY_MILLISECONDS = 2000  # 切断後にブラウザが再接続するまでの待ち時間
+# 1つの配信は接続中ずっとリクエスト用のスレッドを使うため、プロセスあたりの同時配信数を制限する
+# （gunicornのスレッド数GUNICORN_THREADSの半分以下にし、他のリクエスト用のスレッドを残す。超えた分はポーリングで進捗を取得する）
+JOB_EVENTS_MAX_STREAMS = int(os.environ.get("JOB_EVENTS_MAX_STREAMS", "4"))
 
-def read_csv_from_stream(file_stream):
-    encodings_to_try = ['utf-8-sig', 'utf-8', 'shift-jis', 'cp932']
-    for encoding in encodings_to_try:
+def is_job_expired(job, now):
+    """期限切れのジョブか（完了後TTLを過ぎたもの、または処理中のまま長時間更新されていないもの）"""
+    if job.get('status') == 'processing':
+        return now - job.get('updated_at', now) > JOB_STALE_SECONDS
+    return now - job.get('updated_at', now) > JOB_TTL_SECONDS
+
+class MemoryJobStore:
+    """プロセス内の辞書にジョブを保持するストア（ワーカーが1つの場合向け）"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.last_eviction = 0
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **changes):
+        """ジョブの記録を部分的に更新する（存在しなければ作成する）"""
+        now = time.time()
+        with self.lock:
+            self.jobs[job_id] = {**self.jobs.get(job_id, {}), **changes, 'updated_at': now}
+            if now - self.last_eviction > JOB_EVICTION_INTERVAL_SECONDS:
+                self.last_eviction = now
+                for expired_id in [key for key, job in self.jobs.items() if is_job_expired(job, now)]:
+                    del self.jobs[expired_id]
+
+class SQLiteJobStore:
+    """SQLiteファイルにジョブを保持するストア（同じホストの複数ワーカーで共有できる）"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.last_eviction = 0
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self.connection.commit()
+        return self.connection
+
+    def get(self, job_id):
+        with self.lock:
+            row = self._connect().execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id, **changes):
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            job = {**(json.loads(row[0]) if row else {}), **changes, 'updated_at': now}
+            connection.execute("INSERT OR REPLACE INTO jobs (job_id, data, updated_at) VALUES (?, ?, ?)",
+                               (job_id, json.dumps(job, ensure_ascii=False), now))
+            if now - self.last_eviction > JOB_EVICTION_INTERVAL_SECONDS:
+                self.last_eviction = now
+                expired = [job_id for job_id, data in connection.execute(
+                    "SELECT job_id, data FROM jobs WHERE updated_at < ?", (now - min(JOB_TTL_SECONDS, JOB_STALE_SECONDS),)
+                ) if is_job_expired(json.loads(data), now)]
+                connection.executemany("DELETE FROM jobs WHERE job_id = ?", [(expired_id,) for expired_id in expired])
+            connection.commit()
+
+class FileSystemJobStore:
+    """ディレクトリにジョブごとのJSONファイルを置くストア（共有ディスク上なら複数ワーカーで共有できる）"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.last_eviction = 0
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{secure_filename(job_id)}.json")
+
+    def _read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get(self, job_id):
+        return self._read(self._path(job_id))
+
+    def update(self, job_id, **changes):
+        now = time.time()
+        path = self._path(job_id)
+        with self.lock:
+            job = {**(self._read(path) or {}), **changes, 'updated_at': now}
+            # 読み込み途中のファイルを他のワーカーが見ないよう、一時ファイルに書いてから置き換える
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(job, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+            if now - self.last_eviction > JOB_EVICTION_INTERVAL_SECONDS:
+                self.last_eviction = now
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json'):
+                        expired_path = os.path.join(self.directory, name)
+                        expired_job = self._read(expired_path)
+                        if expired_job is None or is_job_expired(expired_job, now):
+                            try:
+                                os.remove(expired_path)
+                            except FileNotFoundError:
+                                pass
+
+class JobEventHub:
+    """ジョブの記録の更新を、同じプロセスで進捗を配信している接続に知らせる
+
+    ジョブごとに更新のたびに進む版番号を持ち、配信側は版番号が変わるまで待つ（待っている間はCPUを使わない）。
+    """
+
+    FINISHED = -1  # 終了したジョブの版番号
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+        # 終了したジョブは版番号の代わりに一定時間だけ記録し、待っている接続がすぐに終了を読めるようにする
+        self.finished = TTLCache(maxsize=10000, ttl=JOB_EVENTS_MAX_SECONDS)
+
+    def _current(self, job_id):
+        return self.FINISHED if job_id in self.finished else self.versions.get(job_id, 0)
+
+    def version(self, job_id):
+        with self.condition:
+            return self._current(job_id)
+
+    def notify(self, job_id, finished=False):
+        with self.condition:
+            if finished:
+                self.versions.pop(job_id, None)
+                self.finished[job_id] = True
+            else:
+                # 再実行で処理中に戻ったジョブは、版番号を0から数え直す
+                self.finished.pop(job_id, None)
+                self.versions[job_id] = self.versions.get(job_id, 0) + 1
+            self.condition.notify_all()
+
+    def wait(self, job_id, version, timeout):
+        """版番号がversionから変わるか、timeout秒が経過するまで待ち、現在の版番号を返す"""
+        with self.condition:
+            self.condition.wait_for(lambda: self._current(job_id) != version, timeout)
+            return self._current(job_id)
+
+class NotifyingJobStore:
+    """ジョブストアへの更新をJobEventHubに知らせるラッパー（別のワーカーでの更新は配信側が定期的に読み直して拾う）"""
+
+    def __init__(self, store, hub):
+        self.store = store
+        self.hub = hub
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def update(self, job_id, **changes):
+        self.store.update(job_id, **changes)
+        self.hub.notify(job_id, finished=changes.get('status') in ('completed', 'error'))
+
+def create_job_store():
+    if JOB_STORE_BACKEND == 'memory' and int(os.environ.get("WEB_CONCURRENCY", "1") or "1") > 1:
+        print("警告: JOB_STORE_BACKEND=memoryでは、ジョブを開始したワーカー以外から進捗や結果を取得できません。"
+              "複数ワーカー(WEB_CONCURRENCY>1)で動かす場合はsqliteまたはfilesystemを指定してください。")
+    if JOB_STORE_BACKEND == 'sqlite':
+        os.makedirs(os.path.dirname(JOB_STORE_PATH) or '.', exist_ok=True)
+        return SQLiteJobStore(f"{JOB_STORE_PATH}.sqlite3")
+    if JOB_STORE_BACKEND == 'filesystem':
+        return FileSystemJobStore(JOB_STORE_PATH)
+    return MemoryJobStore()
+
+job_events = JobEventHub()
+job_store = NotifyingJobStore(create_job_store(), job_events)
+job_event_stream_slots = threading.BoundedSemaphore(JOB_EVENTS_MAX_STREAMS)
+# ジョブは上限付きのワーカープールで実行し、実行中と待ちの合計が上限に達したら受け付けない
+job_executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix='csv-job')
+job_slots = threading.BoundedSemaphore(JOB_MAX_WORKERS + JOB_QUEUE_LIMIT)
+
+# ★★★ ジョブの段階ごとの計測と、Prometheus形式のメトリクス ★★★
+# 各段階の処理時間・行数・メモリ・AI呼び出しをジョブの記録に保存し、同じ値をプロセス全体のメトリクスにも積算する。
+# メトリクスはワーカープロセスごとの値なので、gunicornで複数ワーカーを動かす場合はworkerラベルで区別して集計する。
+METRICS_PREFIX = "csv_helper"
+METRICS_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def peak_rss_bytes():
+    """プロセスのメモリ使用量（常駐セットサイズ）のこれまでの最大値"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト単位、macOSはバイト単位で返す
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class MetricsRegistry:
+    """カウンタ・ゲージ・ヒストグラムを保持し、Prometheusのテキスト形式で出力する"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {}  # {名前: {'type': ..., 'help': ..., 'values': {ラベルの組: 値}}}
+
+    def _series(self, metric_type, name, help_text, labels, default):
+        metric = self.metrics.setdefault(name, {'type': metric_type, 'help': help_text, 'values': {}})
+        key = tuple(sorted(labels.items()))
+        if key not in metric['values']:
+            metric['values'][key] = default()
+        return metric['values'], key
+
+    def inc(self, name, help_text, value=1, **labels):
+        with self.lock:
+            values, key = self._series('counter', name, help_text, labels, lambda: 0)
+            values[key] += value
+
+    def set(self, name, help_text, value, **labels):
+        with self.lock:
+            values, key = self._series('gauge', name, help_text, labels, lambda: 0)
+            values[key] = value
+
+    def add(self, name, help_text, value, **labels):
+        """ゲージを増減させる"""
+        with self.lock:
+            values, key = self._series('gauge', name, help_text, labels, lambda: 0)
+            values[key] += value
+
+    def observe(self, name, help_text, value, buckets=METRICS_SECONDS_BUCKETS, **labels):
+        with self.lock:
+            values, key = self._series('histogram', name, help_text, labels,
+                                       lambda: {'buckets': [0] * len(buckets), 'bounds': buckets, 'sum': 0.0, 'count': 0})
+            histogram = values[key]
+            for i, bound in enumerate(histogram['bounds']):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self, **common_labels):
+        def format_labels(labels):
+            labels = {**common_labels, **dict(labels)}
+            if not labels:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+            return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {full_name} {metric['help']}")
+                lines.append(f"# TYPE {full_name} {metric['type']}")
+                for labels, value in sorted(metric['values'].items()):
+                    if metric['type'] != 'histogram':
+                        lines.append(f"{full_name}{format_labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(value['bounds'], value['buckets']):
+                        lines.append(f"{full_name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{full_name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {value['sum']}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+metrics_registry = MetricsRegistry(METRICS_PREFIX)
+
+STAGE_COUNTER_METRICS = {
+    'modelCalls': ('model_calls_total', "AIの呼び出し回数", {}),
+    'promptTokens': ('model_tokens_total', "AIのトークン数", {'kind': 'prompt'}),
+    'outputTokens': ('model_tokens_total', "AIのトークン数", {'kind': 'output'}),
+    'cacheHits': ('ai_cache_hits_total', "AI結果キャッシュのヒット数", {}),
+    'cacheMisses': ('ai_cache_misses_total', "AI結果キャッシュのミス数", {}),
+    'retries': ('model_retries_total', "AI呼び出しの再試行回数", {}),
+    'failedBatches': ('model_failed_batches_total', "再試行後も失敗したAIバッチ数", {}),
+}
+
+class StageMetrics:
+    """ジョブの1段階分の計測値（AI呼び出しの集計はワーカースレッドから加算される）"""
+
+    def __init__(self, name, label, rows_in=0):
+        self.name = name
+        self.label = label
+        self.rows_in = rows_in
+        self.rows_out = rows_in
+        self.seconds = 0.0
+        self.peak_rss = None
+        self.counters = {counter: 0 for counter in STAGE_COUNTER_METRICS}
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for counter, value in counts.items():
+                self.counters[counter] += value
+
+    def record_model_response(self, response):
+        """Geminiの応答からトークン数を加算する（応答に使用量が含まれない場合は呼び出し回数だけ数える）"""
+        usage = getattr(response, 'usage_metadata', None)
+        self.add(modelCalls=1,
+                 promptTokens=getattr(usage, 'prompt_token_count', 0) or 0,
+                 outputTokens=getattr(usage, 'candidates_token_count', 0) or 0)
+
+    def as_dict(self):
+        return {'stage': self.name, 'label': self.label, 'rowsIn': self.rows_in, 'rowsOut': self.rows_out,
+                'seconds': round(self.seconds, 4), 'peakRssBytes': self.peak_rss, **self.counters}
+
+class JobProfiler:
+    """ジョブの段階ごとの計測値を集め、段階が終わるたびにジョブの記録とメトリクスに反映する"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, label, rows_in=0):
+        """with文で使う。ブロックの実行時間を計測し、rows_outなどはブロック内で設定する"""
+        metrics = StageMetrics(name, label, rows_in)
+        self.progress(name, label, rowsIn=rows_in)
+        started = time.perf_counter()
         try:
-            file_stream.seek(0)
-            return pd.read_csv(file_stream, encoding=encoding, dtype=str)
+            yield metrics
+        finally:
+            metrics.seconds = time.perf_counter() - started
+            self.finish(metrics)
+
+    def record(self, name, label, rows_in, rows_out, seconds):
+        """別の仕組みで計測済みの段階（絞り込みパイプラインの述語など）を記録する"""
+        metrics = StageMetrics(name, label, rows_in)
+        metrics.rows_out = rows_out
+        metrics.seconds = seconds
+        self.finish(metrics)
+
+    def progress(self, name, label, **values):
+        """実行中の段階と途中経過（処理済みの件数など）をジョブの記録に反映する（進捗の配信用）"""
+        job_store.update(self.job_id, progress={'stage': name, 'label': label, **values})
+
+    def finish(self, metrics):
+        metrics.peak_rss = peak_rss_bytes()
+        self.stages.append(metrics)
+        record_stage_metrics(metrics)
+        job_store.update(self.job_id, metrics=self.as_list())
+
+    def as_list(self):
+        return [metrics.as_dict() for metrics in self.stages]
+
+def record_stage_metrics(metrics):
+    stage = metrics.name
+    metrics_registry.observe('stage_duration_seconds', "ジョブの段階ごとの処理時間", metrics.seconds, stage=stage)
+    metrics_registry.inc('stage_rows_in_total', "段階に入力された行数", metrics.rows_in, stage=stage)
+    metrics_registry.inc('stage_rows_out_total', "段階を通過した行数", metrics.rows_out, stage=stage)
+    # AIを使わない段階の系列を増やさないよう、AI関連のカウンタは値がある場合だけ加算する
+    for counter, (name, help_text, labels) in STAGE_COUNTER_METRICS.items():
+        if metrics.counters[counter]:
+            metrics_registry.inc(name, help_text, metrics.counters[counter], stage=stage, **labels)
+    if metrics.peak_rss is not None:
+        metrics_registry.set('process_peak_rss_bytes', "プロセスのメモリ使用量の最大値", metrics.peak_rss)
+
+def record_job_finished(status, seconds):
+    metrics_registry.inc('jobs_total', "終了したジョブ数", status=status)
+    metrics_registry.observe('job_duration_seconds', "ジョブ全体の処理時間", seconds, status=status)
+
+# ★★★ 処理結果の保存（スプールファイルまたはS3）と配信 ★★★
+# 結果のCSVはジョブの記録に入れず一度だけ書き出し、ステータスにはメタデータとプレビューだけを返す
+RESULT_STORAGE = os.environ.get("RESULT_STORAGE", "local")  # local / s3
+RESULT_SPOOL_DIR = os.environ.get("RESULT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "csv_helper_results"))
+RESULT_S3_PREFIX = "__results/"
+BATCH_RESULT_S3_PREFIX = "__batch/"  # batch_runner.pyの結果とまとめ（実行IDごと）
+RESULT_PREVIEW_ROWS = 5  # 画面のプレビューに表示する行数
+RESULT_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+RESULT_GZIP_MIN_BYTES = 64 * 1024  # これより小さい結果は圧縮せずに返す
+
+def result_spool_path(job_id):
+    return os.path.join(RESULT_SPOOL_DIR, f"{secure_filename(job_id)}.csv")
+
+def cleanup_result_spool(now):
+    """保持期間を過ぎたスプールファイルを削除する（S3側はバケットのライフサイクル設定で削除する）"""
+    for name in os.listdir(RESULT_SPOOL_DIR):
+        path = os.path.join(RESULT_SPOOL_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > JOB_TTL_SECONDS:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def write_job_result(job_id, df):
+    """処理結果をCSVとして書き出し、保存先の情報を返す"""
+    os.makedirs(RESULT_SPOOL_DIR, exist_ok=True)
+    cleanup_result_spool(time.time())
+    path = result_spool_path(job_id)
+    df.to_csv(path, index=False, encoding='utf-8-sig')
+    size = os.path.getsize(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(RESULT_DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if RESULT_STORAGE == 's3' and s3_client:
+        key = f"{RESULT_S3_PREFIX}{job_id}.csv"
+        s3_client.upload_file(path, S3_BUCKET_NAME, key, ExtraArgs={'ContentType': 'text/csv'}, Config=S3_TRANSFER_CONFIG)
+        os.remove(path)
+        return {'type': 's3', 'key': key, 'size': size, 'sha256': digest.hexdigest()}
+    return {'type': 'local', 'path': path, 'size': size, 'sha256': digest.hexdigest()}
+
+def open_job_result(location):
+    """保存した処理結果をバイナリストリームとして開く"""
+    if location['type'] == 's3':
+        return open_s3_csv_stream(location['key'])
+    return open(location['path'], 'rb')
+
+def iter_stream_chunks(stream, chunk_size=RESULT_DOWNLOAD_CHUNK_SIZE):
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        stream.close()
+
+def iter_gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip形式
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def build_result_preview(df):
+    """ステータス応答に含めるプレビュー用の先頭行（BOMなし）"""
+    return df.head(RESULT_PREVIEW_ROWS).to_csv(index=False) if len(df.columns) else ''
+
+# ★★★ 処理の途中経過のチェックポイント（再実行時に完了済みの段階とAIバッチを省略する） ★★★
+# 入力ファイルとフォームの内容から作るフィンガープリントごとに、入力ファイルのコピー、段階ごとの途中結果（Parquet）、
+# 完了したAIバッチの結果を保存する。ワーカーの再起動やタイムアウトで中断したジョブや、同じ入力で再実行したジョブは、
+# 保存済みの段階を読み込んで続きから処理し、AIには未完了・失敗したバッチだけを送る。
+# 途中結果の保存はpyarrowがある環境のみ（ない場合はAIバッチの結果だけを保存する）。
+CHECKPOINT_STORAGE = os.environ.get("CHECKPOINT_STORAGE", "local")  # local / s3 / off
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "csv_helper_checkpoints"))
+CHECKPOINT_S3_PREFIX = "__checkpoints/"
+CHECKPOINT_TTL_SECONDS = int(os.environ.get("CHECKPOINT_TTL_SECONDS", str(JOB_TTL_SECONDS)))  # チェックポイントを保持する秒数
+CHECKPOINT_VERSION = 1
+JOB_RESUME_STALE_SECONDS = int(os.environ.get("JOB_RESUME_STALE_SECONDS", "900"))  # 処理中のまま更新がないジョブを中断とみなすまでの秒数
+CHECKPOINT_STAGE_LABELS = {'filter': '絞り込み', 'ai_date_format': 'AI日付整形'}
+
+class JobCheckpoint:
+    """フィンガープリントごとのチェックポイント（ローカルのディレクトリ、またはS3のプレフィックスに保存する）
+
+    保存に失敗しても処理は続行できるよう、書き込みのエラーはログに出すだけにする。
+    """
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.use_s3 = CHECKPOINT_STORAGE == 's3' and s3_client is not None
+
+    def _local_path(self, name):
+        return os.path.join(CHECKPOINT_DIR, self.fingerprint, *name.split('/'))
+
+    def _s3_key(self, name):
+        return f"{CHECKPOINT_S3_PREFIX}{self.fingerprint}/{name}"
+
+    def _put_file(self, name, path):
+        if self.use_s3:
+            s3_client.upload_file(path, S3_BUCKET_NAME, self._s3_key(name), Config=S3_TRANSFER_CONFIG)
+            return
+        target = self._local_path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(path, temp_path)  # 同じファイルシステム上ならコピーせずにハードリンクを作る
+        except OSError:
+            shutil.copyfile(path, temp_path)
+        os.replace(temp_path, target)
+
+    def _put_bytes(self, name, data):
+        if self.use_s3:
+            s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=self._s3_key(name), Body=data)
+            return
+        target = self._local_path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, target)
+
+    def _get_bytes(self, name):
+        """保存した内容を返す（存在しない場合はNone）"""
+        if self.use_s3:
+            try:
+                return s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=self._s3_key(name))['Body'].read()
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey':
+                    return None
+                raise
+        try:
+            with open(self._local_path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _open(self, name):
+        if self.use_s3:
+            return open_s3_csv_stream(self._s3_key(name))
+        return open(self._local_path(name), 'rb')
+
+    def _list(self, directory):
+        if self.use_s3:
+            prefix = self._s3_key(f"{directory}/")
+            paginator = s3_client.get_paginator('list_objects_v2')
+            return [s3_object['Key'][len(prefix):] for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix)
+                    for s3_object in page.get('Contents', [])]
+        try:
+            return [name for name in os.listdir(self._local_path(directory)) if not name.endswith('.tmp')]
+        except FileNotFoundError:
+            return []
+
+    def save_inputs(self, latest_file_path, latest_filename, previous_file_path, form_data):
+        """再実行に使う入力ファイルとフォームの内容を保存する（同じフィンガープリントで保存済みなら何もしない）"""
+        if self.load_inputs() is not None:
+            return
+        self._put_file('inputs/latest.csv', latest_file_path)
+        if previous_file_path:
+            self._put_file('inputs/previous.csv', previous_file_path)
+        inputs = {'latestFilename': latest_filename, 'hasPrevious': bool(previous_file_path), 'formData': form_data,
+                  'createdAt': datetime.now().isoformat()}
+        self._put_bytes('inputs.json', json.dumps(inputs, ensure_ascii=False).encode('utf-8'))
+
+    def load_inputs(self):
+        data = self._get_bytes('inputs.json')
+        return json.loads(data) if data is not None else None
+
+    def open_input(self, name):
+        """保存した入力ファイル（'latest' または 'previous'）を開く"""
+        return self._open(f"inputs/{name}.csv")
+
+    def save_stage(self, name, df, **state):
+        """段階の処理結果と、続きから処理するために必要な状態を保存する"""
+        if pq is None:
+            return
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        parquet_fd, parquet_path = tempfile.mkstemp(dir=UPLOAD_SPOOL_DIR, suffix='.parquet')
+        os.close(parquet_fd)
+        try:
+            # 行番号はAIプロンプト処理でAIに送るため、インデックスも保存する
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=True), parquet_path, compression=PARQUET_COMPRESSION)
+            self._put_file(f"stages/{name}.parquet", parquet_path)
+            # 状態は結果の後に書き込み、状態があれば結果も揃っているとみなす
+            self._put_bytes(f"stages/{name}.json", json.dumps({**state, 'rows': len(df)}, ensure_ascii=False).encode('utf-8'))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os.remove(parquet_path)
+
+    def load_latest_stage(self, names):
+        """namesの順に保存済みの段階を探し、最初に見つかった(段階名, DataFrame, 状態)を返す（ない場合はNone）"""
+        if pq is None:
+            return None
+        for name in names:
+            data = self._get_bytes(f"stages/{name}.json")
+            if data is None:
+                continue
+            with self._open(f"stages/{name}.parquet") as stream:
+                df = pq.read_table(stream).to_pandas()
+            return name, df, json.loads(data)
+        return None
+
+    def save_batch(self, stage, mapping):
+        """完了したAIバッチの結果（{入力のキー: 結果}）を保存する"""
+        if not mapping:
+            return
+        try:
+            self._put_bytes(f"batches/{stage}/{uuid.uuid4().hex}.json", json.dumps(mapping, ensure_ascii=False).encode('utf-8'))
         except Exception:
+            traceback.print_exc()
+
+    def load_batches(self, stage):
+        """保存済みのAIバッチの結果をすべて結合して返す"""
+        merged = {}
+        for name in self._list(f"batches/{stage}"):
+            data = self._get_bytes(f"batches/{stage}/{name}")
+            if data is not None:
+                merged.update(json.loads(data))
+        return merged
+
+def cleanup_checkpoints(now):
+    """保持期間を過ぎたローカルのチェックポイントを削除する（S3側はバケットのライフサイクル設定で削除する）"""
+    for name in os.listdir(CHECKPOINT_DIR):
+        path = os.path.join(CHECKPOINT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > CHECKPOINT_TTL_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+def job_uses_checkpoint(form_data):
+    """途中経過を保存する価値のあるジョブか（AIを使う段階がある場合だけ保存する）"""
+    if CHECKPOINT_STORAGE == 'off':
+        return False
+    return form_data.get('ai_date_format_enabled') == 'on' or bool(model and form_data.get('ai_prompt'))
+
+def compute_input_fingerprint(latest_file_path, latest_filename, previous_file_path, form_data):
+    """入力ファイルの内容・フォームの内容・比較対象のS3オブジェクトの版から、ジョブの入力のフィンガープリントを作る"""
+    digest = hashlib.sha256(f"v{CHECKPOINT_VERSION}\n{GEMINI_MODEL_NAME}\n{CSV_COMPACT_DTYPES}\n{latest_filename}\n".encode('utf-8'))
+    digest.update(json.dumps(form_data, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    for path in (latest_file_path, previous_file_path):
+        digest.update(b'\x00')
+        if path:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(RESULT_DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+    # S3上のファイルと比較する場合は、その時点の版（ETag）も含める
+    compared_keys = []
+    if form_data.get('diff_mode') == 'seen_ever':
+        compared_keys.append(S3_SEEN_EVER_KEY)
+    elif form_data.get('previous_file_key') and not previous_file_path:
+        compared_keys.append(form_data['previous_file_key'])
+    for key in compared_keys:
+        s3_object = head_s3_object(key) if s3_client else None
+        digest.update(f"\x00{key}:{s3_object['ETag'] if s3_object else ''}".encode('utf-8'))
+    return digest.hexdigest()
+
+def prepare_job_checkpoint(job_id, latest_file_path, latest_filename, previous_file_path, form_data):
+    """ジョブのチェックポイントを用意して入力を保存する（保存しないジョブや、用意に失敗した場合はNone）"""
+    if not job_uses_checkpoint(form_data):
+        return None
+    try:
+        if CHECKPOINT_STORAGE != 's3':
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            cleanup_checkpoints(time.time())
+        checkpoint = JobCheckpoint(compute_input_fingerprint(latest_file_path, latest_filename, previous_file_path, form_data))
+        checkpoint.save_inputs(latest_file_path, latest_filename, previous_file_path, form_data)
+        if not checkpoint.use_s3:
+            os.utime(os.path.join(CHECKPOINT_DIR, checkpoint.fingerprint))  # 保持期間は最後に使われた時点から数える
+        job_store.update(job_id, checkpoint_id=checkpoint.fingerprint)
+        return checkpoint
+    except Exception:
+        traceback.print_exc()
+        return None
+
+def is_job_retryable(job):
+    """チェックポイントから再実行できるジョブか（エラーで終了した、AIバッチの一部が失敗した、または処理中のまま止まっている）"""
+    if not job.get('checkpoint_id'):
+        return False
+    if job['status'] == 'error':
+        return True
+    if job['status'] == 'completed':
+        return bool((job.get('result') or {}).get('failedBatches'))
+    return time.time() - job.get('updated_at', time.time()) > JOB_RESUME_STALE_SECONDS
+
+# ★★★ ストリーミング読込用の設定 ★★★
+CSV_ENCODINGS = ['utf-8-sig', 'utf-8', 'shift-jis', 'cp932']
+CSV_CHUNK_SIZE = int(os.environ.get("CSV_CHUNK_SIZE", "50000"))  # 1チャンクあたりの行数
+ENCODING_SAMPLE_BYTES = int(os.environ.get("ENCODING_SAMPLE_BYTES", str(1024 * 1024)))  # 文字コード判定に使う先頭バイト数
+ENCODING_ERROR_MESSAGE = "ファイルの文字コードを認識できませんでした。UTF-8またはShift-JISで保存してください。"
+# 省メモリモード: 文字列をArrowの文字列型（pyarrowがない場合は通常の文字列）で持ち、値の種類が少ない列はカテゴリ型にする
+CSV_COMPACT_DTYPES = os.environ.get("CSV_COMPACT_DTYPES", "off") == "on"
+COMPACT_STRING_DTYPE = 'string[pyarrow]' if pa is not None else str
+COMPACT_CATEGORY_MAX_SHARE = float(os.environ.get("COMPACT_CATEGORY_MAX_SHARE", "0.5"))  # 異なり数が行数のこの割合以下の列をカテゴリ型にする
+
+def detect_encoding(sample, candidates=CSV_ENCODINGS):
+    """バイト列のサンプルをデコードできる最初の文字コードを返す（なければNone）"""
+    for encoding in candidates:
+        try:
+            # サンプル末尾で多バイト文字が途切れていてもエラーにしないよう、インクリメンタルデコーダを使う
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
             continue
-    raise ValueError("ファイルの文字コードを認識できませんでした。UTF-8またはShift-JISで保存してください。")
+    return None
+
+def candidate_encodings(file_stream, sample_size=ENCODING_SAMPLE_BYTES):
+    """先頭のサンプルだけで文字コードを判定し、試す順に並べた候補リストを返す"""
+    file_stream.seek(0)
+    sample = file_stream.read(sample_size)
+    file_stream.seek(0)
+    detected = detect_encoding(sample)
+    if detected is None:
+        raise ValueError(ENCODING_ERROR_MESSAGE)
+    # サンプルより後ろでデコードに失敗した場合の予備として、判定結果より後ろの候補も残しておく
+    return CSV_ENCODINGS[CSV_ENCODINGS.index(detected):]
+
+def read_csv_header(file_stream, encoding):
+    """ヘッダー行だけを読み込んで列名のリストを返す"""
+    file_stream.seek(0)
+    try:
+        columns = list(pd.read_csv(file_stream, encoding=encoding, dtype=str, nrows=0).columns)
+    except pd.errors.EmptyDataError:
+        raise ValueError("ファイルが空です。")
+    finally:
+        file_stream.seek(0)
+    return columns
+
+def iter_csv_chunks(file_stream, encoding, chunksize=CSV_CHUNK_SIZE, usecols=None, compact=False):
+    """指定した文字コードでCSVを固定行数のチャンクごとに読み込む（usecolsで読み込む列を絞れる）
+
+    compactを指定すると省メモリな型で読み込む。カテゴリ型にする列は最初のチャンクで決め、以降のチャンクもそろえる。
+    """
+    file_stream.seek(0)
+    category_columns = None
+    with pd.read_csv(file_stream, encoding=encoding, dtype=COMPACT_STRING_DTYPE if compact else str, chunksize=chunksize, usecols=usecols) as reader:
+        for chunk in reader:
+            if compact:
+                if category_columns is None:
+                    max_categories = max(1, int(len(chunk) * COMPACT_CATEGORY_MAX_SHARE))
+                    category_columns = [col for col in chunk.columns if chunk[col].nunique() <= max_categories]
+                if category_columns:
+                    chunk = chunk.astype({col: 'category' for col in category_columns})
+            yield chunk
+
+def concat_chunks(chunks, columns):
+    """チャンクを1つのDataFrameに結合する（カテゴリ型の列は、カテゴリを統合してカテゴリ型のまま結合する）"""
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    category_columns = [col for col in chunks[0].columns if all(isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in chunks)]
+    if not category_columns or len(chunks) == 1:
+        return pd.concat(chunks)
+    # そのまま結合するとチャンクごとにカテゴリが異なる列が文字列に戻ってしまうため、カテゴリを統合する
+    combined = pd.concat([chunk.drop(columns=category_columns) for chunk in chunks])
+    for col in category_columns:
+        merged = union_categoricals([chunk[col] for chunk in chunks])
+        combined[col] = pd.Series(merged, index=combined.index)
+    return combined[list(chunks[0].columns)]
+
+def parse_dates(series):
+    """文字列の列を日付に変換する（カテゴリ型の列は、カテゴリの値だけを1回ずつ変換する）
+
+    書式は値ごとに判定する（format='mixed'）。先頭の値から書式を推定すると、どの行が先に残ったか
+    （絞り込みの実行順やチャンクの区切り）によって同じ値の変換結果が変わるため。
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        parsed_categories = pd.to_datetime(pd.Series(series.cat.categories), errors='coerce', format='mixed').to_numpy(dtype='datetime64[ns]')
+        codes = series.cat.codes.to_numpy()
+        parsed = parsed_categories.take(codes, mode='clip')
+        parsed[codes < 0] = np.datetime64('NaT')
+        return parsed
+    return pd.to_datetime(series, errors='coerce', format='mixed').to_numpy(dtype='datetime64[ns]')
+
+def read_csv_from_stream(file_stream):
+    """CSV全体を1つのDataFrameとして読み込む（文字コードの判定はサンプルで1回だけ行う）"""
+    for encoding in candidate_encodings(file_stream):
+        try:
+            chunks = list(iter_csv_chunks(file_stream, encoding))
+            return pd.concat(chunks) if chunks else pd.DataFrame(columns=read_csv_header(file_stream, encoding))
+        except UnicodeDecodeError:
+            continue
+        except pd.errors.EmptyDataError:
+            raise ValueError("ファイルが空です。")
+    raise ValueError(ENCODING_ERROR_MESSAGE)
+
+# ★★★ 行ハッシュによる差分抽出エンジン ★★★
+ROW_HASH_NULL = '\x00'  # 空欄(NaN)をハッシュ計算用に置き換える値（CSVの値としては現れない文字）
+
+def compute_row_hashes(df, columns):
+    """指定した列の値から行ごとの64bitハッシュ(uint64配列)を計算する（列の並び順には依存しない）"""
+    values = df[sorted(columns)]
+    has_null = values.isna().any()
+    if has_null.any():
+        # 空欄のある列だけを文字列に戻して置き換える（カテゴリ型などの列は型ごとにハッシュしても値は同じになる）
+        values = values.assign(**{col: values[col].astype(object).fillna(ROW_HASH_NULL) for col in has_null.index[has_null]})
+    # 値の種類が多い列ではcategorize=Trueの方が遅くなるため、そのままハッシュ化する
+    return pd.util.hash_pandas_object(values, index=False, categorize=False).to_numpy(dtype=np.uint64)
+
+def sorted_contains(sorted_hashes, hashes):
+    """ソート済みのハッシュ配列に各ハッシュが含まれるかを二分探索で判定する"""
+    if len(sorted_hashes) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    positions = np.searchsorted(sorted_hashes, hashes)
+    positions[positions == len(sorted_hashes)] = 0
+    return sorted_hashes[positions] == hashes
+
+class RowHashIndex:
+    """前回ファイルの行ハッシュ（と任意のキー列のハッシュ）をソート済み配列で保持する差分比較用インデックス"""
+
+    def __init__(self, columns, row_hashes, key_column=None, key_hashes=None):
+        self.columns = sorted(columns)
+        self.row_hashes = np.unique(row_hashes)
+        self.key_column = key_column
+        self.key_hashes = np.unique(key_hashes) if key_column else None
+
+    @classmethod
+    def from_chunks(cls, chunks, columns, key_column=None):
+        row_hash_parts, key_hash_parts = [], []
+        for chunk in chunks:
+            row_hash_parts.append(compute_row_hashes(chunk, columns))
+            if key_column:
+                key_hash_parts.append(compute_row_hashes(chunk, [key_column]))
+        row_hashes = np.concatenate(row_hash_parts) if row_hash_parts else np.array([], dtype=np.uint64)
+        key_hashes = None
+        if key_column:
+            key_hashes = np.concatenate(key_hash_parts) if key_hash_parts else np.array([], dtype=np.uint64)
+        return cls(columns, row_hashes, key_column, key_hashes)
+
+    @classmethod
+    def from_csv_stream(cls, file_stream, encodings, columns, key_column=None):
+        """CSVをチャンク単位で読みながらインデックスを構築する（前回ファイル全体は保持しない）"""
+        for encoding in encodings:
+            try:
+                return cls.from_chunks(iter_csv_chunks(file_stream, encoding), columns, key_column)
+            except UnicodeDecodeError:
+                continue
+        raise ValueError(ENCODING_ERROR_MESSAGE)
+
+    def to_bytes(self, **metadata):
+        """S3に保存するサイドカー形式(npz)にシリアライズする"""
+        metadata = {**metadata, 'columns': self.columns, 'key_column': self.key_column}
+        arrays = {'row_hashes': self.row_hashes, 'metadata': np.array(json.dumps(metadata, ensure_ascii=False))}
+        if self.key_column:
+            arrays['key_hashes'] = self.key_hashes
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """to_bytesで保存したサイドカーを読み込み、(インデックス, メタデータ)を返す"""
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            metadata = json.loads(str(arrays['metadata']))
+            key_hashes = arrays['key_hashes'] if 'key_hashes' in arrays.files else None
+            index = cls(metadata['columns'], arrays['row_hashes'], metadata.get('key_column'), key_hashes)
+        return index, metadata
+
+    def classify(self, df):
+        """各行が新規か、キー列は同じで内容が変わった行かを判定し、(新規マスク, 変更マスク)を返す"""
+        unchanged = sorted_contains(self.row_hashes, compute_row_hashes(df, self.columns))
+        if not self.key_column:
+            return ~unchanged, np.zeros(len(df), dtype=bool)
+        key_exists = sorted_contains(self.key_hashes, compute_row_hashes(df, [self.key_column]))
+        return ~unchanged & ~key_exists, ~unchanged & key_exists
+
+def row_index_key(file_key):
+    """S3上のCSVに対応する行ハッシュインデックス（サイドカー）のキー"""
+    return f"{file_key}{S3_ROW_INDEX_SUFFIX}"
+
+def is_archive_current(metadata, source_etag):
+    """サイドカーやParquetのコピーが、指定した版（ETag）のCSVから作られたものか（版を指定しない場合は確認しない）
+
+    CSVの保存とコピーの作成の間は、新しいCSVに古いコピーが残っている。
+    作成元の版を記録していない（この確認より前に保存された）コピーも、一致するか分からないため使わない。
+    """
+    return source_etag is None or metadata.get('source_etag') == source_etag
+
+def save_row_index_to_s3(file_key, file_stream, key_column=None, parquet_path=None, source_etag=None):
+    """保存したCSVの全列から行ハッシュインデックスを作り、サイドカーとしてS3に保存する
+
+    parquet_pathを指定した場合は、同じ読み込みの中でParquetのコピーもそのパスに書き出す。
+    source_etagには保存したCSVの版（ETag）を指定し、読み込み時に本体と一致するかの確認に使う。
+    """
+    encodings = candidate_encodings(file_stream)
+    columns = read_csv_header(file_stream, encodings[0])
+    if key_column not in columns:
+        key_column = None
+    for encoding in encodings:
+        try:
+            chunks = iter_csv_chunks(file_stream, encoding)
+            if parquet_path:
+                chunks = iter_chunks_to_parquet(chunks, parquet_path, columns, source_key=file_key, source_etag=source_etag, encoding=encoding)
+            index = RowHashIndex.from_chunks(chunks, columns, key_column)
+            break
+        except UnicodeDecodeError:
+            chunks.close()
+            continue
+    else:
+        raise ValueError(ENCODING_ERROR_MESSAGE)
+    body = index.to_bytes(source_columns=columns, encoding=encoding, source_key=file_key, source_etag=source_etag)
+    s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=row_index_key(file_key), Body=body, ContentType='application/octet-stream')
+    return index
+
+def load_row_index_from_s3(file_key, source_etag=None):
+    """サイドカーの行ハッシュインデックスを読み込む（存在しない、またはsource_etagの版のCSVから作られていない場合はNone）"""
+    try:
+        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=row_index_key(file_key))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    index, metadata = RowHashIndex.from_bytes(s3_object['Body'].read())
+    return (index, metadata) if is_archive_current(metadata, source_etag) else None
+
+# ★★★ 列指向の圧縮コピー（Parquet） ★★★
+# 保存時にCSVの文字コード判定と解析を済ませた状態で書き出し、再読込では必要な列だけを取得する。
+# 値はCSVと同じく文字列のまま保存するため、行ハッシュや結果のCSVはCSVから読んだ場合と一致する。
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+PARQUET_METADATA_KEY = b'csv_helper'
+
+def parquet_key(file_key):
+    return f"{file_key}{S3_PARQUET_SUFFIX}"
+
+def iter_chunks_to_parquet(chunks, parquet_path, columns, **metadata):
+    """チャンクをそのまま返しながら、同じ内容をParquetファイルに書き出す"""
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    row_count = 0
+    with pq.ParquetWriter(parquet_path, schema, compression=PARQUET_COMPRESSION) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            row_count += len(chunk)
+            yield chunk
+        writer.add_key_value_metadata({PARQUET_METADATA_KEY: json.dumps({**metadata, 'row_count': row_count}, ensure_ascii=False)})
+
+def save_file_to_s3_archive(file_key, file_stream, key_column=None, source_etag=None):
+    """行ハッシュインデックスと（pyarrowがあれば）Parquetのコピーを1回の読み込みで作成してS3に保存し、インデックスを返す"""
+    if pq is None:
+        return save_row_index_to_s3(file_key, file_stream, key_column, source_etag=source_etag)
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    parquet_fd, parquet_path = tempfile.mkstemp(dir=UPLOAD_SPOOL_DIR, suffix=S3_PARQUET_SUFFIX)
+    os.close(parquet_fd)
+    try:
+        index = save_row_index_to_s3(file_key, file_stream, key_column, parquet_path=parquet_path, source_etag=source_etag)
+        s3_client.upload_file(parquet_path, S3_BUCKET_NAME, parquet_key(file_key), ExtraArgs={'ContentType': 'application/vnd.apache.parquet'}, Config=S3_TRANSFER_CONFIG)
+        return index
+    finally:
+        os.remove(parquet_path)
+
+def open_parquet_copy(file_key, source_etag=None):
+    """S3上のParquetのコピーを開く（pyarrowがない、コピーが存在しない、またはsource_etagの版のCSVから作られていない場合はNone）
+
+    S3ObjectStreamを通して読むため、読み込む列の範囲だけが取得される。
+    """
+    if pq is None or not s3_client:
+        return None
+    stream = open_s3_csv_stream(parquet_key(file_key))
+    try:
+        parquet_file = pq.ParquetFile(stream)
+    except ClientError as e:
+        stream.close()
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    if not is_archive_current(parquet_copy_metadata(parquet_file), source_etag):
+        stream.close()
+        return None
+    return parquet_file
+
+def parquet_copy_metadata(parquet_file):
+    metadata = parquet_file.metadata.metadata or {}
+    return json.loads(metadata.get(PARQUET_METADATA_KEY, b'{}'))
+
+def iter_parquet_chunks(parquet_file, columns=None, chunksize=CSV_CHUNK_SIZE):
+    """Parquetのコピーを、CSVのチャンクと同じ形（文字列の列）のDataFrameとして順に読み込む"""
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield batch.to_pandas()
+
+def read_parquet_head(parquet_file, nrows, columns=None):
+    """先頭のnrows行だけを読み込む"""
+    for chunk in iter_parquet_chunks(parquet_file, columns, chunksize=nrows):
+        return chunk
+    return pd.DataFrame(columns=columns if columns is not None else parquet_file.schema_arrow.names)
+
+def build_previous_diff_index(previous_file_stream, previous_file_key, latest_columns, diff_key_column, diff_notes):
+    """前回ファイルの差分比較用インデックスを用意し、(インデックス, 前回ファイルの列名)を返す
+
+    前回ファイルがS3のキーで指定され、サイドカーのインデックスがそのまま使える場合は、
+    CSV本体を読まずにインデックスだけを読み込む。サイドカー、Parquetのコピー、CSV本体の順に試し、
+    サイドカーとコピーは現在のCSVの版（ETag）から作られたものだけを使う。
+    """
+    if previous_file_stream is None:
+        if not s3_client:
+            raise ValueError("S3が設定されていないため、前回ファイルをキーで指定できません。")
+        # CSVが存在しない場合は、どのコピーも使わずにCSV本体の読み込みでエラーにする
+        previous_object = head_s3_object(previous_file_key)
+        source_etag = previous_object['ETag'] if previous_object else ''
+        loaded = load_row_index_from_s3(previous_file_key, source_etag)
+        if loaded is not None:
+            index, metadata = loaded
+            source_columns = metadata.get('source_columns', index.columns)
+            if set(source_columns) <= set(latest_columns) and diff_key_column in (None, index.key_column):
+                if diff_key_column is None:
+                    index.key_column, index.key_hashes = None, None
+                diff_notes.append(f"前回ファイル「{previous_file_key}」の行ハッシュインデックスを使用しました。({len(index.row_hashes)}件)")
+                return index, source_columns
+        # サイドカーがない（古い）、または列構成が異なる場合は、Parquetのコピーから比較に使う列だけを読み込む
+        parquet_file = open_parquet_copy(previous_file_key, source_etag)
+        if parquet_file is not None:
+            previous_columns = parquet_file.schema_arrow.names
+            common_columns = [col for col in latest_columns if col in previous_columns]
+            if not common_columns:
+                raise ValueError("差分比較のため、2つのファイル間で共通の列が1つも見つかりませんでした。")
+            if diff_key_column and diff_key_column not in common_columns:
+                raise ValueError(f"差分比較のキー列「{diff_key_column}」が2つのファイルの両方に存在しません。")
+            index = RowHashIndex.from_chunks(iter_parquet_chunks(parquet_file, common_columns), common_columns, diff_key_column)
+            diff_notes.append(f"前回ファイル「{previous_file_key}」を列指向のコピーから読み込みました。")
+            return index, previous_columns
+        # どちらもない場合はCSV本体から作り直す
+        previous_file_stream = open_s3_csv_stream(previous_file_key)
+        diff_notes.append(f"前回ファイル「{previous_file_key}」をS3から読み込みました。")
+
+    previous_encodings = candidate_encodings(previous_file_stream)
+    previous_columns = read_csv_header(previous_file_stream, previous_encodings[0])
+    common_columns = [col for col in latest_columns if col in previous_columns]
+    if not common_columns:
+        raise ValueError("差分比較のため、2つのファイル間で共通の列が1つも見つかりませんでした。")
+    if diff_key_column and diff_key_column not in common_columns:
+        raise ValueError(f"差分比較のキー列「{diff_key_column}」が2つのファイルの両方に存在しません。")
+    # 前回ファイルは行ハッシュのソート済み配列だけを保持する
+    index = RowHashIndex.from_csv_stream(previous_file_stream, previous_encodings, common_columns, diff_key_column)
+    return index, previous_columns
+
+# ★★★ 保存済みファイル全体の「過去に出現したか」インデックス（月ごとのBloomフィルタ） ★★★
+# 保存したファイルの行ハッシュとキー列のハッシュを、保存月ごとのBloomフィルタに追加してS3に1つのオブジェクトとして置く。
+# 差分抽出では保持期間内の各フィルタで個別に判定して結果をORするため、過去のCSVを読まずに一定のメモリで比較できる。
+# Bloomフィルタは「含まれない」判定は正確で、「含まれる」判定だけがまれに誤る（新規案件を既出と見なす可能性がある）。
+# 誤判定率はフィルタ1つあたりSEEN_EVER_FALSE_POSITIVE_RATE以下で、全体ではおおよそ「フィルタの数 × 誤判定率」になる。
+# フィルタを合成（ビットのOR）すると登録件数が想定を大きく超えて誤判定率が急増するため、合成はしない。
+S3_SEEN_EVER_KEY = "__seen_ever_index.npz"
+SEEN_EVER_VERSION = 2
+SEEN_EVER_MONTHS = int(os.environ.get("SEEN_EVER_MONTHS", "6"))  # フィルタを保持する月数（これより古い月のフィルタは削除する）
+SEEN_EVER_MONTHLY_CAPACITY = int(os.environ.get("SEEN_EVER_MONTHLY_CAPACITY", "500000"))  # 1か月に保存される行数の想定
+SEEN_EVER_FALSE_POSITIVE_RATE = float(os.environ.get("SEEN_EVER_FALSE_POSITIVE_RATE", "0.001"))  # 想定行数での誤判定率
+SEEN_EVER_UPDATE_RETRIES = 5
+
+class BloomFilter:
+    """64bitハッシュの配列を登録・判定するBloomフィルタ（ダブルハッシュ法でビット位置を作る）"""
+
+    def __init__(self, bit_count, hash_count, words=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.words = words if words is not None else np.zeros(bit_count // 64, dtype=np.uint64)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        bit_count = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2 / 64)) * 64
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        return cls(bit_count, hash_count)
+
+    def _positions(self, hashes):
+        h1 = hashes.astype(np.uint64)
+        # 2つ目のハッシュはsplitmix64の混合関数で作る（奇数にして全ビットを巡回させる）
+        h2 = (h1 ^ (h1 >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        h2 = (h2 ^ (h2 >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        h2 = (h2 ^ (h2 >> np.uint64(31))) | np.uint64(1)
+        bit_count = np.uint64(self.bit_count)
+        for i in range(self.hash_count):
+            yield (h1 + np.uint64(i) * h2) % bit_count
+
+    def add(self, hashes):
+        for positions in self._positions(hashes):
+            np.bitwise_or.at(self.words, positions >> np.uint64(6), np.uint64(1) << (positions & np.uint64(63)))
+
+    def contains(self, hashes):
+        found = np.ones(len(hashes), dtype=bool)
+        for positions in self._positions(hashes):
+            found &= ((self.words[positions >> np.uint64(6)] >> (positions & np.uint64(63))) & np.uint64(1)).astype(bool)
+        return found
+
+
+class SeenEverIndex:
+    """保存月ごとの行ハッシュ・キーハッシュのBloomフィルタの集合
+
+    フィルタは{(保存月, 'rows' または 'key', キー列名, 連番): BloomFilter}で持つ。キー列のフィルタはキー列名ごとに分ける。
+    1つのフィルタに登録する件数はcapacityまでとし、超えた分は同じ月の次の連番のフィルタに登録する。
+    """
+
+    def __init__(self, bit_count, hash_count, capacity, filters=None, counts=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.capacity = capacity
+        self.filters = filters or {}
+        self.counts = counts or {}  # {(保存月, 種類, キー列名, 連番): 登録した件数}
+
+    @classmethod
+    def empty(cls):
+        template = BloomFilter.for_capacity(SEEN_EVER_MONTHLY_CAPACITY, SEEN_EVER_FALSE_POSITIVE_RATE)
+        return cls(template.bit_count, template.hash_count, SEEN_EVER_MONTHLY_CAPACITY)
+
+    def _filter(self, name):
+        if name not in self.filters:
+            self.filters[name] = BloomFilter(self.bit_count, self.hash_count)
+            self.counts[name] = 0
+        return self.filters[name]
+
+    def _add(self, month, kind, column, hashes):
+        part = max((name[3] for name in self.filters if name[:3] == (month, kind, column)), default=0)
+        start = 0
+        while start < len(hashes):
+            name = (month, kind, column, part)
+            bloom = self._filter(name)
+            room = self.capacity - self.counts[name]
+            if room <= 0:
+                # 想定件数に達したフィルタにはこれ以上登録せず、新しいフィルタを始める（誤判定率を想定内に保つ）
+                part += 1
+                continue
+            piece = hashes[start:start + room]
+            bloom.add(piece)
+            self.counts[name] += len(piece)
+            start += len(piece)
+
+    def add_row_index(self, row_index, month):
+        """RowHashIndex（保存したファイルの行・キーのハッシュ）を指定した月のフィルタに登録する"""
+        self._add(month, 'rows', '', row_index.row_hashes)
+        if row_index.key_column:
+            self._add(month, 'key', row_index.key_column, row_index.key_hashes)
+
+    def prune(self, current_month):
+        """保持期間より古い月のフィルタを削除する"""
+        oldest = (pd.Period(current_month, freq='M') - (SEEN_EVER_MONTHS - 1)).strftime('%Y-%m')
+        for name in [name for name in self.filters if name[0] < oldest]:
+            del self.filters[name]
+            del self.counts[name]
+
+    def filters_for(self, kind, column=''):
+        """保持期間内の全月の該当するフィルタのリストを返す"""
+        return [bloom for (month, filter_kind, filter_column, part), bloom in sorted(self.filters.items(), key=lambda item: item[0])
+                if filter_kind == kind and filter_column == column]
+
+    def months(self):
+        return sorted({name[0] for name in self.filters})
+
+    def row_count(self):
+        return sum(count for name, count in self.counts.items() if name[1] == 'rows')
+
+    def to_bytes(self):
+        entries = []
+        arrays = {}
+        for i, (name, bloom) in enumerate(sorted(self.filters.items())):
+            arrays[f"filter_{i}"] = bloom.words
+            entries.append({'array': f"filter_{i}", 'month': name[0], 'kind': name[1], 'column': name[2], 'part': name[3], 'count': self.counts[name]})
+        metadata = {'version': SEEN_EVER_VERSION, 'bitCount': self.bit_count, 'hashCount': self.hash_count, 'capacity': self.capacity, 'filters': entries}
+        buffer = io.BytesIO()
+        # 登録件数が少ない間はビットがまばらなため、圧縮して保存する
+        np.savez_compressed(buffer, metadata=np.array(json.dumps(metadata, ensure_ascii=False)), **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            metadata = json.loads(str(arrays['metadata']))
+            # 版1（連番なし）のインデックスは、各フィルタを連番0として読み込む
+            index = cls(metadata['bitCount'], metadata['hashCount'], metadata.get('capacity', SEEN_EVER_MONTHLY_CAPACITY))
+            for entry in metadata['filters']:
+                name = (entry['month'], entry['kind'], entry['column'], entry.get('part', 0))
+                index.filters[name] = BloomFilter(index.bit_count, index.hash_count, arrays[entry['array']])
+                index.counts[name] = entry['count']
+        return index
+
+class SeenEverDiffIndex:
+    """差分抽出で使う、保持期間内の全月のフィルタ（RowHashIndexと同じclassifyを持つ）
+
+    フィルタごとに判定して結果をORする（いずれかのフィルタに含まれれば出現済み）。
+    """
+
+    def __init__(self, seen_ever_index, columns, key_column=None):
+        self.columns = sorted(columns)
+        self.row_filters = seen_ever_index.filters_for('rows')
+        self.key_filters = seen_ever_index.filters_for('key', key_column) if key_column else []
+        self.key_column = key_column if self.key_filters else None
+
+    @staticmethod
+    def _contains_any(filters, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for bloom in filters:
+            found |= bloom.contains(hashes)
+        return found
+
+    def classify(self, df):
+        unchanged = self._contains_any(self.row_filters, compute_row_hashes(df, self.columns))
+        if not self.key_column:
+            return ~unchanged, np.zeros(len(df), dtype=bool)
+        key_exists = self._contains_any(self.key_filters, compute_row_hashes(df, [self.key_column]))
+        return ~unchanged & ~key_exists, ~unchanged & key_exists
+
+def load_seen_ever_index():
+    """(インデックス, ETag)を返す（まだ作成されていない場合は(None, None)）"""
+    try:
+        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_SEEN_EVER_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None, None
+        raise
+    return SeenEverIndex.from_bytes(s3_object['Body'].read()), s3_object['ETag']
+
+def build_seen_ever_index_from_archive(current_month, skip_file_key=None):
+    """この仕組みより前に保存されたファイルを、行ハッシュインデックス（サイドカー）から登録したインデックスを作る"""
+    index = SeenEverIndex.empty()
+    oldest = (pd.Period(current_month, freq='M') - (SEEN_EVER_MONTHS - 1)).strftime('%Y-%m')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME):
+        for s3_object in page.get('Contents', []):
+            month = s3_object['LastModified'].astimezone(timezone.utc).strftime('%Y-%m')
+            file_key = s3_object['Key'][:-len(S3_ROW_INDEX_SUFFIX)]
+            if not s3_object['Key'].endswith(S3_ROW_INDEX_SUFFIX) or month < oldest or file_key == skip_file_key:
+                continue
+            loaded = load_row_index_from_s3(file_key)
+            if loaded is not None:
+                index.add_row_index(loaded[0], month)
+    return index
+
+def update_seen_ever_index(update_index, skip_file_key=None):
+    """インデックスを読み込み、update_index(インデックス)で更新した結果を条件付きで書き戻す
+
+    Bloomフィルタへの登録は順序に依存しないため、他のワーカーと競合した場合は読み込みからやり直すだけでよい。
+    skip_file_keyは、インデックスを新規作成する際にサイドカーから登録しないファイル（これから登録するファイル）。
+    """
+    current_month = datetime.now(timezone.utc).strftime('%Y-%m')
+    for _ in range(SEEN_EVER_UPDATE_RETRIES):
+        index, etag = load_seen_ever_index()
+        if index is None:
+            index = build_seen_ever_index_from_archive(current_month, skip_file_key)
+        update_index(index)
+        index.prune(current_month)
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=S3_SEEN_EVER_KEY, Body=index.to_bytes(), ContentType='application/octet-stream', **condition)
+            return index
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+    raise RuntimeError("過去出現インデックスの更新が競合し続けたため、登録できませんでした。")
+
+def record_saved_file_in_seen_ever_index(file_key, row_index):
+    """保存したファイルの行ハッシュインデックスを、今月のフィルタに登録する"""
+    month = datetime.now(timezone.utc).strftime('%Y-%m')
+    update_seen_ever_index(lambda index: index.add_row_index(row_index, month), skip_file_key=file_key)
+
+def build_seen_ever_diff_index(latest_columns, diff_key_column, diff_notes):
+    """「過去に一度も出現していない」行を抽出するための差分比較用インデックスを用意する"""
+    if not s3_client:
+        raise ValueError("S3が設定されていないため、過去の保存ファイルとの差分抽出はできません。")
+    index, _ = load_seen_ever_index()
+    if index is None:
+        # 初回はサイドカーから作成して保存する
+        index = update_seen_ever_index(lambda index: None)
+    diff_index = SeenEverDiffIndex(index, latest_columns, diff_key_column)
+    months = index.months()
+    period = f"{months[0]}〜{months[-1]}" if months else "なし"
+    diff_notes.append(f"過去の保存ファイル全体（{period}、{index.row_count()}行）のインデックスと比較しました。")
+    if diff_key_column and diff_index.key_column is None:
+        diff_notes.append(f"警告: キー列「{diff_key_column}」で保存されたファイルがないため、全列で比較しました。")
+    return diff_index
+
+# ★★★ キーワード検索エンジン ★★★
+KEYWORD_LOG_MAX_ITEMS = 20  # 処理ログにキーワード別の該当行数を表示する最大件数
+
+def build_trie_pattern(words):
+    """文字列のリストから、共通の接頭辞をまとめたトライ形式の正規表現を作る（各文字はエスケープする）"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def to_pattern(node):
+        terminal = '' in node
+        branches = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 and len(branches[0]) == 1 else f"(?:{'|'.join(branches)})"
+        return f"(?:{body})?" if terminal else body
+
+    return to_pattern(trie)
+
+class KeywordMatcher:
+    """キーワードのリストを一度だけコンパイルし、列の値に対するAND/OR検索とキーワード別の該当行数を求める
+
+    literalモードでは、キーワードを1つのトライ正規表現にまとめて各位置の最長一致を取り出し、
+    一致した文字列に含まれるキーワードを行ごとのビット集合に立てる（キーワード同士の重なりも数えられる）。
+    regexモードでは、キーワードを正規表現として個別にコンパイルして判定する。
+    normalizeを有効にすると、キーワードと値の両方をNFKC正規化（全角・半角の統一など）してから比較する。
+    """
+
+    def __init__(self, keywords, search_type='AND', match_mode='literal', normalize=False):
+        self.search_type = 'OR' if search_type == 'OR' else 'AND'
+        self.match_mode = 'regex' if match_mode == 'regex' else 'literal'
+        self.normalize = normalize
+        self.keywords = []  # 表示用（入力されたままの）キーワード
+        self.patterns = []  # 比較に使うキーワード
+        for keyword in keywords:
+            pattern = unicodedata.normalize('NFKC', keyword) if normalize else keyword
+            if pattern and pattern not in self.patterns:
+                self.keywords.append(keyword)
+                self.patterns.append(pattern)
+        self.hit_counts = np.zeros(len(self.patterns), dtype=np.int64)
+        if self.match_mode == 'regex':
+            try:
+                self.compiled = [re.compile(pattern) for pattern in self.patterns]
+            except re.error as e:
+                raise ValueError(f"キーワードの正規表現が不正です: {e}")
+        else:
+            trie_pattern = build_trie_pattern(self.patterns)
+            self.any_scanner = re.compile(trie_pattern)
+            # 先読みの中でキャプチャすることで、重なり合う一致も各開始位置ごとに取り出す
+            self.scanner = re.compile(f"(?=({trie_pattern}))")
+            self.words = (len(self.patterns) + 63) // 64
+            self.match_bits = {}  # {一致した文字列: その中に含まれるキーワードのビット集合}
+
+    def _bits_for(self, matched):
+        bits = self.match_bits.get(matched)
+        if bits is None:
+            bits = np.zeros(self.words, dtype=np.uint64)
+            for position, pattern in enumerate(self.patterns):
+                if pattern in matched:
+                    bits[position // 64] |= np.uint64(1) << np.uint64(position % 64)
+            self.match_bits[matched] = bits
+        return bits
+
+    def _literal_row_bits(self, values):
+        row_bits = np.zeros((len(values), self.words), dtype=np.uint64)
+        # どれかのキーワードを含む行だけを対象に、一致した文字列をすべて取り出す
+        candidates = values[values.str.contains(self.any_scanner).to_numpy()]
+        matches = candidates.str.findall(self.scanner).explode().dropna()
+        if matches.empty:
+            return row_bits
+        pairs = pd.DataFrame({'row': matches.index, 'match': matches.to_numpy()}).drop_duplicates()
+        distinct = pairs['match'].unique()
+        table = np.stack([self._bits_for(matched) for matched in distinct])
+        codes = pd.Categorical(pairs['match'], categories=distinct).codes
+        np.bitwise_or.at(row_bits, pairs['row'].to_numpy(), table[codes])
+        return row_bits
+
+    def _evaluate(self, values):
+        """(各行が条件を満たすか, 各行が各キーワードを含むかの真偽値行列)を返す"""
+        values = values.fillna('').astype(str)
+        if self.normalize:
+            values = values.str.normalize('NFKC')
+        values = values.reset_index(drop=True)
+        if self.match_mode == 'regex':
+            hits = np.column_stack([values.str.contains(compiled, na=False).to_numpy() for compiled in self.compiled])
+        else:
+            row_bits = self._literal_row_bits(values)
+            # ビット集合をキーワードの並びに展開する
+            hits = np.unpackbits(row_bits.view(np.uint8), axis=1, bitorder='little')[:, :len(self.patterns)].astype(bool)
+        return (hits.any(axis=1) if self.search_type == 'OR' else hits.all(axis=1)), hits
+
+    def match(self, series):
+        """各行が条件を満たすかの真偽値配列を返し、キーワード別の該当行数を積算する"""
+        if not isinstance(series.dtype, pd.CategoricalDtype):
+            matched, hits = self._evaluate(series)
+            self.hit_counts += hits.sum(axis=0, dtype=np.int64)
+            return matched
+        # カテゴリ型の列は、カテゴリの値ごとに1回だけ判定して各行に展開する（空欄は末尾に加えた空文字列として判定する）
+        categories = pd.Series([*series.cat.categories.astype(str), ''], dtype=object)
+        codes = series.cat.codes.to_numpy()
+        codes = np.where(codes < 0, len(categories) - 1, codes)
+        matched, hits = self._evaluate(categories)
+        occurrences = np.bincount(codes, minlength=len(categories))
+        self.hit_counts += (hits * occurrences[:, None]).sum(axis=0, dtype=np.int64)
+        return matched[codes]
+
+    def filter(self, df, keyword_column):
+        """キーワードの条件を満たす行だけを残す"""
+        return df[self.match(df[keyword_column])]
+
+    def hit_count_summary(self):
+        items = [f"「{keyword}」{int(count)}行" for keyword, count in zip(self.keywords, self.hit_counts)]
+        if len(items) > KEYWORD_LOG_MAX_ITEMS:
+            items = items[:KEYWORD_LOG_MAX_ITEMS] + [f"...他{len(items) - KEYWORD_LOG_MAX_ITEMS}件"]
+        return ', '.join(items)
+
+# ★★★ 絞り込みパイプライン（述語の並べ替えと段階ごとの計測） ★★★
+# フォームの指定から、チャンクの各行に真偽値を返す述語（差分・日付・キーワード）の一覧を作る。
+# 述語は互いに独立したANDの条件なので、実行順を変えても結果は変わらない。
+# チャンクごとに実測した「1行あたりの時間」と「残る割合」から、安くてよく絞れる述語を先に実行し、
+# 後の述語はそれまでに残った行だけを評価する。行の切り出しはチャンクの最後に1回だけ行う。
+PIPELINE_MIN_REJECT_RATE = 0.01  # ほとんど絞り込まない述語の優先度が無限大にならないための下限
+
+class PipelineStageError(Exception):
+    """パイプラインの述語の評価中に発生したエラー（どの述語で失敗したかを保持する）"""
+
+    def __init__(self, stage, error):
+        super().__init__(str(error))
+        self.stage = stage
+        self.error = error
+
+class ChunkContext:
+    """1チャンク分の評価状態（日付の解析結果は列ごとに1回だけ計算して使い回す）"""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.parsed_dates = {}  # {列名: チャンク全体を解析した日付}
+
+    def rows(self, positions):
+        """残っている行だけのDataFrame（全行が残っている場合はコピーしない）"""
+        return self.chunk if len(positions) == len(self.chunk) else self.chunk.iloc[positions]
+
+    def dates(self, column, positions):
+        """指定列の日付のうち、残っている行の分を返す（解析は残っている行によらずチャンク全体で1回だけ行う）"""
+        if column not in self.parsed_dates:
+            self.parsed_dates[column] = parse_dates(self.chunk[column])
+        return self.parsed_dates[column][positions]
+
+class PipelinePredicate:
+    """パイプラインの述語1つ分（実行時間と残った行数を積算する）
+
+    各述語はevaluate(context, positions)で、positionsの行を残すかの真偽値配列を返す。
+    """
+
+    def __init__(self, name, label, prior_cost):
+        self.name = name
+        self.label = label
+        self.prior_cost = prior_cost  # 実測前に使う、1行あたりの相対的なコスト
+        self.rows_in = 0
+        self.rows_out = 0
+        self.seconds = 0.0
+
+    def reset(self):
+        self.rows_in = self.rows_out = 0
+        self.seconds = 0.0
+
+    def rank(self):
+        """小さいほど先に実行する（1行あたりのコスト ÷ 除外する割合）"""
+        if self.rows_in == 0:
+            return self.prior_cost / 0.5
+        cost = self.seconds / self.rows_in
+        reject_rate = max(1 - self.rows_out / self.rows_in, PIPELINE_MIN_REJECT_RATE)
+        return cost / reject_rate
+
+class DiffPredicate(PipelinePredicate):
+    def __init__(self, diff_index, include_changed_rows):
+        super().__init__('diff', '差分抽出', prior_cost=1e-6)
+        self.diff_index = diff_index
+        self.include_changed_rows = include_changed_rows
+        self.counts = {'new': 0, 'changed': 0}
+
+    def reset(self):
+        super().reset()
+        self.counts = {'new': 0, 'changed': 0}
+
+    def evaluate(self, context, positions):
+        new_mask, changed_mask = self.diff_index.classify(context.rows(positions))
+        self.counts['new'] += int(new_mask.sum())
+        self.counts['changed'] += int(changed_mask.sum())
+        return new_mask | changed_mask if self.include_changed_rows else new_mask
+
+class DateFilterPredicate(PipelinePredicate):
+    """日付列が指定日以降の行を残す（日付に変換できない行はFalseになり、同時に除外される）"""
+
+    def __init__(self, column, date_value, filter_num):
+        super().__init__(filter_num, f"日付フィルタ{filter_num}", prior_cost=1e-5)
+        self.column = column
+        self.threshold = pd.to_datetime(date_value).to_datetime64()
+
+    def evaluate(self, context, positions):
+        return context.dates(self.column, positions) >= self.threshold
+
+class KeywordPredicate(PipelinePredicate):
+    def __init__(self, keyword_matcher, keyword_column):
+        super().__init__('keyword', 'キーワード検索', prior_cost=2e-6 * max(len(keyword_matcher.patterns), 1))
+        self.keyword_matcher = keyword_matcher
+        self.keyword_column = keyword_column
+
+    def reset(self):
+        super().reset()
+        self.keyword_matcher.hit_counts[:] = 0
+
+    def evaluate(self, context, positions):
+        return np.asarray(self.keyword_matcher.match(context.rows(positions)[self.keyword_column]))
+
+class FilterPipeline:
+    def __init__(self, predicates, date_columns):
+        self.predicates = predicates
+        self.date_columns = date_columns  # 絞り込み後に日付型へ変換する列（従来の日付フィルタと同じ出力）
+        self.order_history = []
+
+    def reset(self):
+        for predicate in self.predicates:
+            predicate.reset()
+        self.order_history = []
+
+    def ordered(self):
+        return sorted(self.predicates, key=lambda predicate: predicate.rank())
+
+    def run_chunk(self, chunk):
+        """チャンクに全述語を適用し、残った行を返す"""
+        context = ChunkContext(chunk)
+        positions = np.arange(len(chunk))
+        order = self.ordered()
+        self.order_history.append([predicate.name for predicate in order])
+        for predicate in order:
+            if len(positions) == 0:
+                break
+            started = time.perf_counter()
+            try:
+                mask = predicate.evaluate(context, positions)
+            except Exception as e:
+                raise PipelineStageError(predicate, e)
+            predicate.seconds += time.perf_counter() - started
+            predicate.rows_in += len(positions)
+            positions = positions[mask]
+            predicate.rows_out += len(positions)
+        if len(positions) == len(chunk) and not self.date_columns:
+            return chunk
+        result = chunk.iloc[positions]
+        if self.date_columns:
+            result = result.assign(**{column: context.dates(column, positions) for column in self.date_columns})
+        return result
+
+    def stage(self, name):
+        return next((predicate for predicate in self.predicates if predicate.name == name), None)
+
+    def final_order(self):
+        """最後のチャンクで使った実行順（チャンクがなかった場合は実測前の順）"""
+        names = self.order_history[-1] if self.order_history else [predicate.name for predicate in self.ordered()]
+        return [self.stage(name) for name in names]
+
+def build_filter_pipeline(form_data, latest_columns, diff_index, keyword_matcher):
+    """フォームの指定から絞り込みパイプラインを作る"""
+    predicates = []
+    if diff_index is not None:
+        predicates.append(DiffPredicate(diff_index, form_data.get('diff_include_changed') == 'on'))
+    date_filters = [
+        (form_data.get('filter_date_column_1'), form_data.get('filter_date_value_1'), "①"),
+        (form_data.get('filter_date_column_2'), form_data.get('filter_date_value_2'), "②"),
+    ]
+    date_columns = []
+    for column, date_value, filter_num in date_filters:
+        if column and date_value and column in latest_columns:
+            predicates.append(DateFilterPredicate(column, date_value, filter_num))
+            if column not in date_columns:
+                date_columns.append(column)
+    if keyword_matcher is not None:
+        predicates.append(KeywordPredicate(keyword_matcher, form_data.get('keyword_column')))
+    return FilterPipeline(predicates, date_columns)
 
 @app.route('/')
 def index():
@@ -76,89 +1741,256 @@ def index():
     except FileNotFoundError:
         return "index.htmlが見つかりません。先にファイルを作成してください。", 404
 
-# ★★★ バックグラウンドで実行する処理関数 ★★★
-def process_csv_background(job_id, latest_file_data, latest_filename, previous_file_data, form_data):
-    """バックグラウンドでCSV処理を実行する関数"""
-    try:
-        with jobs_lock:
-            jobs[job_id] = {'status': 'processing', 'result': None, 'error': None, 'started_at': datetime.now().isoformat()}
-        
-        # ファイルデータをストリームに変換
-        latest_file_stream = io.BytesIO(latest_file_data)
-        df_latest = read_csv_from_stream(latest_file_stream)
-        original_row_count = len(df_latest)
-        processing_log = [f"最新ファイル「{secure_filename(latest_filename)}」を読み込みました。({original_row_count}行)"]
-
-        previous_file_stream = None
-        if previous_file_data:
+# ★★★ 和暦・西暦の日付をルールで整形する高速パス（AIに送る前に実行する） ★★★
+JAPANESE_ERA_OFFSETS = {'令和': 2018, 'R': 2018, '平成': 1988, 'H': 1988, '昭和': 1925, 'S': 1925}
+JAPANESE_ERA_LAST_YEARS = {'平成': 31, 'H': 31, '昭和': 64, 'S': 64}  # 終わった元号の最終年（これを超える年はAIに任せる）
+DATE_LIST_SEPARATOR_PATTERN = r'\s*(?:〜|~|、|,)\s*'  # 範囲表現（A〜B）や複数日付の区切り
+DATE_PART_PATTERN = (
+    r'^(?:(?P<era>令和|平成|昭和|R|H|S)\.?\s*(?P<era_year>元|\d{1,2})|(?P<year>\d{4}))'
+    r'\s*[年./・-]\s*(?P<month>\d{1,2})\s*[月./・-]\s*(?P<day>\d{1,2})\s*日?'
+    r'\s*(?:\(?[月火水木金土日](?:曜日?)?\)?)?$'  # 曜日の表記は読み捨てる
+)
+
+def normalize_japanese_dates(series):
+    """日付文字列のSeriesを一括で「YYYY-MM-DD」に変換する（ルールで解釈できない値はNaN）
+
+    全角数字・和暦（令和/平成/昭和、R/H/S）・区切り文字（. ・ / -）・曜日の付記に対応する。
+    元号の範囲を超える和暦の年（平成32年以降、昭和65年以降、0年）は解釈できない値として扱う。
+    範囲表現や複数日付は、すべての日付を解釈できた場合だけ未来の方の日付を残す。
+    """
+    normalized = series.astype(str).str.normalize('NFKC').str.strip().str.upper()
+    parts = normalized.str.split(DATE_LIST_SEPARATOR_PATTERN, regex=True).explode()
+    matched = parts.str.extract(DATE_PART_PATTERN)
+    era_year = pd.to_numeric(matched['era_year'].replace('元', '1'), errors='coerce')
+    era_last_year = matched['era'].map(JAPANESE_ERA_LAST_YEARS).fillna(float('inf'))
+    era_year = era_year.where((era_year >= 1) & (era_year <= era_last_year))  # H35やS70のような存在しない年はルールで解釈しない
+    year = pd.to_numeric(matched['year'], errors='coerce').fillna(matched['era'].map(JAPANESE_ERA_OFFSETS) + era_year)
+    date_strings = (
+        year.astype('Int64').astype(str) + '-'
+        + matched['month'].fillna('').str.zfill(2) + '-'
+        + matched['day'].fillna('').str.zfill(2)
+    )
+    dates = pd.to_datetime(date_strings, format='%Y-%m-%d', errors='coerce')
+    all_parsed = dates.notna().groupby(level=0).all()
+    latest = dates.groupby(level=0).max()
+    return latest.dt.strftime('%Y-%m-%d').where(all_parsed).reindex(series.index)
+
+# ★★★ AI結果の永続キャッシュ（SQLite + メモリ上のLRU） ★★★
+AI_CACHE_DB_PATH = os.environ.get("AI_CACHE_DB_PATH", os.path.join(tempfile.gettempdir(), "csv_helper_ai_cache.sqlite3"))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_MAX_ENTRIES", "200000"))  # SQLiteに保持する最大件数
+AI_CACHE_MEMORY_ENTRIES = int(os.environ.get("AI_CACHE_MEMORY_ENTRIES", "20000"))  # メモリ上に保持する最大件数
+
+class PersistentLRUCache:
+    """SQLiteに永続化し、手前にメモリ上のLRUキャッシュを置くキー・バリューストア
+
+    キーは(名前空間, キー)の組で管理する。件数が上限を超えたら、最後に使われた日時が古いものから削除する。
+    """
+
+    def __init__(self, db_path, table, max_entries=AI_CACHE_MAX_ENTRIES, memory_entries=AI_CACHE_MEMORY_ENTRIES):
+        self.db_path = db_path
+        self.table = table
+        self.max_entries = max_entries
+        self.memory = LRUCache(maxsize=memory_entries)
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def _connect(self):
+        # gunicornのワーカー間で共有できるよう、接続は初回利用時に開く
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)")
+            self.connection.commit()
+        return self.connection
+
+    def get_many(self, namespace, keys):
+        """キャッシュにあるキーだけを{キー: 値}の辞書で返す"""
+        found = {}
+        with self.lock:
+            connection = self._connect()
+            missing = []
+            for key in keys:
+                value = self.memory.get((namespace, key))
+                if value is None:
+                    missing.append(key)
+                else:
+                    found[key] = value
+            if missing:
+                now = time.time()
+                for i in range(0, len(missing), 500):
+                    part = missing[i:i+500]
+                    placeholders = ','.join('?' * len(part))
+                    rows = connection.execute(
+                        f"SELECT key, value FROM {self.table} WHERE namespace = ? AND key IN ({placeholders})",
+                        [namespace, *part]
+                    ).fetchall()
+                    for key, value in rows:
+                        found[key] = value
+                        self.memory[(namespace, key)] = value
+                    connection.executemany(
+                        f"UPDATE {self.table} SET last_used = ? WHERE namespace = ? AND key = ?",
+                        [(now, namespace, key) for key, _ in rows]
+                    )
+                connection.commit()
+        return found
+
+    def set_many(self, namespace, mapping):
+        if not mapping:
+            return
+        with self.lock:
+            connection = self._connect()
+            now = time.time()
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (namespace, key, value, last_used) VALUES (?, ?, ?, ?)",
+                [(namespace, key, value, now) for key, value in mapping.items()]
+            )
+            for key, value in mapping.items():
+                self.memory[(namespace, key)] = value
+            # 上限を超えた分は、最後に使われた日時が古いものから削除する
+            count = connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                connection.execute(
+                    f"DELETE FROM {self.table} WHERE rowid IN (SELECT rowid FROM {self.table} ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            connection.commit()
+
+date_format_cache = PersistentLRUCache(AI_CACHE_DB_PATH, 'date_format_cache')
+DATE_FORMAT_CACHE_NAMESPACE = f"{GEMINI_MODEL_NAME}:date_format_v1"  # モデルやプロンプトを変えたら別のキャッシュになる
+row_filter_cache = PersistentLRUCache(AI_CACHE_DB_PATH, 'row_filter_cache')
+
+def row_filter_cache_namespace(ai_processing_prompt):
+    """AIプロンプト処理の判定結果キャッシュの名前空間（正規化した指示文とモデル名から作る）
+
+    指示文の内容そのものがキーになるため、テンプレートを編集すると別の名前空間になり、明示的な無効化は不要。
+    編集前・削除後の指示文の名前空間は使われなくなり、件数の上限による削除（最後に使われた日時が古い順）で消える。
+    """
+    normalized_prompt = ' '.join(unicodedata.normalize('NFKC', ai_processing_prompt).split())
+    return hashlib.sha256(f"{GEMINI_MODEL_NAME}\n{normalized_prompt}".encode('utf-8')).hexdigest()
+
+# ★★★ Gemini呼び出しの並列ディスパッチャ（日付整形とAIプロンプト処理で共用） ★★★
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", "4"))  # 同時に実行するAI呼び出しの上限
+AI_REQUESTS_PER_MINUTE = float(os.environ.get("AI_REQUESTS_PER_MINUTE", "60"))  # 1分あたりのAI呼び出しの上限
+AI_MAX_RETRIES = int(os.environ.get("AI_MAX_RETRIES", "2"))  # 失敗したバッチを再試行する回数
+AI_RETRY_BACKOFF_SECONDS = float(os.environ.get("AI_RETRY_BACKOFF_SECONDS", "2"))  # 再試行までの待ち時間の基準値
+AI_TARGET_BATCH_SECONDS = float(os.environ.get("AI_TARGET_BATCH_SECONDS", "30"))  # 1バッチあたりの応答時間の目標値
+
+class TokenBucket:
+    """一定のレートでトークンが補充されるトークンバケット（AI呼び出しのレート制限用）"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得できるまで待つ"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+class AIBatchDispatcher:
+    """AI呼び出しを上限付きのスレッドプールで並列に実行するディスパッチャ
+
+    レート制限（トークンバケット）、失敗時のバックオフ付き再試行、応答時間と失敗に応じたバッチサイズの自動調整を行う。
+    """
+
+    def __init__(self, max_workers=AI_MAX_CONCURRENCY, requests_per_minute=AI_REQUESTS_PER_MINUTE,
+                 max_retries=AI_MAX_RETRIES, backoff_seconds=AI_RETRY_BACKOFF_SECONDS):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ai-dispatcher')
+        self.rate_limiter = TokenBucket(requests_per_minute / 60, capacity=max(1, max_workers))
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+
+    def call(self, request_fn):
+        """レート制限と再試行付きでrequest_fnを実行し、(戻り値, 再試行回数)を返す"""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
             try:
-                rows_before_diff = len(df_latest)
-                previous_file_stream = io.BytesIO(previous_file_data)
-                df_previous = read_csv_from_stream(previous_file_stream)
-                common_columns = list(set(df_latest.columns) & set(df_previous.columns))
-                if not common_columns:
-                    raise ValueError("差分比較のため、2つのファイル間で共通の列が1つも見つかりませんでした。")
-                merged_df = pd.merge(df_latest, df_previous, on=common_columns, how='left', indicator=True)
-                diff_df = merged_df[merged_df['_merge'] == 'left_only']
-                df_latest = diff_df.drop(columns=['_merge'])
-                processing_log.append(f"差分抽出: 新規案件に絞り込みました。({rows_before_diff}行 -> {len(df_latest)}行)")
-            except Exception as e:
-                error_message = f"差分抽出中にエラーが発生したため、以降の処理を中断しました。エラー: {e}"
-                processing_log.append(f"【重要】{error_message}")
-                with jobs_lock:
-                    jobs[job_id] = {
-                        'status': 'completed',
-                        'result': {'message': '処理が中断されました。', 'log': processing_log, 'rowCount': 0, 'csvData': ''},
-                        'error': None,
-                        'completed_at': datetime.now().isoformat()
-                    }
-                return
+                return request_fn(), attempt
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_seconds * (2 ** attempt) + random.uniform(0, self.backoff_seconds))
+
+    def _run_batch(self, handler, batch, prior_retries=0):
+        started_at = time.monotonic()
+        outcome = {'items': batch, 'result': None, 'error': None, 'retries': prior_retries}
+        try:
+            outcome['result'], retries = self.call(lambda: handler(batch))
+        except Exception as e:
+            outcome['error'] = e
+            retries = self.max_retries
+        outcome['retries'] += retries
+        outcome['seconds'] = time.monotonic() - started_at
+        return outcome
+
+    def map_batches(self, items, handler, batch_size, min_batch_size=1, max_batch_size=None,
+                    target_seconds=AI_TARGET_BATCH_SECONDS, on_batch_done=None):
+        """itemsをバッチに分けてhandler(バッチ)を並列に実行し、入力順に並んだ結果のリストを返す
+
+        結果は{'start', 'items', 'result', 'error', 'retries', 'seconds'}の辞書。
+        応答が速ければバッチを大きくし、遅いか失敗した場合は小さくする。失敗したバッチは一度だけ半分に分割して再実行する。
+        分割前の失敗した呼び出しは、分割後の前半のバッチの再試行回数に含める。
+        on_batch_done(結果)はバッチが完了するたびに呼び出し元のスレッドで呼ばれる。
+        """
+        max_batch_size = max_batch_size or batch_size
+        requeued = deque()  # (開始位置, バッチ, 分割可能か, 分割前の再試行回数)
+        cursor = 0
+        in_flight = {}
+        results = []
+        while requeued or cursor < len(items) or in_flight:
+            while len(in_flight) < self.max_workers and (requeued or cursor < len(items)):
+                if requeued:
+                    start, batch, splittable, prior_retries = requeued.popleft()
+                else:
+                    start, batch, splittable, prior_retries = cursor, items[cursor:cursor + batch_size], True, 0
+                    cursor += len(batch)
+                in_flight[self.executor.submit(self._run_batch, handler, batch, prior_retries)] = (start, splittable)
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, splittable = in_flight.pop(future)
+                outcome = {'start': start, **future.result()}
+                batch = outcome['items']
+                if outcome['error'] is not None:
+                    batch_size = max(min_batch_size, batch_size // 2)
+                    if splittable and len(batch) > min_batch_size:
+                        # 大きすぎるバッチは応答のJSONが崩れやすいため、半分に分けてもう一度だけ試す
+                        half = (len(batch) + 1) // 2
+                        requeued.appendleft((start + half, batch[half:], False, 0))
+                        requeued.appendleft((start, batch[:half], False, outcome['retries'] + 1))
+                        continue
+                elif outcome['seconds'] > target_seconds:
+                    batch_size = max(min_batch_size, batch_size // 2)
+                elif outcome['seconds'] < target_seconds / 2:
+                    batch_size = min(max_batch_size, batch_size + max(1, batch_size // 4))
+                results.append(outcome)
+                if on_batch_done:
+                    on_batch_done(outcome)
+        results.sort(key=lambda outcome: outcome['start'])
+        return results
+
+ai_dispatcher = AIBatchDispatcher()
 
-        if not df_latest.empty:
-            def apply_date_filter(df, col_name, date_val, log_list, filter_num):
-                if col_name and date_val:
-                    if col_name in df.columns:
-                        rows_before = len(df)
-                        df[col_name] = pd.to_datetime(df[col_name], errors='coerce')
-                        df.dropna(subset=[col_name], inplace=True)
-                        df = df[df[col_name] >= pd.to_datetime(date_val)]
-                        log_list.append(f"日付フィルタ{filter_num}: 「{col_name}」で {rows_before}行 -> {len(df)}行")
-                return df
-
-            df_latest = apply_date_filter(df_latest, form_data.get('filter_date_column_1'), form_data.get('filter_date_value_1'), processing_log, "①")
-            df_latest = apply_date_filter(df_latest, form_data.get('filter_date_column_2'), form_data.get('filter_date_value_2'), processing_log, "②")
-
-            keyword_column = form_data.get('keyword_column')
-            keywords_str = form_data.get('keywords')
-            search_type = form_data.get('search_type')
-            if keyword_column and keywords_str and keyword_column in df_latest.columns:
-                keywords = [kw.strip() for kw in keywords_str.splitlines() if kw.strip()]
-                if keywords:
-                    rows_before = len(df_latest)
-                    condition = df_latest[keyword_column].str.contains('|'.join(keywords), na=False) if search_type == 'OR' else pd.concat([df_latest[keyword_column].str.contains(kw, na=False) for kw in keywords], axis=1).all(axis=1)
-                    df_latest = df_latest[condition]
-                    processing_log.append(f"キーワード検索: {rows_before}行 -> {len(df_latest)}行")
-
-            ai_date_format_enabled = form_data.get('ai_date_format_enabled') == 'on'
-            ai_date_format_column = form_data.get('ai_date_format_column')
-            if ai_date_format_enabled and ai_date_format_column and model and ai_date_format_column in df_latest.columns:
-                processing_log.append(f"AIによる日付自動整形を開始 (対象列: {ai_date_format_column})")
-                
-                final_dates = df_latest[ai_date_format_column].fillna('').astype(str)
-                non_empty_dates = final_dates[final_dates != '']
-                
-                if not non_empty_dates.empty:
-                    batch_size = 100
-                    has_error = False
-                    formatted_dates_series = non_empty_dates.copy()
-
-                    for i in range(0, len(non_empty_dates), batch_size):
-                        batch_series = non_empty_dates.iloc[i:i+batch_size]
-                        
-                        try:
-                            unique_batch_list = batch_series.unique().tolist()
-
-                            date_formatting_prompt = f"""
+# ★★★ AIによる日付整形のプロンプトと応答の解析 ★★★
+def build_date_formatting_prompt(unique_batch_list):
+    """日付文字列のリストを「YYYY-MM-DD」形式に変換させるプロンプトを作成する"""
+    return f"""
 # あなたのタスク
 あなたは、日本の様々な日付表現を、厳格なルールに従って「YYYY-MM-DD」形式の文字列に変換する、超高性能な日付整形専門AIです。
 これからJSON形式の文字列配列を受け取ります。各文字列をキーとして、変換結果を値とする**JSONオブジェクト（辞書）**を返してください。
@@ -178,183 +2010,556 @@ def process_csv_background(job_id, latest_file_data, latest_filename, previous_f
 # 変換対象のJSON配列
 {json.dumps(unique_batch_list)}
 """
-                            response = model.generate_content(date_formatting_prompt, request_options={'timeout': 180})
-                            cleaned_response_text = response.text.strip()
-                            
-                            start_index = cleaned_response_text.find('{')
-                            end_index = cleaned_response_text.rfind('}')
-                            
-                            if start_index != -1 and end_index != -1:
-                                json_string = cleaned_response_text[start_index:end_index+1]
-                                
-                                # JSONパース前に検証
-                                try:
-                                    formatted_map = json.loads(json_string)
-                                except json.JSONDecodeError as json_err:
-                                    # JSON解析エラーの詳細情報をログに出力
-                                    error_pos = getattr(json_err, 'pos', None)
-                                    error_msg = f"JSON解析エラー: {str(json_err)}"
-                                    if error_pos:
-                                        error_msg += f" (位置: {error_pos}文字目)"
-                                        error_msg += f"\nエラー位置付近の文字列: {json_string[max(0, error_pos-100):error_pos+100]}"
-                                    error_msg += f"\nAIの生応答（最初の500文字）: {cleaned_response_text[:500]}"
-                                    error_msg += f"\n抽出したJSON文字列（最初の500文字）: {json_string[:500]}"
-                                    error_msg += f"\n抽出したJSON文字列（最後の500文字）: {json_string[-500:]}"
-                                    raise ValueError(error_msg)
-
-                                if isinstance(formatted_map, dict):
-                                    batch_series_updated = batch_series.map(formatted_map).fillna(batch_series)
-                                    formatted_dates_series.update(batch_series_updated)
-                                else:
-                                    raise ValueError("AIの応答がJSONオブジェクト（辞書）ではありません。")
-                            else:
-                                raise ValueError(f"AIの応答にJSONオブジェクト（辞書）が含まれていません。開始位置: {start_index}, 終了位置: {end_index}\nAIの生応答（最初の500文字）: {cleaned_response_text[:500]}")
-
-                        except Exception as e:
-                            has_error = True
-                            error_detail = str(e)
-                            # エラーメッセージが長い場合は切り詰める
-                            if len(error_detail) > 1000:
-                                error_detail = error_detail[:1000] + "... (以下省略)"
-                            processing_log.append(f"警告: 日付整形のバッチ処理でエラー発生。このバッチはスキップされます。エラー: {error_detail}")
-                    
-                    final_dates.update(formatted_dates_series)
-                    df_latest[ai_date_format_column] = final_dates
-
-                    if has_error:
-                        processing_log.append("AIによる日付自動整形が完了しました（一部エラーあり）。")
-                    else:
-                        processing_log.append("AIによる日付自動整形が正常に完了しました。")
+
+def parse_date_formatting_response(response_text, unique_batch_list):
+    """AIの応答からJSONオブジェクトを取り出し、入力した値ごとの変換結果の辞書を返す"""
+    cleaned_response_text = response_text.strip()
+    
+    start_index = cleaned_response_text.find('{')
+    end_index = cleaned_response_text.rfind('}')
+    
+    if start_index == -1 or end_index == -1:
+        raise ValueError(f"AIの応答にJSONオブジェクト（辞書）が含まれていません。開始位置: {start_index}, 終了位置: {end_index}\nAIの生応答（最初の500文字）: {cleaned_response_text[:500]}")
+
+    json_string = cleaned_response_text[start_index:end_index+1]
+    
+    # JSONパース前に検証
+    try:
+        formatted_map = json.loads(json_string)
+    except json.JSONDecodeError as json_err:
+        # JSON解析エラーの詳細情報をログに出力
+        error_pos = getattr(json_err, 'pos', None)
+        error_msg = f"JSON解析エラー: {str(json_err)}"
+        if error_pos:
+            error_msg += f" (位置: {error_pos}文字目)"
+            error_msg += f"\nエラー位置付近の文字列: {json_string[max(0, error_pos-100):error_pos+100]}"
+        error_msg += f"\nAIの生応答（最初の500文字）: {cleaned_response_text[:500]}"
+        error_msg += f"\n抽出したJSON文字列（最初の500文字）: {json_string[:500]}"
+        error_msg += f"\n抽出したJSON文字列（最後の500文字）: {json_string[-500:]}"
+        raise ValueError(error_msg)
+
+    if not isinstance(formatted_map, dict):
+        raise ValueError("AIの応答がJSONオブジェクト（辞書）ではありません。")
+    # 入力にない値や文字列以外の結果は使わない（該当する値は元のまま残る）
+    requested = set(unique_batch_list)
+    return {key: value for key, value in formatted_map.items() if key in requested and isinstance(value, str)}
+
+# ★★★ ユーザー指示のAIプロンプト処理（行チャンクごとのmap-reduce） ★★★
+AI_FILTER_TOKEN_BUDGET = int(os.environ.get("AI_FILTER_TOKEN_BUDGET", "60000"))  # 1チャンクのCSV部分に使うトークン数の目安
+AI_FILTER_MAX_ROWS_PER_CHUNK = int(os.environ.get("AI_FILTER_MAX_ROWS_PER_CHUNK", "500"))  # 1チャンクあたりの最大行数
+AI_FILTER_GENERATION_CONFIG = genai.types.GenerationConfig(temperature=0)
+AI_FILTER_SAFETY_SETTINGS = {'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE','HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE','HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE','HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',}
+
+def build_row_filter_prompt(ai_processing_prompt, csv_for_prompt):
+    """ユーザーの指示に合致する行番号だけを返させるプロンプトを作成する"""
+    return f"""
+# あなたのタスク
+あなたは、CSVデータの中から、ユーザーが定義したルールに合致する行を見つけ出し、その**行番号（インデックス）**だけを返す、超高性能なデータフィルタリング専門AIです。
+
+# ユーザーの指示
+{ai_processing_prompt}
+
+# 処理前のCSVデータ（先頭に行番号が付いています）
+```csv
+{csv_for_prompt}
+```
+
+# 実行手順
+1. まず、「ユーザーの指示」を注意深く読み、抽出条件と除外条件を正確に理解してください。
+2. 指示の中に「〇〇列を調べて」のように特定の列名が指定されている場合、その列の値を最優先で評価してください。なければ、すべての列を総合的に判断してください。
+3. 次に、「処理前のCSVデータ」を一行ずつ確認します。
+4. 各行が「ユーザーの指示」に合致するかを判断します。
+5. 条件に合致した行の**行番号（インデックス）**だけを、結果として蓄積します。
+
+# 絶対的なルール
+- **出力は、条件に合致した行の行番号（インデックス）を、JSON形式の数値配列として、ただ一つだけ返してください。**
+- **例:** `[0, 5, 12, 23]`
+- 会話や説明、マークダウン(` ```json ... ```)など、余計な情報は一切含めないでください。
+- もし、どの行も条件に合致しなかった場合は、空の配列 `[]` を返してください。
+"""
+
+def parse_row_filter_response(raw_response):
+    """AIの応答からJSON配列（行番号のリスト）を取り出す"""
+    # マークダウンコードブロックを除去
+    cleaned_response = raw_response.strip().replace("```json", "").replace("```", "").strip()
+    # JSON配列の開始位置と終了位置を探す（最初の[と最後の]）。見つからない場合は全体をパースする
+    start_index = cleaned_response.find('[')
+    end_index = cleaned_response.rfind(']')
+    json_string = cleaned_response[start_index:end_index+1] if start_index != -1 and end_index > start_index else cleaned_response
+    try:
+        matched_indices = json.loads(json_string)
+    except json.JSONDecodeError as json_err:
+        error_pos = getattr(json_err, 'pos', None)
+        error_msg = f"JSON解析エラー: {str(json_err)}"
+        if error_pos:
+            error_msg += f" (位置: {error_pos}文字目)"
+            error_msg += f"\nエラー位置付近の文字列: {json_string[max(0, error_pos-100):error_pos+100]}"
+        error_msg += f"\nAIの応答（最初の500文字）: {raw_response[:500]}"
+        raise ValueError(error_msg)
+    if not isinstance(matched_indices, list):
+        raise ValueError(f"AIの応答が配列ではありません: {type(matched_indices)}")
+    return matched_indices
+
+def estimate_tokens(text):
+    """プロンプトのトークン数の概算（日本語は1文字≒1トークン、英数字は4文字≒1トークン）"""
+    ascii_count = sum(1 for char in text if ord(char) < 128)
+    return (len(text) - ascii_count) + ascii_count // 4 + 1
+
+def select_prompt_columns(ai_processing_prompt, columns):
+    """指示文に列名が含まれていればその列だけを、なければ全列を返す"""
+    mentioned = [col for col in columns if str(col) in ai_processing_prompt]
+    return mentioned or list(columns)
+
+def run_ai_row_filter(df, ai_processing_prompt, processing_log, stage=None, checkpoint=None, on_progress=None):
+    """ユーザーの指示に合致する行だけを残す
+
+    行をトークン数の目安に収まるチャンクに分け、チャンクごとに並列でAIに問い合わせて、返ってきた行番号を結合する。
+    失敗したチャンクは（再試行後も失敗した場合）AI処理前の行をそのまま残す。
+    stage（StageMetrics）を渡すと、AI呼び出し・トークン数・キャッシュの集計を加算する。
+    checkpoint（JobCheckpoint）を渡すと、完了したチャンクの判定結果を保存し、再実行時は保存済みの判定を使う。
+    on_progress(完了した行数, 対象の行数, 完了したチャンク数)は、チャンクが完了するたびに呼ばれる。
+    """
+    prompt_columns = select_prompt_columns(ai_processing_prompt, df.columns)
+    if len(prompt_columns) < len(df.columns):
+        processing_log.append(f"AIプロンプト処理の対象列: {', '.join(map(str, prompt_columns))}（指示に含まれる列だけを送信します）")
+
+    # ★★★ (指示文, モデル, 行の内容)ごとの判定結果をキャッシュし、未判定の行だけをAIに送る ★★★
+    cache_namespace = row_filter_cache_namespace(ai_processing_prompt)
+    columns_key = hashlib.sha256(json.dumps(sorted(map(str, prompt_columns)), ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+    row_cache_keys = pd.Series([f"{columns_key}:{row_hash:016x}" for row_hash in compute_row_hashes(df, prompt_columns)], index=df.index)
+    unique_cache_keys = row_cache_keys.unique().tolist()
+    cached_decisions = {}
+    if checkpoint is not None:
+        restored_decisions = checkpoint.load_batches('ai_filter')
+        cached_decisions = {key: restored_decisions[key] for key in unique_cache_keys if key in restored_decisions}
+        if cached_decisions:
+            processing_log.append(f"チェックポイントから、完了済みのチャンクの判定{len(cached_decisions)}件を再利用します。")
+    cached_decisions.update(row_filter_cache.get_many(cache_namespace, [key for key in unique_cache_keys if key not in cached_decisions]))
+    cached_mask = row_cache_keys.isin(cached_decisions.keys()).to_numpy()
+    kept_labels = df.index[cached_mask][row_cache_keys[cached_mask].map(cached_decisions).eq('1').to_numpy()].tolist()
+    row_labels = df.index[~cached_mask].tolist()
+    processing_log.append(f"AIプロンプト処理の判定キャッシュ: ヒット{int(cached_mask.sum())}行 / 未判定{len(row_labels)}行")
+    if stage is not None:
+        stage.add(cacheHits=int(cached_mask.sum()), cacheMisses=len(row_labels))
+    if not row_labels:
+        result_df = df[df.index.isin(kept_labels)]
+        processing_log.append(f"ユーザー指示のAIプロンプト処理が完了しました。{len(result_df)}件の行が合致しました。")
+        return result_df
+
+    # 先頭の行からCSVの1行あたりのトークン数を見積もり、チャンクの行数を決める
+    sample_csv = df.loc[row_labels[:200], prompt_columns].to_csv(index=True)
+    tokens_per_row = max(1, estimate_tokens(sample_csv) // min(len(row_labels), 200))
+    rows_per_chunk = max(1, min(AI_FILTER_MAX_ROWS_PER_CHUNK, AI_FILTER_TOKEN_BUDGET // tokens_per_row))
+    chunk_count = -(-len(row_labels) // rows_per_chunk)
+    processing_log.append(f"AIプロンプト処理: {len(row_labels)}行を約{rows_per_chunk}行ずつ、{chunk_count}チャンクに分けて処理します。")
+
+    rows_done = 0
+    chunks_done = 0
+
+    def on_chunk_done(outcome):
+        nonlocal rows_done, chunks_done
+        rows_done += len(outcome['items'])
+        chunks_done += 1
+        if on_progress is not None:
+            on_progress(rows_done, len(row_labels), chunks_done)
+        if outcome['error'] is None:
+            # チャンクごとに判定結果を保存し、次回以降は同じ内容の行をAIに送らない
+            matched = set(outcome['result'])
+            decisions = {row_cache_keys[label]: '1' if label in matched else '0' for label in outcome['items']}
+            row_filter_cache.set_many(cache_namespace, decisions)
+            if checkpoint is not None:
+                checkpoint.save_batch('ai_filter', decisions)
+
+    def filter_chunk(chunk_labels):
+        csv_for_prompt = df.loc[chunk_labels, prompt_columns].to_csv(index=True)
+        response = model.generate_content(build_row_filter_prompt(ai_processing_prompt, csv_for_prompt),
+                                          generation_config=AI_FILTER_GENERATION_CONFIG, safety_settings=AI_FILTER_SAFETY_SETTINGS,
+                                          request_options={'timeout': 180})
+        if stage is not None:
+            stage.record_model_response(response)
+        chunk_label_set = set(chunk_labels)
+        return [idx for idx in parse_row_filter_response(response.text) if isinstance(idx, int) and idx in chunk_label_set]
+
+    outcomes = ai_dispatcher.map_batches(row_labels, filter_chunk, rows_per_chunk,
+                                         min_batch_size=max(1, rows_per_chunk // 8), max_batch_size=rows_per_chunk,
+                                         on_batch_done=on_chunk_done)
+    failed_chunks = 0
+    for number, outcome in enumerate(outcomes, start=1):
+        chunk_labels = outcome['items']
+        chunk_range = f"チャンク{number}/{len(outcomes)} (行番号 {chunk_labels[0]}〜{chunk_labels[-1]})"
+        retry_note = f"、再試行{outcome['retries']}回" if outcome['retries'] else ""
+        if stage is not None:
+            stage.add(retries=outcome['retries'])
+        if outcome['error'] is None:
+            kept_labels.extend(outcome['result'])
+            processing_log.append(f"AIプロンプト処理 {chunk_range}: {len(chunk_labels)}行中{len(outcome['result'])}行が合致 ({outcome['seconds']:.1f}秒{retry_note})")
+        else:
+            failed_chunks += 1
+            if stage is not None:
+                stage.add(failedBatches=1)
+            kept_labels.extend(chunk_labels)
+            error_detail = str(outcome['error'])
+            if len(error_detail) > 1000:
+                error_detail = error_detail[:1000] + "... (以下省略)"
+            processing_log.append(f"警告: AIプロンプト処理 {chunk_range} でエラーが発生したため、このチャンクはAI処理前のデータを結果とします。エラー: {error_detail}")
+
+    # 同じ行番号が重複して返された場合に備えて、元の並び順で行を取り出す
+    result_df = df[df.index.isin(kept_labels)]
+    if failed_chunks:
+        processing_log.append(f"ユーザー指示のAIプロンプト処理が完了しました（{failed_chunks}チャンクでエラーあり）。{len(result_df)}件の行が残りました。")
+    else:
+        processing_log.append(f"ユーザー指示のAIプロンプト処理が完了しました。{len(result_df)}件の行が合致しました。")
+    return result_df
+
+def complete_with_diff_error(job_id, latest_file_label, latest_file_stream, latest_encodings, error):
+    """差分抽出に失敗した場合に、以降の処理を中断した状態でジョブを完了させる"""
+    row_count = 0
+    for encoding in latest_encodings:
+        try:
+            row_count = sum(len(chunk) for chunk in iter_csv_chunks(latest_file_stream, encoding))
+            break
+        except UnicodeDecodeError:
+            continue
+    error_message = f"差分抽出中にエラーが発生したため、以降の処理を中断しました。エラー: {error}"
+    processing_log = [f"最新ファイル「{latest_file_label}」を読み込みました。({row_count}行)", f"【重要】{error_message}"]
+    job_store.update(
+        job_id,
+        status='completed',
+        result={'message': '処理が中断されました。', 'log': processing_log, 'rowCount': 0, 'columns': [], 'previewCsv': '', 'resultSize': 0, 'downloadUrl': None, 'datasetId': None},
+        error=None,
+        completed_at=datetime.now().isoformat()
+    )
+
+# ★★★ バックグラウンドで実行する処理関数 ★★★
+def filter_latest_file(job_id, job_started, profiler, latest_file_stream, latest_filename, previous_file_stream, form_data):
+    """最新ファイルを読み込みながら差分抽出・日付フィルタ・キーワード検索で絞り込む
+
+    (絞り込んだDataFrame, 処理ログ, AI日付整形を行うか)を返す。差分抽出に失敗してジョブを完了させた場合はNoneを返す。
+    """
+    # ★★★ 文字コードは先頭サンプルで1回だけ判定し、以降はチャンク単位で処理する ★★★
+    with profiler.stage('encoding', '文字コード判定'):
+        latest_encodings = candidate_encodings(latest_file_stream)
+        latest_columns = read_csv_header(latest_file_stream, latest_encodings[0])
+    latest_file_label = secure_filename(latest_filename)
+
+    diff_index = None
+    extra_columns = []
+    include_changed_rows = form_data.get('diff_include_changed') == 'on'
+    diff_notes = []
+    previous_file_key = form_data.get('previous_file_key')
+    diff_mode = form_data.get('diff_mode') or 'previous'
+    if diff_mode == 'seen_ever' or previous_file_stream is not None or previous_file_key:
+        try:
+            diff_key_column = form_data.get('diff_key_column') or None
+            if diff_mode == 'seen_ever':
+                # 前回ファイル1つではなく、これまでに保存した全ファイルと比較する
+                if diff_key_column and diff_key_column not in latest_columns:
+                    raise ValueError(f"差分比較のキー列「{diff_key_column}」が最新ファイルに存在しません。")
+                with profiler.stage('diff_index', '過去出現インデックスの読込'):
+                    diff_index = build_seen_ever_diff_index(latest_columns, diff_key_column, diff_notes)
+            else:
+                with profiler.stage('diff_index', '前回ファイルの索引作成'):
+                    diff_index, previous_columns = build_previous_diff_index(previous_file_stream, previous_file_key, latest_columns, diff_key_column, diff_notes)
+                # 従来のpd.mergeと同様に、前回ファイルにしかない列も結果に含める
+                extra_columns = [col for col in previous_columns if col not in latest_columns]
+        except Exception as e:
+            complete_with_diff_error(job_id, latest_file_label, latest_file_stream, latest_encodings, e)
+            record_job_finished('completed', time.perf_counter() - job_started)
+            return None
+
+    keyword_column = form_data.get('keyword_column')
+    keywords_str = form_data.get('keywords')
+    search_type = form_data.get('search_type')
+    keyword_matcher = None
+    if keyword_column and keywords_str and keyword_column in latest_columns:
+        keywords = [kw.strip() for kw in keywords_str.splitlines() if kw.strip()]
+        if keywords:
+            keyword_matcher = KeywordMatcher(
+                keywords,
+                search_type=search_type,
+                match_mode=form_data.get('keyword_match_mode') or 'literal',
+                normalize=form_data.get('keyword_normalize') == 'on'
+            )
+    pipeline = build_filter_pipeline(form_data, latest_columns, diff_index, keyword_matcher)
+
+    for encoding in latest_encodings:
+        try:
+            original_row_count = 0
+            kept_row_count = 0
+            read_seconds = 0.0
+            pipeline.reset()
+            kept_chunks = []
+            started = time.perf_counter()
+            for chunk in iter_csv_chunks(latest_file_stream, encoding, compact=CSV_COMPACT_DTYPES):
+                read_seconds += time.perf_counter() - started
+                original_row_count += len(chunk)
+                try:
+                    kept_chunks.append(pipeline.run_chunk(chunk))
+                except PipelineStageError as e:
+                    if e.stage.name == 'diff':
+                        complete_with_diff_error(job_id, latest_file_label, latest_file_stream, latest_encodings, e.error)
+                        record_job_finished('completed', time.perf_counter() - job_started)
+                        return None
+                    raise e.error
+                kept_row_count += len(kept_chunks[-1])
+                profiler.progress('parse', 'CSV読込・絞り込み', rowsRead=original_row_count, rowsRemaining=kept_row_count)
+                started = time.perf_counter()
+            read_seconds += time.perf_counter() - started
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(ENCODING_ERROR_MESSAGE)
+
+    started = time.perf_counter()
+    df_latest = concat_chunks(kept_chunks, latest_columns)
+    del kept_chunks
+    if extra_columns:
+        df_latest = df_latest.reindex(columns=latest_columns + extra_columns)
+    concat_seconds = time.perf_counter() - started
+    profiler.record('parse', 'CSV読込', original_row_count, original_row_count, read_seconds)
+    for predicate in pipeline.final_order():
+        profiler.record(predicate.name, predicate.label, predicate.rows_in, predicate.rows_out, predicate.seconds)
+    profiler.record('concat', 'チャンクの結合', len(df_latest), len(df_latest), concat_seconds)
+
+    processing_log = [f"最新ファイル「{latest_file_label}」を読み込みました。({original_row_count}行)"]
+    if CSV_COMPACT_DTYPES:
+        category_columns = [str(col) for col in df_latest.columns if isinstance(df_latest[col].dtype, pd.CategoricalDtype)]
+        processing_log.append(f"省メモリモードで読み込みました。(カテゴリ型の列: {', '.join(category_columns) or 'なし'})")
+    processing_log.extend(diff_notes)
+    diff_stage = pipeline.stage('diff')
+    if diff_stage is not None:
+        if diff_index.key_column:
+            changed_label = "新規・変更案件" if include_changed_rows else "新規案件"
+            processing_log.append(f"差分抽出(キー列「{diff_index.key_column}」): {changed_label}に絞り込みました。新規{diff_stage.counts['new']}件 / 変更{diff_stage.counts['changed']}件 ({diff_stage.rows_in}行 -> {diff_stage.rows_out}行)")
+        else:
+            processing_log.append(f"差分抽出: 新規案件に絞り込みました。({diff_stage.rows_in}行 -> {diff_stage.rows_out}行)")
+
+    # 先に実行した述語で全行が除外され、評価されなかった述語のログは出さない（差分抽出がない場合は従来どおり出す）
+    def was_evaluated(predicate):
+        return diff_stage is None or predicate.rows_in > 0
+
+    for predicate in pipeline.predicates:
+        if isinstance(predicate, DateFilterPredicate) and was_evaluated(predicate):
+            processing_log.append(f"{predicate.label}: 「{predicate.column}」で {predicate.rows_in}行 -> {predicate.rows_out}行")
+    keyword_stage = pipeline.stage('keyword')
+    if keyword_stage is not None and was_evaluated(keyword_stage):
+        processing_log.append(f"キーワード検索: {keyword_stage.rows_in}行 -> {keyword_stage.rows_out}行")
+        processing_log.append(f"キーワード別の該当行数: {keyword_matcher.hit_count_summary()}")
+    if len(pipeline.predicates) > 1:
+        processing_log.append(f"絞り込みの実行順: {' → '.join(predicate.label for predicate in pipeline.final_order())}")
+
+    # 差分抽出で全行が除外された場合は、従来どおりAIによる日付整形を行わない
+    return df_latest, processing_log, diff_stage is None or not df_latest.empty
+
+def run_ai_date_format(df_latest, form_data, processing_log, profiler, checkpoint=None):
+    """フォームで指定された列の日付をルールとAIで整形し、df_latestとprocessing_logを更新する
+
+    整形を行った場合はその段階の計測値（StageMetrics）を、対象外の場合はNoneを返す。
+    """
+    ai_date_format_enabled = form_data.get('ai_date_format_enabled') == 'on'
+    ai_date_format_column = form_data.get('ai_date_format_column')
+    if not (ai_date_format_enabled and ai_date_format_column and ai_date_format_column in df_latest.columns):
+        return None
+    with profiler.stage('ai_date_format', 'AI日付整形', rows_in=len(df_latest)) as stage:
+        processing_log.append(f"AIによる日付自動整形を開始 (対象列: {ai_date_format_column})")
+
+        date_values = df_latest[ai_date_format_column]
+        if isinstance(date_values.dtype, pd.CategoricalDtype):
+            date_values = date_values.astype(object)
+        final_dates = date_values.fillna('').astype(str)
+        non_empty_dates = final_dates[final_dates != '']
+
+        if not non_empty_dates.empty:
+            batch_size = 100
+            has_error = False
+
+            # ★★★ 列全体で重複を除き、ルールで整形できずキャッシュにもない値だけをAIに送る ★★★
+            unique_dates = non_empty_dates.unique().tolist()
+            rule_formatted = normalize_japanese_dates(pd.Series(unique_dates, dtype=object)).dropna()
+            formatted_map = dict(zip(rule_formatted.index.map(unique_dates.__getitem__), rule_formatted))
+            rule_unresolved = [value for value in unique_dates if value not in formatted_map]
+            processing_log.append(f"ルールによる日付整形: {len(unique_dates) - len(rule_unresolved)}種類 / {len(unique_dates)}種類を整形しました。")
+            if checkpoint is not None:
+                # 中断前に完了したバッチの結果は、キャッシュを引かずにそのまま使う
+                restored_batches = checkpoint.load_batches('ai_date_format')
+                restored_map = {value: restored_batches[value] for value in rule_unresolved if value in restored_batches}
+                if restored_map:
+                    formatted_map.update(restored_map)
+                    rule_unresolved = [value for value in rule_unresolved if value not in restored_map]
+                    processing_log.append(f"チェックポイントから、完了済みのバッチの整形結果{len(restored_map)}種類を再利用します。")
+            cached_map = date_format_cache.get_many(DATE_FORMAT_CACHE_NAMESPACE, rule_unresolved)
+            formatted_map.update(cached_map)
+            pending_dates = [value for value in rule_unresolved if value not in cached_map]
+            stage.add(cacheHits=len(cached_map), cacheMisses=len(pending_dates))
+            if not model and pending_dates:
+                processing_log.append(f"警告: AI機能が設定されていないため、ルールで解釈できない{len(pending_dates)}種類の値はそのまま残します。")
+                pending_dates = []
+            model_call_count = 0
+            date_batches_done = 0
+            date_values_done = 0
+
+            def format_date_batch(unique_batch_list):
+                response = model.generate_content(build_date_formatting_prompt(unique_batch_list), request_options={'timeout': 180})
+                stage.record_model_response(response)
+                return parse_date_formatting_response(response.text, unique_batch_list)
+
+            def on_date_batch_done(outcome):
+                nonlocal has_error, model_call_count, date_batches_done, date_values_done
+                model_call_count += 1 + outcome['retries']
+                date_batches_done += 1
+                date_values_done += len(outcome['items'])
+                profiler.progress('ai_date_format', 'AI日付整形', done=date_values_done, total=len(pending_dates), unit='種類', batches=date_batches_done)
+                stage.add(retries=outcome['retries'])
+                if outcome['error'] is None:
+                    formatted_map.update(outcome['result'])
+                    # バッチごとに保存しておき、途中で失敗しても完了済みの結果は次回以降に再利用する
+                    date_format_cache.set_many(DATE_FORMAT_CACHE_NAMESPACE, outcome['result'])
+                    if checkpoint is not None:
+                        checkpoint.save_batch('ai_date_format', outcome['result'])
                 else:
-                    processing_log.append("AIによる日付自動整形: 対象列に整形すべきデータがありませんでした。")
+                    has_error = True
+                    stage.add(failedBatches=1)
+                    error_detail = str(outcome['error'])
+                    # エラーメッセージが長い場合は切り詰める
+                    if len(error_detail) > 1000:
+                        error_detail = error_detail[:1000] + "... (以下省略)"
+                    processing_log.append(f"警告: 日付整形のバッチ処理でエラー発生。このバッチ({len(outcome['items'])}件)はスキップされます。エラー: {error_detail}")
+
+            ai_dispatcher.map_batches(pending_dates, format_date_batch, batch_size, min_batch_size=10,
+                                      max_batch_size=batch_size * 2, on_batch_done=on_date_batch_done)
+
+            processing_log.append(f"日付整形キャッシュ: ヒット{len(cached_map)}件 / ミス{len(rule_unresolved) - len(cached_map)}件 (AI呼び出し{model_call_count}回)")
+            final_dates.update(non_empty_dates.map(formatted_map).fillna(non_empty_dates))
+            df_latest[ai_date_format_column] = final_dates
+
+            if has_error:
+                processing_log.append("AIによる日付自動整形が完了しました（一部エラーあり）。")
+            else:
+                processing_log.append("AIによる日付自動整形が正常に完了しました。")
+        else:
+            processing_log.append("AIによる日付自動整形: 対象列に整形すべきデータがありませんでした。")
+    return stage
+
+
+def process_csv_background(job_id, latest_file_stream, latest_filename, previous_file_stream, form_data, checkpoint=None):
+    """バックグラウンドでCSV処理を実行する関数
+
+    checkpoint（JobCheckpoint）を渡すと、段階ごとの途中結果とAIバッチの結果を保存し、保存済みの段階からは続きを処理する。
+    """
+    job_started = time.perf_counter()
+    profiler = JobProfiler(job_id)
+    try:
+        job_store.update(job_id, status='processing', result=None, error=None, metrics=[], progress=None, started_at=datetime.now().isoformat())
+
+        restored = None
+        if checkpoint is not None:
+            started = time.perf_counter()
+            restored = checkpoint.load_latest_stage(('ai_date_format', 'filter'))
+            if restored is not None:
+                profiler.record('checkpoint_restore', 'チェックポイントの読込', 0, len(restored[1]), time.perf_counter() - started)
+        if restored is None:
+            restored_stage = None
+            filtered = filter_latest_file(job_id, job_started, profiler, latest_file_stream, latest_filename, previous_file_stream, form_data)
+            if filtered is None:
+                return
+            df_latest, processing_log, date_format_allowed = filtered
+            if checkpoint is not None:
+                with profiler.stage('checkpoint_save', 'チェックポイントの保存', rows_in=len(df_latest)):
+                    checkpoint.save_stage('filter', df_latest, log=processing_log, dateFormatAllowed=date_format_allowed)
+        else:
+            restored_stage, df_latest, state = restored
+            processing_log = state['log'] + [f"チェックポイントから再開しました。（{CHECKPOINT_STAGE_LABELS[restored_stage]}まで完了済み）"]
+            date_format_allowed = state['dateFormatAllowed']
+
+        if restored_stage != 'ai_date_format' and date_format_allowed:
+            stage = run_ai_date_format(df_latest, form_data, processing_log, profiler, checkpoint)
+            # 失敗したバッチがある場合は保存せず、再実行時にこの段階をもう一度（失敗したバッチだけAIに送って）処理する
+            if stage is not None and checkpoint is not None and not stage.counters['failedBatches']:
+                with profiler.stage('checkpoint_save', 'チェックポイントの保存', rows_in=len(df_latest)):
+                    checkpoint.save_stage('ai_date_format', df_latest, log=processing_log, dateFormatAllowed=date_format_allowed)
 
         ai_processing_prompt = form_data.get('ai_prompt')
-        final_df = df_latest.copy()
+        final_df = df_latest
         if ai_processing_prompt and model and not final_df.empty:
-            processing_log.append("ユーザー指示のAIプロンプト処理を開始します...")
-            csv_for_prompt = final_df.to_csv(index=True)
-            final_prompt = f"""
-# あなたのタスク
-あなたは、CSVデータの中から、ユーザーが定義したルールに合致する行を見つけ出し、その**行番号（インデックス）**だけを返す、超高性能なデータフィルタリング専門AIです。
-
-# ユーザーの指示
-{ai_processing_prompt}
+            with profiler.stage('ai_filter', 'AIプロンプト処理', rows_in=len(final_df)) as stage:
+                processing_log.append("ユーザー指示のAIプロンプト処理を開始します...")
+                def on_ai_filter_progress(done, total, batches):
+                    profiler.progress('ai_filter', 'AIプロンプト処理', done=done, total=total, unit='行', batches=batches)
 
-# 処理前のCSVデータ（先頭に行番号が付いています）
-```csv
-{csv_for_prompt}
-```
+                final_df = run_ai_row_filter(final_df, ai_processing_prompt, processing_log, stage, checkpoint, on_ai_filter_progress)
+                stage.rows_out = len(final_df)
 
-# 実行手順
-1. まず、「ユーザーの指示」を注意深く読み、抽出条件と除外条件を正確に理解してください。
-2. 指示の中に「〇〇列を調べて」のように特定の列名が指定されている場合、その列の値を最優先で評価してください。なければ、すべての列を総合的に判断してください。
-3. 次に、「処理前のCSVデータ」を一行ずつ確認します。
-4. 各行が「ユーザーの指示」に合致するかを判断します。
-5. 条件に合致した行の**行番号（インデックス）**だけを、結果として蓄積します。
+        failed_batches = sum(metrics.counters['failedBatches'] for metrics in profiler.stages)
+        if failed_batches and checkpoint is not None:
+            processing_log.append(f"{failed_batches}件のAIバッチが失敗しました。再実行すると、失敗したバッチだけをAIで処理し直します。")
 
-# 絶対的なルール
-- **出力は、条件に合致した行の行番号（インデックス）を、JSON形式の数値配列として、ただ一つだけ返してください。**
-- **例:** `[0, 5, 12, 23]`
-- 会話や説明、マークダウン(` ```json ... ```)など、余計な情報は一切含めないでください。
-- もし、どの行も条件に合致しなかった場合は、空の配列 `[]` を返してください。
-"""
-            try:
-                generation_config = genai.types.GenerationConfig(temperature=0)
-                safety_settings = {'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE','HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE','HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE','HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE',}
-                response = model.generate_content(final_prompt, generation_config=generation_config, safety_settings=safety_settings, request_options={'timeout': 180})
-                
-                # AIの応答からJSON配列を抽出（より堅牢な処理）
-                raw_response = response.text.strip()
-                processing_log.append(f"AIの生応答（最初の200文字）: {raw_response[:200]}")
-                
-                # マークダウンコードブロックを除去（複数のパターンに対応）
-                cleaned_response = raw_response
-                # ```json と ``` を除去
-                cleaned_response = cleaned_response.replace("```json", "").replace("```", "").strip()
-                
-                # JSON配列の開始位置と終了位置を探す（最初の[と最後の]）
-                start_index = cleaned_response.find('[')
-                end_index = cleaned_response.rfind(']')
-                
-                processing_log.append(f"cleaned_responseの長さ: {len(cleaned_response)}文字")
-                processing_log.append(f"start_index: {start_index}, end_index: {end_index}")
-                
-                if start_index != -1 and end_index != -1 and end_index > start_index:
-                    json_string = cleaned_response[start_index:end_index+1]
-                    processing_log.append(f"抽出したJSON文字列の長さ: {len(json_string)}文字")
-                    processing_log.append(f"抽出したJSON文字列（最初の200文字）: {json_string[:200]}")
-                    processing_log.append(f"抽出したJSON文字列（最後の200文字）: {json_string[-200:]}")
-                    
-                    # 非常に長いJSON配列の場合でも解析できるようにする
-                    try:
-                        matched_indices = json.loads(json_string)
-                    except json.JSONDecodeError as json_err:
-                        # JSON解析エラーが発生した場合、エラーの位置を確認
-                        error_pos = getattr(json_err, 'pos', None)
-                        error_msg = f"JSON解析エラー: {str(json_err)}"
-                        if error_pos:
-                            error_msg += f" (位置: {error_pos}文字目)"
-                            error_msg += f"\nエラー位置付近の文字列: {json_string[max(0, error_pos-100):error_pos+100]}"
-                        error_msg += f"\n抽出したJSON文字列（最初の500文字）: {json_string[:500]}"
-                        error_msg += f"\n抽出したJSON文字列（最後の500文字）: {json_string[-500:]}"
-                        processing_log.append(error_msg)
-                        raise
-                else:
-                    # JSON配列が見つからない場合、全体をパースしてみる
-                    processing_log.append("警告: JSON配列の開始/終了が見つかりません。全体をパースします。")
-                    processing_log.append(f"cleaned_response（最初の500文字）: {cleaned_response[:500]}")
-                    try:
-                        matched_indices = json.loads(cleaned_response)
-                    except json.JSONDecodeError as json_err:
-                        # 全体パースでもエラーが発生した場合の詳細ログ
-                        error_pos = getattr(json_err, 'pos', None)
-                        error_msg = f"全体パース時のJSON解析エラー: {str(json_err)}"
-                        if error_pos:
-                            error_msg += f" (位置: {error_pos}文字目)"
-                            error_msg += f"\nエラー位置付近の文字列: {cleaned_response[max(0, error_pos-100):error_pos+100]}"
-                        error_msg += f"\ncleaned_response（最後の500文字）: {cleaned_response[-500:]}"
-                        processing_log.append(error_msg)
-                        raise
-                
-                if isinstance(matched_indices, list):
-                    valid_indices = [idx for idx in matched_indices if idx in final_df.index]
-                    final_df = final_df.loc[valid_indices]
-                    processing_log.append(f"ユーザー指示のAIプロンプト処理が完了しました。{len(valid_indices)}件の行が合致しました。")
-                else:
-                    raise ValueError(f"AIの応答が配列ではありません: {type(matched_indices)}")
-            except json.JSONDecodeError as e:
-                processing_log.append(f"警告: AIプロンプト処理中にJSON解析エラーが発生しました。AI処理前のデータを結果とします。")
-                processing_log.append(f"エラー詳細: {str(e)}")
-                processing_log.append(f"AIの応答（最初の500文字）: {raw_response[:500] if 'raw_response' in locals() else '応答なし'}")
-            except Exception as e:
-                processing_log.append(f"警告: AIプロンプト処理中にエラーが発生しました。AI処理前のデータを結果とします。エラー: {e}")
-                if 'raw_response' in locals():
-                    processing_log.append(f"AIの応答（最初の500文字）: {raw_response[:500]}")
-        
+        with profiler.stage('write_result', '結果の書き出し', rows_in=len(final_df)):
+            result_location = write_job_result(job_id, final_df)
         result = {
             'message': '処理が正常に完了しました。',
             'log': processing_log,
             'rowCount': len(final_df),
-            'csvData': final_df.to_csv(index=False, encoding='utf-8-sig')
+            'columns': [str(column) for column in final_df.columns],
+            'previewCsv': build_result_preview(final_df),
+            'resultSize': result_location['size'],
+            'downloadUrl': f"/api/process_result/{job_id}",
+            'datasetId': result_location['sha256'],
+            'failedBatches': failed_batches
         }
         
-        with jobs_lock:
-            jobs[job_id] = {
-                'status': 'completed',
-                'result': result,
-                'error': None,
-                'completed_at': datetime.now().isoformat()
-            }
+        job_store.update(job_id, status='completed', result=result, result_location=result_location, error=None, completed_at=datetime.now().isoformat())
+        record_job_finished('completed', time.perf_counter() - job_started)
             
     except Exception as e:
         traceback.print_exc()
-        with jobs_lock:
-            jobs[job_id] = {
-                'status': 'error',
-                'result': None,
-                'error': f'サーバーで予期せぬエラーが発生しました: {str(e)}',
-                'completed_at': datetime.now().isoformat()
-            }
+        job_store.update(
+            job_id,
+            status='error',
+            result=None,
+            error=f'サーバーで予期せぬエラーが発生しました: {str(e)}',
+            completed_at=datetime.now().isoformat()
+        )
+        record_job_finished('error', time.perf_counter() - job_started)
+
+def run_spooled_job(job_id, latest_file_path, latest_filename, previous_file_path, form_data):
+    """一時ファイルに書き出したアップロードを開いて処理し、終了後に削除する"""
+    try:
+        checkpoint = prepare_job_checkpoint(job_id, latest_file_path, latest_filename, previous_file_path, form_data)
+        with open(latest_file_path, 'rb') as latest_file_stream:
+            if previous_file_path:
+                with open(previous_file_path, 'rb') as previous_file_stream:
+                    process_csv_background(job_id, latest_file_stream, latest_filename, previous_file_stream, form_data, checkpoint)
+            else:
+                process_csv_background(job_id, latest_file_stream, latest_filename, None, form_data, checkpoint)
+    finally:
+        for path in (latest_file_path, previous_file_path):
+            if path:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+def run_checkpointed_job(job_id, checkpoint, inputs):
+    """チェックポイントに保存した入力ファイルを開き、保存済みの段階の続きから処理する"""
+    try:
+        latest_file_stream = checkpoint.open_input('latest')
+        previous_file_stream = checkpoint.open_input('previous') if inputs['hasPrevious'] else None
+    except Exception as e:
+        traceback.print_exc()
+        job_store.update(job_id, status='error', result=None, error=f'再実行に必要な入力ファイルを開けませんでした: {str(e)}',
+                         completed_at=datetime.now().isoformat())
+        return
+    try:
+        process_csv_background(job_id, latest_file_stream, inputs['latestFilename'], previous_file_stream, inputs['formData'], checkpoint)
+    finally:
+        for stream in (latest_file_stream, previous_file_stream):
+            if stream is not None:
+                stream.close()
+
+def release_job_slot(_future):
+    job_slots.release()
+    metrics_registry.add('jobs_in_flight', "実行中と実行待ちのジョブ数", -1)
 
 @app.route('/api/process', methods=['POST'])
 def process_csv():
@@ -364,15 +2569,25 @@ def process_csv():
         if not latest_file:
             return jsonify({'error': '「最新の案件ファイル」がアップロードされていません。'}), 400
         
-        # ファイルデータをメモリに読み込む
-        latest_file_data = latest_file.read()
-        latest_filename = latest_file.filename
-        
-        # 前回ファイルのデータを読み込む（存在する場合）
-        previous_file_data = None
-        previous_file = request.files.get('previous_file')
-        if previous_file:
-            previous_file_data = previous_file.read()
+        # 実行中と待ちのジョブが上限に達している場合は受け付けない
+        if not job_slots.acquire(blocking=False):
+            metrics_registry.inc('jobs_rejected_total', "混雑のため受け付けなかったジョブ数")
+            return jsonify({'error': '現在処理が混み合っています。しばらく待ってから再度実行してください。'}), 503
+
+        # ファイルはメモリに読み込まず一時ファイルに書き出す（前回ファイルは存在する場合のみ）
+        latest_file_path = previous_file_path = None
+        try:
+            latest_file_path = spool_upload(latest_file)
+            latest_filename = latest_file.filename
+            previous_file = request.files.get('previous_file')
+            if previous_file:
+                previous_file_path = spool_upload(previous_file)
+        except Exception:
+            job_slots.release()
+            for path in (latest_file_path, previous_file_path):
+                if path:
+                    os.remove(path)
+            raise
         
         # フォームデータを取得
         form_data = {
@@ -385,19 +2600,30 @@ def process_csv():
             'keyword_column': request.form.get('keyword_column'),
             'keywords': request.form.get('keywords'),
             'search_type': request.form.get('search_type'),
+            'keyword_match_mode': request.form.get('keyword_match_mode'),
+            'keyword_normalize': request.form.get('keyword_normalize'),
+            'diff_key_column': request.form.get('diff_key_column'),
+            'diff_include_changed': request.form.get('diff_include_changed'),
+            'previous_file_key': None if previous_file_path else request.form.get('previous_file_key'),
+            'diff_mode': request.form.get('diff_mode'),
             'ai_prompt': request.form.get('ai_prompt')
         }
         
         # ジョブIDを生成
         job_id = str(uuid.uuid4())
+        job_store.update(job_id, status='processing', result=None, error=None, queued_at=datetime.now().isoformat())
         
-        # バックグラウンドで処理を開始
-        thread = threading.Thread(
-            target=process_csv_background,
-            args=(job_id, latest_file_data, latest_filename, previous_file_data, form_data)
-        )
-        thread.daemon = True
-        thread.start()
+        # ワーカープールでバックグラウンド処理を開始
+        try:
+            future = job_executor.submit(run_spooled_job, job_id, latest_file_path, latest_filename, previous_file_path, form_data)
+        except Exception:
+            job_slots.release()
+            for path in (latest_file_path, previous_file_path):
+                if path:
+                    os.remove(path)
+            raise
+        metrics_registry.add('jobs_in_flight', "実行中と実行待ちのジョブ数", 1)
+        future.add_done_callback(release_job_slot)
         
         return jsonify({'job_id': job_id, 'status': 'processing'})
         
@@ -405,23 +2631,172 @@ def process_csv():
         traceback.print_exc()
         return jsonify({'error': f'処理の開始に失敗しました: {str(e)}'}), 500
 
+def job_status_payload(job_id, job):
+    """ステータス応答と進捗の配信で共通の内容を返す"""
+    # 段階ごとの計測値と実行中の段階の途中経過は、処理中も返す
+    metrics = job.get('metrics', [])
+    retryable = is_job_retryable(job)
+    if job['status'] == 'processing':
+        return {'status': 'processing', 'job_id': job_id, 'progress': job.get('progress'), 'metrics': metrics, 'retryable': retryable}
+    elif job['status'] == 'completed':
+        return {'status': 'completed', 'job_id': job_id, **job['result'], 'metrics': metrics, 'retryable': retryable}
+    elif job['status'] == 'error':
+        return {'status': 'error', 'job_id': job_id, 'error': job['error'], 'metrics': metrics, 'retryable': retryable}
+    return {'status': 'unknown', 'job_id': job_id}
+
 @app.route('/api/process_status/<job_id>', methods=['GET'])
 def get_process_status(job_id):
     """処理の状態を取得"""
-    with jobs_lock:
-        job = jobs.get(job_id)
+    job = job_store.get(job_id)
     
     if not job:
         return jsonify({'error': 'ジョブが見つかりません。'}), 404
     
-    if job['status'] == 'processing':
-        return jsonify({'status': 'processing', 'job_id': job_id})
-    elif job['status'] == 'completed':
-        return jsonify({'status': 'completed', 'job_id': job_id, **job['result']})
-    elif job['status'] == 'error':
-        return jsonify({'status': 'error', 'job_id': job_id, 'error': job['error']}), 500
-    
-    return jsonify({'status': 'unknown', 'job_id': job_id})
+    payload = job_status_payload(job_id, job)
+    return jsonify(payload), 500 if payload['status'] == 'error' else 200
+
+def format_server_sent_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/api/process_events/<job_id>', methods=['GET'])
+def stream_process_events(job_id):
+    """ジョブの進捗をServer-Sent Eventsで配信する
+
+    接続時と記録が更新されるたびに、処理中は'progress'、終了時は'done'イベントで状態を送る（内容はステータス応答と同じ）。
+    更新がない間は通知を待つだけで、JOB_EVENTS_RECHECK_SECONDSごとに記録を読み直して接続維持のコメントを送る。
+    同時配信数がJOB_EVENTS_MAX_STREAMSに達している場合は503を返し、ブラウザはポーリングに切り替える。
+    """
+    if not job_store.get(job_id):
+        return jsonify({'error': 'ジョブが見つかりません。'}), 404
+    if not job_event_stream_slots.acquire(blocking=False):
+        metrics_registry.inc('job_event_streams_rejected_total', "同時配信数の上限により受け付けなかった進捗配信の数")
+        return jsonify({'error': '進捗の配信が混み合っています。'}), 503
+
+    def generate():
+        metrics_registry.add('job_event_streams', "接続中の進捗配信の数", 1)
+        try:
+            yield f"retry: {JOB_EVENTS_RETRY_MILLISECONDS}\n\n"
+            deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+            version = job_events.version(job_id)
+            last_payload = None
+            while True:
+                job = job_store.get(job_id)
+                if not job:
+                    yield format_server_sent_event('done', {'status': 'error', 'job_id': job_id, 'error': 'ジョブが見つかりません。'})
+                    return
+                payload = job_status_payload(job_id, job)
+                if payload['status'] != 'processing':
+                    yield format_server_sent_event('done', payload)
+                    return
+                if payload != last_payload:
+                    yield format_server_sent_event('progress', payload)
+                    last_payload = payload
+                else:
+                    yield ": keep-alive\n\n"
+                if time.monotonic() > deadline:
+                    # 長時間つなぎ続けないよう一度切断する（ブラウザはretryの間隔で再接続する）
+                    return
+                version = job_events.wait(job_id, version, JOB_EVENTS_RECHECK_SECONDS)
+        finally:
+            metrics_registry.add('job_event_streams', "接続中の進捗配信の数", -1)
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # 配信が始まる前に切断された場合も枠を返すよう、ジェネレータではなくレスポンスの終了時に解放する
+    response.call_on_close(job_event_stream_slots.release)
+    return response
+
+@app.route('/api/process_retry/<job_id>', methods=['POST'])
+def retry_process(job_id):
+    """中断・失敗したジョブを、チェックポイントに保存した入力と途中経過から同じjob_idで再実行する"""
+    job = job_store.get(job_id)
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません。'}), 404
+    if not is_job_retryable(job):
+        return jsonify({'error': 'このジョブは再実行できません（処理中、正常に完了済み、または途中経過を保存していないジョブです）。'}), 409
+    try:
+        checkpoint = JobCheckpoint(job['checkpoint_id'])
+        inputs = checkpoint.load_inputs()
+        if inputs is None:
+            return jsonify({'error': '再実行に必要な入力ファイルの保存期間が過ぎています。もう一度ファイルを指定して実行してください。'}), 410
+
+        if not job_slots.acquire(blocking=False):
+            metrics_registry.inc('jobs_rejected_total', "混雑のため受け付けなかったジョブ数")
+            return jsonify({'error': '現在処理が混み合っています。しばらく待ってから再度実行してください。'}), 503
+        job_store.update(job_id, status='processing', result=None, error=None, queued_at=datetime.now().isoformat(),
+                         retry_count=job.get('retry_count', 0) + 1)
+        try:
+            future = job_executor.submit(run_checkpointed_job, job_id, checkpoint, inputs)
+        except Exception:
+            job_slots.release()
+            raise
+        metrics_registry.add('jobs_in_flight', "実行中と実行待ちのジョブ数", 1)
+        metrics_registry.inc('jobs_retried_total', "チェックポイントから再実行したジョブ数")
+        future.add_done_callback(release_job_slot)
+
+        return jsonify({'job_id': job_id, 'status': 'processing'})
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'再実行の開始に失敗しました: {str(e)}'}), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus形式のメトリクス（このワーカープロセスの値。workerラベルにプロセスIDを付ける）"""
+    metrics_registry.set('job_capacity', "同時に受け付けられるジョブ数（実行中と実行待ちの合計）", JOB_MAX_WORKERS + JOB_QUEUE_LIMIT)
+    metrics_registry.set('job_workers', "ジョブを同時に実行するスレッド数", JOB_MAX_WORKERS)
+    peak_rss = peak_rss_bytes()
+    if peak_rss is not None:
+        metrics_registry.set('process_peak_rss_bytes', "プロセスのメモリ使用量の最大値", peak_rss)
+    return Response(metrics_registry.render(worker=os.getpid()), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/process_result/<job_id>', methods=['GET'])
+def download_process_result(job_id):
+    """処理結果のCSVを分割して配信する（Rangeリクエストと、ブラウザが対応していればgzip圧縮に対応）"""
+    job = job_store.get(job_id)
+    if not job or job['status'] != 'completed' or not job.get('result_location'):
+        return jsonify({'error': '処理結果が見つかりません。'}), 404
+    location = job['result_location']
+    download_name = 'processed_data.csv'
+    use_gzip = (
+        'gzip' in request.headers.get('Accept-Encoding', '')
+        and not request.headers.get('Range')
+        and request.args.get('gzip', '1') != '0'
+        and location['size'] >= RESULT_GZIP_MIN_BYTES
+    )
+
+    try:
+        if location['type'] == 'local' and not use_gzip:
+            # send_fileがRange・If-Range・ETagの処理を行う
+            return send_file(location['path'], mimetype='text/csv', as_attachment=True, download_name=download_name, conditional=True, max_age=0)
+
+        headers = {'Content-Disposition': f'attachment;filename={download_name}'}
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+            return Response(iter_gzip_chunks(iter_stream_chunks(open_job_result(location))), mimetype='text/csv', headers=headers)
+
+        headers['Accept-Ranges'] = 'bytes'
+
+        # S3上の結果はRangeをそのままS3に渡して該当部分だけを取得する
+        get_object_args = {'Bucket': S3_BUCKET_NAME, 'Key': location['key']}
+        if request.headers.get('Range'):
+            get_object_args['Range'] = request.headers['Range']
+        s3_object = s3_client.get_object(**get_object_args)
+        headers['Content-Length'] = str(s3_object['ContentLength'])
+        status = 200
+        if s3_object.get('ContentRange'):
+            headers['Content-Range'] = s3_object['ContentRange']
+            status = 206
+        return Response(s3_object['Body'].iter_chunks(S3_STREAM_CHUNK_SIZE), status=status, mimetype='text/csv', headers=headers)
+    except FileNotFoundError:
+        return jsonify({'error': '処理結果の保持期間が過ぎたため、ファイルが削除されています。'}), 410
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return Response(status=416, headers={'Content-Range': f"bytes */{location['size']}"})
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return jsonify({'error': '処理結果の保持期間が過ぎたため、ファイルが削除されています。'}), 410
+        return jsonify({'error': f'処理結果の取得に失敗しました: {e}'}), 500
 
 @app.route('/api/save_latest_file', methods=['POST'])
 def save_latest_file_to_s3():
@@ -431,12 +2806,50 @@ def save_latest_file_to_s3():
     try:
         original_filename = secure_filename(file_to_save.filename)
         file_to_save.seek(0)
-        s3_client.upload_fileobj(file_to_save, S3_BUCKET_NAME, original_filename)
+        replaced_object = head_s3_object(original_filename)
+        s3_client.upload_fileobj(file_to_save.stream, S3_BUCKET_NAME, original_filename, Config=S3_TRANSFER_CONFIG)
+        # 行ハッシュインデックスとParquetのコピーには作成元のCSVの版を記録し、作り直すまでの間は古いコピーを使わせない
+        saved_object = head_s3_object(original_filename)
         s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=S3_POINTER_FILE_KEY, Body=original_filename.encode('utf-8'))
-        return jsonify({'message': f'ファイル「{original_filename}」をS3に保存しました。'})
+        message = f'ファイル「{original_filename}」をS3に保存しました。'
+        # ★★★ 日付別の一覧から参照できるよう、マニフェストに記録する ★★★
+        try:
+            record_saved_file_in_manifest(original_filename, replaced_object)
+        except Exception as e:
+            traceback.print_exc()
+            message += f'（ファイル一覧への登録には失敗しました: {e}）'
+        # ★★★ 次回の差分抽出でCSV本体を読まずに済むよう、行ハッシュインデックスも保存する ★★★
+        try:
+            row_index = save_file_to_s3_archive(original_filename, file_to_save.stream, request.form.get('diff_key_column') or None,
+                                                source_etag=saved_object['ETag'] if saved_object else None)
+        except Exception as e:
+            traceback.print_exc()
+            message += f'（行ハッシュインデックスと列指向コピーの保存には失敗しました: {e}）'
+        else:
+            # ★★★ 過去に一度でも出現した案件を判定できるよう、過去出現インデックスにも登録する ★★★
+            try:
+                record_saved_file_in_seen_ever_index(original_filename, row_index)
+            except Exception as e:
+                traceback.print_exc()
+                message += f'（過去出現インデックスへの登録には失敗しました: {e}）'
+        return jsonify({'message': message})
     except ClientError as e:
         return jsonify({'error': f'S3へのファイル保存に失敗しました: {e}'}), 500
 
+@app.route('/api/previous_file_info', methods=['GET'])
+def get_previous_file_info():
+    """前回ファイルのキーだけを返す（ファイル本体はダウンロードしない）"""
+    if not s3_client: return jsonify({'error': 'S3が設定されていません。'}), 503
+    try:
+        pointer_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_POINTER_FILE_KEY)
+        previous_filename = pointer_object['Body'].read().decode('utf-8')
+        s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=previous_filename)
+        return jsonify({'key': previous_filename})
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return jsonify({'error': 'S3に前回ファイルが見つかりませんでした。'}), 404
+        return jsonify({'error': f'S3からのファイル情報の取得に失敗しました: {e}'}), 500
+
 @app.route('/api/load_previous_file', methods=['GET'])
 def load_previous_file_from_s3():
     if not s3_client: return jsonify({'error': 'S3が設定されていません。'}), 503
@@ -444,60 +2857,347 @@ def load_previous_file_from_s3():
         pointer_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_POINTER_FILE_KEY)
         previous_filename = pointer_object['Body'].read().decode('utf-8')
         s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=previous_filename)
-        file_content = s3_object['Body'].read()
-        return Response(file_content, mimetype='text/csv', headers={'Content-Disposition': f'attachment;filename={previous_filename}'})
+        return s3_download_response(s3_object, previous_filename)
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchKey':
             return jsonify({'error': 'S3に前回ファイルが見つかりませんでした。'}), 404
         return jsonify({'error': f'S3からのファイル取得に失敗しました: {e}'}), 500
 
 # ★★★ ここからテンプレート用の新しい機能 ★★★
+# テンプレートは従来どおりS3上の1つのJSON（S3_TEMPLATES_KEY）に保存するが、
+# 解析済みの内容をメモリに保持してETagで再検証し、書き込みはテンプレート単位の変更をIfMatch付きで反映する。
+TEMPLATE_CACHE_FRESH_SECONDS = float(os.environ.get("TEMPLATE_CACHE_FRESH_SECONDS", "5"))  # この秒数内はS3への再検証を省略する
+TEMPLATE_UPDATE_RETRIES = 5
+
+class TemplateNotFoundError(Exception):
+    pass
+
+class TemplateConflictError(Exception):
+    pass
+
+def template_id_for(template):
+    """IDを持たない（この仕組みより前に保存された）テンプレートに、内容から決まるIDを割り当てる"""
+    digest = hashlib.sha256(json.dumps([template.get('name'), template.get('content')], ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def normalize_templates(templates):
+    if not isinstance(templates, list):
+        raise ValueError(f"S3上のテンプレートファイル({S3_TEMPLATES_KEY})の形式が不正です。")
+    return [
+        {**template, 'id': template.get('id') or template_id_for(template), 'version': template.get('version', 1)}
+        for template in templates if isinstance(template, dict)
+    ]
+
+class TemplateStore:
+    """S3上のテンプレートを、ETagによる条件付き取得でキャッシュするストア"""
+
+    def __init__(self):
+        self.templates = None
+        self.etag = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def _refresh(self, force=False):
+        if not force and self.templates is not None and time.time() - self.checked_at < TEMPLATE_CACHE_FRESH_SECONDS:
+            return
+        get_object_args = {'Bucket': S3_BUCKET_NAME, 'Key': S3_TEMPLATES_KEY}
+        if self.etag and self.templates is not None:
+            get_object_args['IfNoneMatch'] = self.etag
+        try:
+            s3_object = s3_client.get_object(**get_object_args)
+            templates_content = s3_object['Body'].read().decode('utf-8')
+            # ファイルが空の場合も考慮する
+            self.templates = normalize_templates(json.loads(templates_content)) if templates_content.strip() else []
+            self.etag = s3_object['ETag']
+        except ClientError as e:
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304 or e.response['Error']['Code'] in ('304', 'NotModified'):
+                pass  # キャッシュしている内容が最新
+            elif e.response['Error']['Code'] == 'NoSuchKey':
+                self.templates, self.etag = [], None  # ファイルがなければ空のリスト
+            else:
+                raise
+        self.checked_at = time.time()
+
+    def get(self):
+        """(テンプレートのリスト, ETag)を返す"""
+        with self.lock:
+            self._refresh()
+            return self.templates, self.etag
+
+    def modify(self, change):
+        """change(テンプレートのリスト)で作った新しいリストを、読み込んだ版から変わっていない場合だけ書き込む
+
+        他のワーカーが先に書き込んでいた場合は、最新の内容を読み直してchangeを適用し直す。
+        changeの戻り値は(新しいリスト, 呼び出し元に返す値)。
+        """
+        with self.lock:
+            for attempt in range(TEMPLATE_UPDATE_RETRIES):
+                self._refresh(force=attempt > 0)
+                new_templates, value = change([dict(template) for template in self.templates])
+                condition = {'IfMatch': self.etag} if self.etag else {'IfNoneMatch': '*'}
+                try:
+                    response = s3_client.put_object(
+                        Bucket=S3_BUCKET_NAME,
+                        Key=S3_TEMPLATES_KEY,
+                        Body=json.dumps(new_templates, ensure_ascii=False, indent=2).encode('utf-8'),
+                        ContentType='application/json',
+                        **condition
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                        continue
+                    raise
+                self.templates, self.etag, self.checked_at = new_templates, response['ETag'], time.time()
+                return value
+        raise TemplateConflictError("テンプレートの保存が他の更新と競合し続けたため、保存できませんでした。")
+
+template_store = TemplateStore()
+
+def find_template(templates, template_id, expected_version=None):
+    """IDでテンプレートを探し、版の指定があれば一致するか確認する"""
+    for position, template in enumerate(templates):
+        if template['id'] == template_id:
+            if expected_version is not None and template['version'] != expected_version:
+                raise TemplateConflictError(f"テンプレート「{template['name']}」は他のユーザーによって更新されています。再読み込みしてから操作してください。")
+            return position
+    raise TemplateNotFoundError("指定されたテンプレートが見つかりません。他のユーザーによって削除された可能性があります。")
+
+def template_error_response(e):
+    if isinstance(e, TemplateNotFoundError):
+        return jsonify({'error': str(e)}), 404
+    if isinstance(e, TemplateConflictError):
+        return jsonify({'error': str(e)}), 409
+    if isinstance(e, ClientError):
+        return jsonify({'error': f'S3へのテンプレート保存に失敗: {e}'}), 500
+    return jsonify({'error': str(e)}), 400
 
 @app.route('/api/templates', methods=['GET'])
 def get_templates_from_s3():
-    """S3からテンプレートファイル(JSON)を取得する"""
+    """S3からテンプレートを取得する（ETagを返し、ブラウザの条件付きリクエストには304で応答する）"""
     if not s3_client: return jsonify({'error': 'S3が設定されていません。'}), 503
     try:
-        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_TEMPLATES_KEY)
-        templates_content = s3_object['Body'].read().decode('utf-8')
-        # ファイルが空の場合も考慮する
-        if not templates_content.strip():
-            return jsonify([])
-        return jsonify(json.loads(templates_content))
+        templates, etag = template_store.get()
+        response = jsonify(templates)
+        response.set_etag((etag or 'empty').strip('"'))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            return jsonify([]) # ファイルがなければ空のリストを返す
         return jsonify({'error': f'S3からのテンプレート取得に失敗: {e}'}), 500
-    except json.JSONDecodeError:
+    except ValueError:
         # S3上のファイルが不正なJSON形式だった場合のエラー
         return jsonify({'error': f'S3上のテンプレートファイル({S3_TEMPLATES_KEY})が不正なJSON形式です。'}), 500
     except Exception as e:
         # その他の予期せぬエラー
         return jsonify({'error': f'テンプレートの読み込み中に予期せぬエラーが発生しました: {e}'}), 500
 
+def read_template_fields(data, required):
+    """リクエストからテンプレートの名前と内容を取り出す"""
+    if not isinstance(data, dict):
+        raise ValueError('保存するテンプレートデータがありません。')
+    fields = {key: data[key] for key in ('name', 'content') if isinstance(data.get(key), str)}
+    if required and not (fields.get('name') and fields.get('content')):
+        raise ValueError('テンプレート名と内容を指定してください。')
+    return fields
+
 @app.route('/api/templates', methods=['POST'])
-def save_templates_to_s3():
-    """テンプレートファイル(JSON)をS3に保存する"""
+def create_template():
+    """テンプレートを1件追加する"""
     if not s3_client: return jsonify({'error': 'S3が設定されていません。'}), 503
-    
-    templates_data = request.get_json()
-    if templates_data is None:
-        return jsonify({'error': '保存するテンプレートデータがありません。'}), 400
-        
     try:
-        # Pythonのリスト/辞書をJSON形式の文字列に変換し、S3にアップロード
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=S3_TEMPLATES_KEY,
-            Body=json.dumps(templates_data, ensure_ascii=False, indent=2).encode('utf-8'),
-            ContentType='application/json'
-        )
-        return jsonify({'message': 'テンプレートをS3に保存しました。'})
-    except ClientError as e:
-        return jsonify({'error': f'S3へのテンプレート保存に失敗: {e}'}), 500
+        fields = read_template_fields(request.get_json(silent=True), required=True)
+        template = {'id': uuid.uuid4().hex[:16], **fields, 'version': 1}
+        template_store.modify(lambda templates: (templates + [template], None))
+        return jsonify({'message': 'テンプレートをS3に保存しました。', 'template': template}), 201
+    except Exception as e:
+        return template_error_response(e)
+
+@app.route('/api/templates/<template_id>', methods=['PUT'])
+def update_template(template_id):
+    """テンプレートを1件更新する（versionを指定した場合は、その版から変わっていないときだけ更新する）"""
+    if not s3_client: return jsonify({'error': 'S3が設定されていません。'}), 503
+    try:
+        data = request.get_json(silent=True)
+        fields = read_template_fields(data, required=False)
+        expected_version = data.get('version')
+
+        def change(templates):
+            position = find_template(templates, template_id, expected_version)
+            templates[position] = {**templates[position], **fields, 'version': templates[position]['version'] + 1}
+            return templates, templates[position]
+
+        template = template_store.modify(change)
+        return jsonify({'message': 'テンプレートを更新しました。', 'template': template})
+    except Exception as e:
+        return template_error_response(e)
+
+@app.route('/api/templates/<template_id>', methods=['DELETE'])
+def delete_template(template_id):
+    """テンプレートを1件削除する（?version= を指定した場合は、その版から変わっていないときだけ削除する）"""
+    if not s3_client: return jsonify({'error': 'S3が設定されていません。'}), 503
+    try:
+        expected_version = request.args.get('version', type=int)
+
+        def change(templates):
+            position = find_template(templates, template_id, expected_version)
+            return templates[:position] + templates[position + 1:], None
+
+        template_store.modify(change)
+        return jsonify({'message': 'テンプレートを削除しました。'})
+    except Exception as e:
+        return template_error_response(e)
 
 # ★★★ ここまでテンプレート用の新しい機能 ★★★
 
+# ★★★ 保存ファイルの日付別マニフェスト ★★★
+# 保存のたびに __manifest/YYYY-MM-DD.json（日付はS3のLastModifiedと同じUTC）を条件付き書き込みで更新し、
+# 一覧はバケット全体を走査せずに該当日のマニフェストだけを読む。
+# マニフェストの記録を始めた日付を __manifest/_rollout.json に1度だけ保存し、その日以前でマニフェストがない日付
+# （この仕組みより前の保存分を含みうる日付）だけを、ページングしながら全体を走査して補う。
+# 記録を始めた日より後の日付は、マニフェストがなければその日に保存されたファイルはない。
+S3_MANIFEST_PREFIX = "__manifest/"
+S3_MANIFEST_ROLLOUT_KEY = f"{S3_MANIFEST_PREFIX}_rollout.json"
+manifest_rollout_cache = {}  # 記録を始めた日付は一度保存すると変わらないため、プロセス内で保持する
+MANIFEST_UPDATE_RETRIES = 5
+FILE_LISTING_CACHE_SECONDS = int(os.environ.get("FILE_LISTING_CACHE_SECONDS", "60"))
+bucket_listing_cache = TTLCache(maxsize=1, ttl=FILE_LISTING_CACHE_SECONDS)
+bucket_listing_lock = threading.Lock()
+
+def manifest_key(date_str):
+    return f"{S3_MANIFEST_PREFIX}{date_str}.json"
+
+def is_listable_file(key):
+    """日付別の一覧に表示するファイルか（アプリが内部で使うファイルは除く）"""
+    return key.endswith('.csv') and not key.startswith((S3_MANIFEST_PREFIX, RESULT_S3_PREFIX, BATCH_RESULT_S3_PREFIX, CHECKPOINT_S3_PREFIX))
+
+def head_s3_object(key):
+    """オブジェクトのメタデータを返す（存在しない場合はNone）"""
+    try:
+        return s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+
+def load_manifest(date_str):
+    """(ファイル一覧, ETag)を返す（マニフェストがない場合は(None, None)）"""
+    try:
+        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=manifest_key(date_str))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None, None
+        raise
+    return json.loads(s3_object['Body'].read().decode('utf-8')).get('files', []), s3_object['ETag']
+
+def load_manifest_rollout_date(create=False):
+    """マニフェストの記録を始めた日付（YYYY-MM-DD）を返す
+
+    まだ記録を始めていない場合はNoneを返す。createを指定した場合は、今日の日付で作成して返す。
+    """
+    rollout_date = manifest_rollout_cache.get('date')
+    if rollout_date is not None:
+        return rollout_date
+    try:
+        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_MANIFEST_ROLLOUT_KEY)
+        rollout_date = json.loads(s3_object['Body'].read().decode('utf-8'))['date']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        if not create:
+            return None
+        rollout_date = datetime.now(timezone.utc).date().isoformat()
+        body = json.dumps({'date': rollout_date}).encode('utf-8')
+        try:
+            s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=S3_MANIFEST_ROLLOUT_KEY, Body=body, ContentType='application/json', IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            # 他のワーカーが先に作成した日付を使う
+            return load_manifest_rollout_date()
+    manifest_rollout_cache['date'] = rollout_date
+    return rollout_date
+
+def update_manifest(date_str, update_files):
+    """マニフェストを読み込み、update_files(一覧)で更新した結果を条件付きで書き戻す
+
+    他のワーカーが同時に更新して書き込みが競合した場合は、読み込みからやり直す。
+    その日のマニフェストをまだ作っていない場合は、記録を始めた日以前の日付に限り、
+    この仕組みより前に保存された分を走査で補ってから作る。
+    """
+    rollout_date = load_manifest_rollout_date(create=True)
+    for _ in range(MANIFEST_UPDATE_RETRIES):
+        files, etag = load_manifest(date_str)
+        if files is None:
+            files = list(scan_bucket_files_by_date().get(date_str, [])) if date_str <= rollout_date else []
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        body = json.dumps({'date': date_str, 'files': update_files(files)}, ensure_ascii=False).encode('utf-8')
+        try:
+            s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=manifest_key(date_str), Body=body, ContentType='application/json', **condition)
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+    raise RuntimeError(f"マニフェスト「{manifest_key(date_str)}」の更新が競合し続けたため、登録できませんでした。")
+
+def record_saved_file_in_manifest(key, replaced_object=None):
+    """保存したファイルを保存日のマニフェストに登録する（上書き保存の場合は以前の日付から外す）"""
+    if not is_listable_file(key):
+        return
+    saved_object = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=key)
+    last_modified = saved_object['LastModified'].astimezone(timezone.utc)
+    entry = {'key': key, 'last_modified': last_modified.isoformat(), 'size': saved_object['ContentLength']}
+    update_manifest(last_modified.date().isoformat(), lambda files: [f for f in files if f['key'] != key] + [entry])
+    if replaced_object is not None:
+        replaced_date = replaced_object['LastModified'].astimezone(timezone.utc).date().isoformat()
+        if replaced_date != last_modified.date().isoformat():
+            update_manifest(replaced_date, lambda files: [f for f in files if f['key'] != key])
+    bucket_listing_cache.clear()
+
+def scan_bucket_files_by_date():
+    """バケット全体をページングしながら走査し、{日付: ファイル一覧}を返す（短時間キャッシュする）"""
+    with bucket_listing_lock:
+        files_by_date = bucket_listing_cache.get('files_by_date')
+        if files_by_date is None:
+            files_by_date = {}
+            for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET_NAME):
+                for obj in page.get('Contents', []):
+                    if not is_listable_file(obj['Key']):
+                        continue
+                    last_modified = obj['LastModified'].astimezone(timezone.utc)
+                    files_by_date.setdefault(last_modified.date().isoformat(), []).append({
+                        'key': obj['Key'],
+                        'last_modified': last_modified.isoformat(),
+                        'size': obj['Size']
+                    })
+            bucket_listing_cache['files_by_date'] = files_by_date
+        return files_by_date
+
+def backfill_manifest(date_str, files):
+    """走査で得た過去の日付の一覧をマニフェストとして保存する（既にある場合は何もしない）
+
+    保存されるファイルの日付は常に当日になるため、前日以前のマニフェストは以後変わらない。
+    """
+    if date_str >= datetime.now(timezone.utc).date().isoformat():
+        return
+    body = json.dumps({'date': date_str, 'files': files}, ensure_ascii=False).encode('utf-8')
+    try:
+        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=manifest_key(date_str), Body=body, ContentType='application/json', IfNoneMatch='*')
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+
+def list_files_for_date(date_str):
+    files, _ = load_manifest(date_str)
+    if files is None:
+        rollout_date = load_manifest_rollout_date()
+        if rollout_date is not None and date_str > rollout_date:
+            return []
+        files = scan_bucket_files_by_date().get(date_str, [])
+        try:
+            backfill_manifest(date_str, files)
+        except ClientError:
+            traceback.print_exc()
+    return files
+
 @app.route('/api/files_by_date', methods=['GET'])
 def get_files_by_date():
     """指定した日付のS3ファイル一覧を取得する"""
@@ -510,31 +3210,9 @@ def get_files_by_date():
         if not target_date:
             return jsonify({'error': '日付パラメータが指定されていません。'}), 400
         
-        # S3から全ファイルの一覧を取得
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME)
-        
-        if 'Contents' not in response:
-            return jsonify({'files': []})
-        
-        # 指定日付のファイルをフィルタリング
+        # 指定日付のマニフェストから一覧を取得（ない場合はバケットの走査で補う）
         target_date_obj = pd.to_datetime(target_date).date()
-        matching_files = []
-        
-        for obj in response['Contents']:
-            # ファイル名がCSVでない場合はスキップ
-            if not obj['Key'].endswith('.csv'):
-                continue
-            
-            # 更新日時を取得
-            last_modified = obj['LastModified'].date()
-            
-            # 指定日付と一致するファイルを抽出
-            if last_modified == target_date_obj:
-                matching_files.append({
-                    'key': obj['Key'],
-                    'last_modified': obj['LastModified'].isoformat(),
-                    'size': obj['Size']
-                })
+        matching_files = list_files_for_date(target_date_obj.isoformat())
         
         # 更新日時の新しい順にソート
         matching_files.sort(key=lambda x: x['last_modified'], reverse=True)
@@ -544,6 +3222,30 @@ def get_files_by_date():
     except Exception as e:
         return jsonify({'error': f'ファイル一覧の取得に失敗しました: {str(e)}'}), 500
 
+def load_s3_file_preview(file_key, nrows, columns=None):
+    """S3上のファイルの先頭行を読み込み、(DataFrame, 総行数またはNone)を返す
+
+    Parquetのコピーがあれば指定した列だけを読み込み、総行数もメタデータから取得する。
+    """
+    parquet_file = open_parquet_copy(file_key)
+    if parquet_file is not None:
+        if columns is not None:
+            columns = [col for col in columns if col in parquet_file.schema_arrow.names]
+        return read_parquet_head(parquet_file, nrows, columns), parquet_file.metadata.num_rows
+    file_stream = open_s3_csv_stream(file_key)
+    try:
+        for encoding in candidate_encodings(file_stream):
+            try:
+                file_stream.seek(0)
+                df = pd.read_csv(file_stream, encoding=encoding, dtype=str, nrows=nrows,
+                                 usecols=(lambda col: col in columns) if columns is not None else None)
+                return df, None
+            except UnicodeDecodeError:
+                continue
+        raise ValueError(ENCODING_ERROR_MESSAGE)
+    finally:
+        file_stream.close()
+
 @app.route('/api/load_file_by_key', methods=['GET'])
 def load_file_by_key():
     """S3のキーを指定してファイルを取得する"""
@@ -555,19 +3257,580 @@ def load_file_by_key():
         if not file_key:
             return jsonify({'error': 'ファイルキーが指定されていません。'}), 400
         
-        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=file_key)
-        file_content = s3_object['Body'].read()
+        # preview=行数 を指定した場合は、ファイル本体ではなく先頭行と列名だけをJSONで返す
+        preview_rows = request.args.get('preview', type=int)
+        if preview_rows:
+            columns = request.args.get('columns')
+            columns = [col for col in columns.split(',') if col] if columns else None
+            preview_df, row_count = load_s3_file_preview(file_key, min(preview_rows, 1000), columns)
+            return jsonify({
+                'key': file_key,
+                'columns': [str(col) for col in preview_df.columns],
+                'rowCount': row_count,
+                'previewCsv': preview_df.to_csv(index=False)
+            })
         
-        return Response(
-            file_content, 
-            mimetype='text/csv', 
-            headers={'Content-Disposition': f'attachment;filename={file_key}'}
-        )
+        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=file_key)
+        return s3_download_response(s3_object, file_key)
         
     except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
             return jsonify({'error': '指定されたファイルが見つかりませんでした。'}), 404
         return jsonify({'error': f'ファイルの取得に失敗しました: {e}'}), 500
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+# ★★★ データセットの統計プロファイル（AIチャット用） ★★★
+# 全行を1回のストリーミング読込で集計し、内容のハッシュ（データセットID）ごとにキャッシュする。
+# チャットはデータセットIDで参照するため、2回目以降の質問ではCSVの送信も解析も行わない。
+DATASET_PROFILE_VERSION = 1
+DATASET_PROFILE_CACHE_ENTRIES = int(os.environ.get("DATASET_PROFILE_CACHE_ENTRIES", "1000"))
+PROFILE_TOP_K = 10  # 列ごとに保持する頻出値の数
+PROFILE_MAX_TRACKED_VALUES = 50000  # 頻出値の集計で保持する値の上限（超えたら出現数の少ない値を捨てる近似に切り替える）
+PROFILE_DISTINCT_SKETCH_SIZE = 4096  # 異なり数の推定に使うハッシュの数（これ未満なら正確な値）
+PROFILE_RESERVOIR_SIZE = 10000  # 分位点の推定に使う標本の数
+PROFILE_TYPE_DETECTION_SHARE = 0.9  # 数値・日付の列とみなす、解釈できた値の割合
+PROFILE_SAMPLE_ROWS = 5
+dataset_profile_cache = PersistentLRUCache(AI_CACHE_DB_PATH, 'dataset_profile_cache', max_entries=DATASET_PROFILE_CACHE_ENTRIES, memory_entries=100)
+DATASET_PROFILE_CACHE_NAMESPACE = f"profile_v{DATASET_PROFILE_VERSION}"
+
+class ColumnProfiler:
+    """1列分の統計をチャンクごとに積み上げる"""
+
+    def __init__(self, name):
+        self.name = name
+        self.row_count = 0
+        self.null_count = 0
+        self.value_counts = {}
+        self.counts_truncated = False
+        self.distinct_hashes = np.array([], dtype=np.uint64)
+        self.numeric = {'count': 0, 'min': None, 'max': None, 'sum': 0.0}
+        self.numeric_sample = np.array([], dtype=float)
+        self.numeric_sample_keys = np.array([], dtype=float)
+        self.date = {'count': 0, 'min': None, 'max': None}
+        # 先頭のチャンクでほとんど解釈できなかった型は、以降のチャンクでは判定しない
+        self.check_numeric = True
+        self.check_date = True
+
+    def update(self, series):
+        self.row_count += len(series)
+        values = series.dropna()
+        self.null_count += len(series) - len(values)
+        if values.empty:
+            return
+        first_chunk = self.row_count == len(series)
+
+        for value, count in values.value_counts().items():
+            self.value_counts[value] = self.value_counts.get(value, 0) + int(count)
+        if len(self.value_counts) > PROFILE_MAX_TRACKED_VALUES:
+            keep = sorted(self.value_counts.items(), key=lambda item: item[1], reverse=True)[:PROFILE_MAX_TRACKED_VALUES // 5]
+            self.value_counts = dict(keep)
+            self.counts_truncated = True
+
+        # 異なり数は、値のハッシュの小さい方からk個だけを残して推定する（KMV法）
+        hashes = np.unique(pd.util.hash_pandas_object(values, index=False, categorize=False).to_numpy())
+        self.distinct_hashes = np.unique(np.concatenate([self.distinct_hashes, hashes]))[:PROFILE_DISTINCT_SKETCH_SIZE]
+
+        if self.check_numeric:
+            numbers = pd.to_numeric(values.str.replace(',', '', regex=False).str.strip(), errors='coerce').dropna()
+            if first_chunk and len(numbers) < len(values) * PROFILE_TYPE_DETECTION_SHARE:
+                self.check_numeric = False
+            elif not numbers.empty:
+                self.numeric['count'] += len(numbers)
+                self.numeric['sum'] += float(numbers.sum())
+                self.numeric['min'] = float(numbers.min()) if self.numeric['min'] is None else min(self.numeric['min'], float(numbers.min()))
+                self.numeric['max'] = float(numbers.max()) if self.numeric['max'] is None else max(self.numeric['max'], float(numbers.max()))
+                # 乱数のキーが小さい順にk個を残すことで、全行からの一様な標本にする
+                keys = np.concatenate([self.numeric_sample_keys, np.random.random(len(numbers))])
+                sample = np.concatenate([self.numeric_sample, numbers.to_numpy(dtype=float)])
+                if len(sample) > PROFILE_RESERVOIR_SIZE:
+                    keep = np.argpartition(keys, PROFILE_RESERVOIR_SIZE)[:PROFILE_RESERVOIR_SIZE]
+                    keys, sample = keys[keep], sample[keep]
+                self.numeric_sample_keys, self.numeric_sample = keys, sample
+
+        if self.check_date:
+            dates = normalize_japanese_dates(values).dropna()
+            if first_chunk and len(dates) < len(values) * PROFILE_TYPE_DETECTION_SHARE:
+                self.check_date = False
+            elif not dates.empty:
+                self.date['count'] += len(dates)
+                self.date['min'] = dates.min() if self.date['min'] is None else min(self.date['min'], dates.min())
+                self.date['max'] = dates.max() if self.date['max'] is None else max(self.date['max'], dates.max())
+
+    def result(self):
+        non_null = self.row_count - self.null_count
+        if len(self.distinct_hashes) < PROFILE_DISTINCT_SKETCH_SIZE:
+            distinct, distinct_approx = len(self.distinct_hashes), False
+        else:
+            kth_hash = float(self.distinct_hashes[-1]) / float(np.iinfo(np.uint64).max)
+            distinct, distinct_approx = int((PROFILE_DISTINCT_SKETCH_SIZE - 1) / kth_hash), True
+        top = sorted(self.value_counts.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP_K]
+        profile = {
+            'name': self.name,
+            'nonNull': non_null,
+            'nullRate': round(self.null_count / self.row_count, 4) if self.row_count else 0.0,
+            'distinct': distinct,
+            'distinctApprox': distinct_approx,
+            'top': [[value, count] for value, count in top],
+            'topApprox': self.counts_truncated,
+        }
+        if self.check_numeric and non_null and self.numeric['count'] >= non_null * PROFILE_TYPE_DETECTION_SHARE:
+            quantiles = np.quantile(self.numeric_sample, [0.05, 0.25, 0.5, 0.75, 0.95]) if len(self.numeric_sample) else []
+            profile['numeric'] = {
+                'count': self.numeric['count'],
+                'min': self.numeric['min'],
+                'max': self.numeric['max'],
+                'mean': self.numeric['sum'] / self.numeric['count'],
+                'quantiles': dict(zip(['p05', 'p25', 'p50', 'p75', 'p95'], [float(q) for q in quantiles])),
+                'quantilesApprox': self.numeric['count'] > len(self.numeric_sample),
+            }
+        if self.check_date and non_null and self.date['count'] >= non_null * PROFILE_TYPE_DETECTION_SHARE:
+            profile['date'] = dict(self.date)
+        return profile
+
+def build_dataset_profile(dataset_id, chunks, source):
+    """DataFrameのチャンク（値はすべて文字列）から全行の統計プロファイルを作る"""
+    profilers = None
+    row_count = 0
+    sample = None
+    for chunk in chunks:
+        if profilers is None:
+            profilers = [ColumnProfiler(str(column)) for column in chunk.columns]
+            sample = chunk.head(PROFILE_SAMPLE_ROWS)
+        row_count += len(chunk)
+        for profiler, column in zip(profilers, chunk.columns):
+            profiler.update(chunk[column])
+    return {
+        'datasetId': dataset_id,
+        'rowCount': row_count,
+        'columns': [profiler.result() for profiler in profilers or []],
+        'sampleCsv': sample.to_csv(index=False) if sample is not None else '',
+        'source': source,
+        'createdAt': datetime.now().isoformat(),
+    }
+
+def get_dataset_profile(dataset_id):
+    cached = dataset_profile_cache.get_many(DATASET_PROFILE_CACHE_NAMESPACE, [dataset_id]).get(dataset_id)
+    return json.loads(cached) if cached else None
+
+def ensure_dataset_profile(dataset_id, build_profile, source=None):
+    """キャッシュにあるプロファイルを返し、なければbuild_profile()で作成してキャッシュする
+
+    sourceを渡すと、キャッシュにあるプロファイル（同じ内容の別のジョブで作成したものなど）の読み込み元をsourceに置き換える。
+    """
+    profile = get_dataset_profile(dataset_id)
+    if profile is None:
+        profile = build_profile()
+    elif source is None or profile['source'] == source:
+        return profile
+    else:
+        profile['source'] = source
+    dataset_profile_cache.set_many(DATASET_PROFILE_CACHE_NAMESPACE, {dataset_id: json.dumps(profile, ensure_ascii=False, default=str)})
+    return profile
+
+def build_profile_from_csv_stream(dataset_id, file_stream, source):
+    """文字コードを判定しながらCSVを集計する（途中でデコードに失敗した場合は次の候補で集計し直す）"""
+    for encoding in candidate_encodings(file_stream):
+        try:
+            # 後で同じデータを読み直すときのため、読み切れた文字コードを記録しておく
+            return build_dataset_profile(dataset_id, iter_csv_chunks(file_stream, encoding), {**source, 'encoding': encoding})
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(ENCODING_ERROR_MESSAGE)
+
+def profile_job_result(job_id):
+    job = job_store.get(job_id)
+    if not job or not job.get('result_location'):
+        raise LookupError('分析対象の処理結果が見つかりません。')
+    location = job['result_location']
+    source = {'type': 'job', 'job_id': job_id}
+
+    def build_profile():
+        result_stream = open_job_result(location)
+        try:
+            return build_dataset_profile(location['sha256'], iter_csv_chunks(result_stream, 'utf-8-sig'), source)
+        finally:
+            result_stream.close()
+    # 同じ内容の結果は、最初に作成したジョブの保持期間が過ぎても読めるよう、指定されたジョブから読み込む
+    return ensure_dataset_profile(location['sha256'], build_profile, source)
+
+def profile_s3_file(file_key):
+    if not s3_client:
+        raise LookupError('S3が設定されていません。')
+    head = head_s3_object(file_key)
+    if head is None:
+        raise LookupError('指定されたファイルが見つかりませんでした。')
+    # S3のファイルは本体を読まずに済むよう、キーとETag（内容が変われば変わる）からIDを作る
+    dataset_id = hashlib.sha256(f"s3\n{file_key}\n{head['ETag']}".encode('utf-8')).hexdigest()
+    source = {'type': 's3', 'key': file_key, 'etag': head['ETag']}
+
+    def build_profile():
+        parquet_file = open_parquet_copy(file_key, head['ETag'])
+        if parquet_file is not None:
+            return build_dataset_profile(dataset_id, iter_parquet_chunks(parquet_file), source)
+        file_stream = open_s3_csv_stream(file_key)
+        try:
+            return build_profile_from_csv_stream(dataset_id, file_stream, source)
+        finally:
+            file_stream.close()
+    return ensure_dataset_profile(dataset_id, build_profile)
+
+def profile_uploaded_csv(file_stream):
+    digest = hashlib.sha256()
+    file_stream.seek(0)
+    for chunk in iter(lambda: file_stream.read(RESULT_DOWNLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    dataset_id = digest.hexdigest()
+    # チャットの集計で全行を読み直せるよう、アップロードされたCSVも処理結果と同じ場所に保持する
+    os.makedirs(RESULT_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(RESULT_SPOOL_DIR, f"dataset_{dataset_id}.csv")
+    if not os.path.exists(path):
+        file_stream.seek(0)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            for chunk in iter(lambda: file_stream.read(RESULT_DOWNLOAD_CHUNK_SIZE), b''):
+                f.write(chunk)
+        os.replace(temp_path, path)
+    return ensure_dataset_profile(dataset_id, lambda: build_profile_from_csv_stream(dataset_id, file_stream, {'type': 'upload', 'path': path}))
+
+def public_dataset_profile(profile):
+    return {key: value for key, value in profile.items() if key != 'source'}
+
+def format_dataset_profile(profile, max_columns=50):
+    """AIに渡すための、プロファイルの文章表現"""
+    lines = []
+    for column in profile['columns'][:max_columns]:
+        distinct = f"約{column['distinct']}" if column['distinctApprox'] else f"{column['distinct']}"
+        line = f"- {column['name']}: 欠損率 {column['nullRate']:.1%}, 異なり数 {distinct}"
+        if 'numeric' in column:
+            numeric = column['numeric']
+            quantiles = ', '.join(f"{name}={value:.6g}" for name, value in numeric['quantiles'].items())
+            line += f", 数値 最小 {numeric['min']:.6g} / 最大 {numeric['max']:.6g} / 平均 {numeric['mean']:.6g}, 分位点 {quantiles}"
+        if 'date' in column:
+            line += f", 日付 {column['date']['min']} 〜 {column['date']['max']}"
+        if column['top'] and ('numeric' not in column or column['distinct'] <= PROFILE_TOP_K):
+            top_values = ', '.join(f"{str(value)[:30]}({count})" for value, count in column['top'][:5])
+            line += f", 頻出値 {top_values}"
+        lines.append(line)
+    if len(profile['columns']) > max_columns:
+        lines.append(f"- ...他 {len(profile['columns']) - max_columns} 列")
+    return '\n'.join(lines)
+
+@app.route('/api/datasets', methods=['POST'])
+def register_dataset():
+    """分析対象のデータを登録し、全行の統計プロファイルを作成してデータセットIDを返す
+
+    処理結果（job_id）、S3上のファイル（file_key）、アップロードしたCSV（file）のいずれかを指定する。
+    """
+    try:
+        uploaded_file = request.files.get('file')
+        data = request.get_json(silent=True) or {}
+        if uploaded_file:
+            profile = profile_uploaded_csv(uploaded_file.stream)
+        elif data.get('job_id'):
+            profile = profile_job_result(data['job_id'])
+        elif data.get('file_key'):
+            profile = profile_s3_file(data['file_key'])
+        else:
+            return jsonify({'error': '分析対象のCSVデータが見つかりません。'}), 400
+        return jsonify(public_dataset_profile(profile))
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'データの集計中にエラーが発生しました: {str(e)}'}), 500
+
+@app.route('/api/datasets/<dataset_id>', methods=['GET'])
+def get_dataset(dataset_id):
+    profile = get_dataset_profile(dataset_id)
+    if profile is None:
+        return jsonify({'error': 'データセットが見つかりません。再度登録してください。'}), 404
+    return jsonify(public_dataset_profile(profile))
+
+# ★★★ チャットの質問をローカルで集計する（AIはクエリプランだけを作る） ★★★
+# 件数や最新日付のような集計の質問は、AIに推測させずにJSONのクエリプランを作らせ、
+# サーバーが全行に対してpandasで実行した正確な結果から回答を作る。
+AI_CHAT_LOCAL_QUERY = os.environ.get("AI_CHAT_LOCAL_QUERY", "on") == "on"
+QUERY_MAX_RESULT_ROWS = 50
+QUERY_MAX_GROUP_BY = 3
+QUERY_MAX_AGGREGATES = 5
+QUERY_FILTER_OPS = {'==', '!=', '>', '>=', '<', '<=', 'contains', 'in', 'isnull', 'notnull'}
+QUERY_AGGREGATE_FUNCS = {'count', 'sum', 'mean', 'min', 'max', 'nunique'}
+
+def column_kinds(profile):
+    """プロファイルから各列の型（numeric / date / text）を決める"""
+    return {
+        column['name']: 'numeric' if 'numeric' in column else 'date' if 'date' in column else 'text'
+        for column in profile['columns']
+    }
+
+def build_query_plan_prompt(profile, user_question):
+    kinds = column_kinds(profile)
+    column_lines = []
+    for column in profile['columns']:
+        examples = ', '.join(str(value)[:30] for value, _ in column['top'][:5])
+        column_lines.append(f"- {column['name']} （型: {kinds[column['name']]}, 例: {examples}）")
+    column_text = '\n'.join(column_lines)
+    return f"""
+# あなたのタスク
+あなたは、CSVデータへの質問を、サーバーで実行する集計のクエリプラン（JSON）に変換する専門AIです。
+データそのものは渡しません。列の情報だけを使って、質問に正確に答えるためのクエリプランを作成してください。
+
+# データの情報
+- 総行数: {profile['rowCount']}行
+- 列:
+{column_text}
+
+# ユーザーからの質問
+{user_question}
+
+# クエリプランの形式
+{{
+  "answerable": true,
+  "filters": [{{"column": "列名", "op": "== | != | > | >= | < | <= | contains | in | isnull | notnull", "value": "比較する値（inの場合は配列）"}}],
+  "group_by": ["列名"],
+  "aggregates": [{{"column": "列名（countで行数を数える場合はnull）", "func": "count | sum | mean | min | max | nunique", "as": "結果の列名"}}],
+  "select": ["列名"],
+  "sort": {{"by": "列名または結果の列名", "desc": true}},
+  "limit": 10
+}}
+
+# 絶対的なルール
+- 列名は「データの情報」に書かれたものだけを、そのまま使ってください。
+- 集計する場合は "aggregates" を、該当する行そのものを一覧する場合は "select" を指定してください。
+- 日付型の列の比較やmin/maxは「YYYY-MM-DD」形式の値で行われます。最新の日付はmaxで求めてください。
+- 集計では答えられない質問（傾向の解釈や要約など）の場合は、{{"answerable": false}} だけを返してください。
+- 出力はJSONオブジェクトを一つだけ返し、説明やマークダウンは含めないでください。
+"""
+
+def parse_query_plan_response(raw_response):
+    cleaned_response = raw_response.strip().replace("```json", "").replace("```", "").strip()
+    start_index = cleaned_response.find('{')
+    end_index = cleaned_response.rfind('}')
+    if start_index == -1 or end_index < start_index:
+        raise ValueError("クエリプランのJSONが見つかりませんでした。")
+    return json.loads(cleaned_response[start_index:end_index+1])
+
+def validate_query_plan(plan, profile):
+    """AIが作ったクエリプランを検証し、実行できる形に整えて返す（答えられない質問の場合はNone）"""
+    if not isinstance(plan, dict):
+        raise ValueError("クエリプランの形式が不正です。")
+    if not plan.get('answerable', True):
+        return None
+    columns = set(column_kinds(profile))
+
+    def check_column(name):
+        if name not in columns:
+            raise ValueError(f"クエリプランに存在しない列「{name}」が含まれています。")
+        return name
+
+    filters = []
+    for item in plan.get('filters') or []:
+        if not isinstance(item, dict) or item.get('op') not in QUERY_FILTER_OPS:
+            raise ValueError(f"クエリプランの条件が不正です: {item}")
+        value = item.get('value')
+        if item['op'] == 'in':
+            value = [str(v) for v in (value if isinstance(value, list) else [value])]
+        elif item['op'] not in ('isnull', 'notnull'):
+            if value is None or isinstance(value, (list, dict)):
+                raise ValueError(f"クエリプランの条件の値が不正です: {item}")
+            value = str(value)
+        filters.append({'column': check_column(item.get('column')), 'op': item['op'], 'value': value})
+
+    group_by = [check_column(name) for name in plan.get('group_by') or []]
+    if len(group_by) > QUERY_MAX_GROUP_BY:
+        raise ValueError("クエリプランのグループ化の列が多すぎます。")
+
+    aggregates = []
+    for position, item in enumerate(plan.get('aggregates') or []):
+        if not isinstance(item, dict) or item.get('func') not in QUERY_AGGREGATE_FUNCS:
+            raise ValueError(f"クエリプランの集計が不正です: {item}")
+        column = item.get('column')
+        if column is None and item['func'] != 'count':
+            raise ValueError(f"クエリプランの集計に列が指定されていません: {item}")
+        aggregates.append({
+            'column': check_column(column) if column is not None else None,
+            'func': item['func'],
+            'as': str(item.get('as') or f"{item['func']}_{column or 'rows'}_{position}"),
+        })
+    if len(aggregates) > QUERY_MAX_AGGREGATES:
+        raise ValueError("クエリプランの集計が多すぎます。")
+    if group_by and not aggregates:
+        aggregates.append({'column': None, 'func': 'count', 'as': '件数'})
+
+    select = [check_column(name) for name in plan.get('select') or []] if not aggregates else []
+    output_columns = group_by + [aggregate['as'] for aggregate in aggregates] if aggregates else (select or sorted(columns))
+    sort = plan.get('sort') if isinstance(plan.get('sort'), dict) else None
+    if sort is not None:
+        # 集計結果は結果の列で、一覧は（selectにない列も含め）データの列で並べ替える
+        if sort.get('by') not in (output_columns if aggregates else columns):
+            raise ValueError(f"クエリプランの並べ替えの列「{sort.get('by')}」が不正です。")
+        sort = {'by': sort['by'], 'desc': bool(sort.get('desc', False))}
+    try:
+        limit = int(plan.get('limit') or QUERY_MAX_RESULT_ROWS)
+    except (TypeError, ValueError):
+        limit = QUERY_MAX_RESULT_ROWS
+    return {
+        'filters': filters,
+        'group_by': group_by,
+        'aggregates': aggregates,
+        'select': select,
+        'sort': sort,
+        'limit': max(1, min(limit, QUERY_MAX_RESULT_ROWS)),
+    }
+
+def query_plan_columns(plan, profile):
+    """クエリプランの実行に必要な列（データの読み込みをこの列だけに絞る）"""
+    needed = [item['column'] for item in plan['filters']] + plan['group_by'] + plan['select']
+    needed += [item['column'] for item in plan['aggregates'] if item['column'] is not None]
+    if plan['sort'] and plan['sort']['by'] in column_kinds(profile):
+        needed.append(plan['sort']['by'])
+    if not plan['aggregates'] and not plan['select']:
+        needed += [column['name'] for column in profile['columns']]
+    return list(dict.fromkeys(needed))
+
+def typed_values(series, kind):
+    """文字列の列を比較・集計用の値に変換する（数値は桁区切りを除いて数値に、日付はYYYY-MM-DDに）"""
+    if kind == 'numeric':
+        return pd.to_numeric(series.str.replace(',', '', regex=False).str.strip(), errors='coerce')
+    if kind == 'date':
+        return normalize_japanese_dates(series)
+    return series
+
+def typed_value(value, kind):
+    return typed_values(pd.Series([value], dtype=object), kind).iloc[0]
+
+def query_filter_mask(chunk, item, kind):
+    series = chunk[item['column']]
+    op, value = item['op'], item['value']
+    if op == 'isnull':
+        return series.isna()
+    if op == 'notnull':
+        return series.notna()
+    if op == 'contains':
+        return series.str.contains(value, regex=False, na=False)
+    if op == 'in':
+        return series.isin(value)
+    if op in ('==', '!=') and kind == 'text':
+        mask = series == value
+        return mask if op == '==' else ~mask & series.notna()
+    values = typed_values(series, kind)
+    target = typed_value(value, kind)
+    if pd.isna(target):
+        raise ValueError(f"条件の値「{value}」を列「{item['column']}」の型として解釈できません。")
+    comparisons = {'==': values == target, '!=': values != target, '>': values > target,
+                   '>=': values >= target, '<': values < target, '<=': values <= target}
+    return comparisons[op].fillna(False) & values.notna()
+
+def run_query_plan(plan, profile, chunks):
+    """クエリプランを全行に実行し、(結果のDataFrame, 条件に合致した行数)を返す"""
+    kinds = column_kinds(profile)
+    matched_rows = 0
+    kept = []
+    for chunk in chunks:
+        mask = pd.Series(True, index=chunk.index)
+        for item in plan['filters']:
+            mask &= query_filter_mask(chunk, item, kinds[item['column']])
+        chunk = chunk[mask]
+        matched_rows += len(chunk)
+        if not plan['aggregates'] and plan['sort'] is None:
+            # 並べ替えのない一覧は、必要な行数が集まった時点で残りを保持しない
+            chunk = chunk.head(plan['limit'] - sum(len(part) for part in kept))
+        kept.append(chunk)
+    df = pd.concat(kept) if kept else pd.DataFrame(columns=query_plan_columns(plan, profile))
+
+    if plan['aggregates']:
+        values = {}
+        for item in plan['aggregates']:
+            if item['column'] is None:
+                continue
+            kind = kinds[item['column']] if item['func'] in ('sum', 'mean', 'min', 'max') else 'text'
+            if item['func'] in ('sum', 'mean') and kind != 'numeric':
+                raise ValueError(f"列「{item['column']}」は数値ではないため、{item['func']}で集計できません。")
+            values[item['as']] = typed_values(df[item['column']], kind)
+        frame = pd.DataFrame({name: df[name] for name in plan['group_by']}, index=df.index).assign(**values)
+        aggregations = {
+            item['as']: (item['as'], item['func']) if item['column'] is not None else (None, 'size')
+            for item in plan['aggregates']
+        }
+        if plan['group_by']:
+            grouped = frame.groupby(plan['group_by'], dropna=False)
+            result = grouped.size().rename('__size').to_frame()
+            for name, (source, func) in aggregations.items():
+                result[name] = result['__size'] if func == 'size' else grouped[source].agg(func)
+            result = result.drop(columns='__size').reset_index()
+        else:
+            result = pd.DataFrame([{
+                name: len(frame) if func == 'size' else frame[source].agg(func)
+                for name, (source, func) in aggregations.items()
+            }])
+        if plan['sort']:
+            result = result.sort_values(plan['sort']['by'], ascending=not plan['sort']['desc'], na_position='last')
+    else:
+        if plan['sort']:
+            # selectに含まれない列で並べ替える場合もあるため、列を絞り込む前に並べ替える
+            by = plan['sort']['by']
+            df = df.sort_values(by, ascending=not plan['sort']['desc'], key=lambda s: typed_values(s, kinds[by]), na_position='last')
+        result = df[plan['select']] if plan['select'] else df
+    return result.head(plan['limit']), matched_rows
+
+def iter_dataset_chunks(profile, columns):
+    """データセットの全行を、指定した列だけチャンクで読み込む"""
+    source = profile['source']
+    if source['type'] == 'job':
+        job = job_store.get(source['job_id'])
+        if not job or not job.get('result_location'):
+            raise LookupError('分析対象の処理結果の保持期間が過ぎています。')
+        stream, encoding = open_job_result(job['result_location']), 'utf-8-sig'
+    elif source['type'] == 's3':
+        head = head_s3_object(source['key'])
+        if head is None or head['ETag'] != source['etag']:
+            raise LookupError('分析対象のファイルが更新または削除されています。')
+        parquet_file = open_parquet_copy(source['key'], source['etag'])
+        if parquet_file is not None:
+            yield from iter_parquet_chunks(parquet_file, columns)
+            return
+        stream, encoding = open_s3_csv_stream(source['key']), source['encoding']
+    else:
+        if not os.path.exists(source.get('path', '')):
+            raise LookupError('分析対象のファイルの保持期間が過ぎています。')
+        stream, encoding = open(source['path'], 'rb'), source['encoding']
+    try:
+        yield from iter_csv_chunks(stream, encoding, usecols=columns)
+    finally:
+        stream.close()
+
+def answer_with_local_query(profile, user_question):
+    """AIにクエリプランを作らせてローカルで実行し、(プラン, 結果, 合致行数)を返す（集計で答えられない場合はNone）"""
+    response = model.generate_content(build_query_plan_prompt(profile, user_question),
+                                      generation_config=genai.types.GenerationConfig(temperature=0, response_mime_type='application/json'),
+                                      safety_settings=AI_FILTER_SAFETY_SETTINGS)
+    plan = validate_query_plan(parse_query_plan_response(response.text), profile)
+    if plan is None:
+        return None
+    result, matched_rows = run_query_plan(plan, profile, iter_dataset_chunks(profile, query_plan_columns(plan, profile)))
+    return plan, result, matched_rows
+
+def build_query_answer_prompt(user_question, plan, result, matched_rows):
+    return f"""あなたは優秀なデータアナリストです。ユーザーの質問に対して、サーバーで全行を集計した正確な結果が得られています。
+この結果だけを根拠に、質問に簡潔かつ的確に答えてください。結果にない数値を推測で補わないでください。
+
+# ユーザーからの質問:
+{user_question}
+
+# 実行した集計:
+{json.dumps(plan, ensure_ascii=False)}
+
+# 集計結果（条件に合致した行数: {matched_rows}行、表示は最大{QUERY_MAX_RESULT_ROWS}行）:
+```text
+{result.to_string(index=False, max_colwidth=50) if not result.empty else '（該当なし）'}
+```
+
+# 回答:
+表形式での回答が適切と判断した場合は、マークダウン形式のテーブルを使用してください。
+"""
 
 @app.route('/api/chat', methods=['POST'])
 def chat_with_ai():
@@ -575,42 +3838,52 @@ def chat_with_ai():
     data = request.get_json()
     if not data: return jsonify({'error': 'リクエストデータが不正です。'}), 400
     user_question = data.get('question')
-    csv_content_string = data.get('csv_content')
     if not user_question: return jsonify({'error': '質問が入力されていません。'}), 400
-    if not csv_content_string: return jsonify({'error': '分析対象のCSVデータが見つかりません。'}), 400
     
     try:
-        df = pd.read_csv(io.StringIO(csv_content_string))
-        
-        # データサイズを制限してトークン数を削減
-        max_rows = 1000  # 最大1000行まで
-        max_cols = 20    # 最大20列まで
+        # 統計は全行を集計したプロファイルを使う（データセットIDがあれば、キャッシュ済みのものを再利用する）
+        if data.get('dataset_id'):
+            profile = get_dataset_profile(data['dataset_id'])
+            if profile is None:
+                return jsonify({'error': 'データセットが見つかりません。再度登録してください。'}), 404
+        elif data.get('job_id'):
+            profile = profile_job_result(data['job_id'])
+        elif data.get('file_key'):
+            profile = profile_s3_file(data['file_key'])
+        elif data.get('csv_content'):
+            profile = profile_uploaded_csv(io.BytesIO(data['csv_content'].encode('utf-8')))
+        else:
+            return jsonify({'error': '分析対象のCSVデータが見つかりません。'}), 400
         
-        if len(df) > max_rows:
-            df = df.head(max_rows)
-        
-        if len(df.columns) > max_cols:
-            df = df.iloc[:, :max_cols]
-        
-        # データの基本情報を取得
-        total_rows = len(df)
-        total_cols = len(df.columns)
-        column_names = list(df.columns)
-        
-        # サンプルデータ（最初の5行）を取得
-        sample_data = df.head(5).to_string(index=False, max_cols=10, max_colwidth=50)
-        
-        # 統計情報を取得
-        numeric_columns = df.select_dtypes(include=['number']).columns.tolist()
-        stats_info = ""
-        if numeric_columns:
-            stats_info = f"\n数値列の統計情報:\n{df[numeric_columns].describe().to_string()}"
+        # 集計で答えられる質問は、全行をローカルで集計した結果から回答する
+        if AI_CHAT_LOCAL_QUERY:
+            try:
+                local_answer = answer_with_local_query(profile, user_question)
+            except Exception as e:
+                print(f"クエリプランの実行に失敗したため、統計情報から回答します: {e}")
+                local_answer = None
+            if local_answer is not None:
+                plan, result, matched_rows = local_answer
+                response = model.generate_content(
+                    build_query_answer_prompt(user_question, plan, result, matched_rows),
+                    generation_config=genai.types.GenerationConfig(temperature=0.3, max_output_tokens=2048)
+                )
+                return jsonify({
+                    'reply': response.text,
+                    'datasetId': profile['datasetId'],
+                    'queryPlan': plan,
+                    'matchedRows': matched_rows,
+                })
+
+        sample_df = pd.read_csv(io.StringIO(profile['sampleCsv']), dtype=str) if profile['sampleCsv'].strip() else pd.DataFrame()
+        sample_data = sample_df.to_string(index=False, max_cols=10, max_colwidth=50)
+        column_names = [column['name'] for column in profile['columns']]
         
         prompt = f"""あなたは優秀なデータアナリストです。以下のCSVデータの内容を分析し、ユーザーからの質問に簡潔かつ的確に答えてください。
 
 # データの基本情報:
-- 総行数: {total_rows}行
-- 総列数: {total_cols}列
+- 総行数: {profile['rowCount']}行
+- 総列数: {len(column_names)}列
 - 列名: {', '.join(column_names)}
 
 # サンプルデータ（最初の5行）:
@@ -618,14 +3891,14 @@ def chat_with_ai():
 {sample_data}
 ```
 
-# 統計情報:
-{stats_info}
+# 列ごとの統計情報（全行を集計。「約」は推定値）:
+{format_dataset_profile(profile)}
 
 # ユーザーからの質問:
 {user_question}
 
 # 回答:
-データサイズが大きいため、サンプルデータと統計情報を基に回答します。表形式での回答が適切と判断した場合は、マークダウン形式のテーブルを使用してください。
+サンプルデータと全行の統計情報を基に回答します。表形式での回答が適切と判断した場合は、マークダウン形式のテーブルを使用してください。
 """
         
         # トークン数を制限するための設定
@@ -635,8 +3908,10 @@ def chat_with_ai():
         )
         
         response = model.generate_content(prompt, generation_config=generation_config)
-        return jsonify({'reply': response.text})
+        return jsonify({'reply': response.text, 'datasetId': profile['datasetId']})
         
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         traceback.print_exc()
         return jsonify({'error': f'AIとの対話中にエラーが発生しました: {str(e)}'}), 500
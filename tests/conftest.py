@@ -0,0 +1,12 @@
+import os
+import sys
+
+# main.pyはリポジトリ直下にあるため、パスに追加して読み込む
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# .envの実際の接続情報は使わない（テストはGeminiとS3に接続しない）
+for name in ('GEMINI_API_KEY', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'S3_BUCKET_NAME'):
+    os.environ[name] = ''
+
+# ジョブの記録は共有ストア（一時ディレクトリのSQLite）ではなく、テストのプロセス内だけに保持する
+os.environ['JOB_STORE_BACKEND'] = 'memory'
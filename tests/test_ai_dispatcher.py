@@ -0,0 +1,79 @@
+import random
+import threading
+import time
+
+import main
+
+
+def make_dispatcher(max_workers=4, max_retries=1):
+    return main.AIBatchDispatcher(max_workers=max_workers, requests_per_minute=60 * 10000, max_retries=max_retries, backoff_seconds=0)
+
+
+class StubModel:
+    """バッチをそのまま返すモデルの代わり（呼び出し回数と、失敗させるバッチの条件を持つ）"""
+
+    def __init__(self, fails=lambda batch: False, delay=0.0):
+        self.fails = fails
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self.lock:
+            self.calls.append(list(batch))
+        time.sleep(self.delay() if callable(self.delay) else self.delay)
+        if self.fails(batch):
+            raise RuntimeError("応答のJSONが不正です")
+        return list(batch)
+
+
+def test_results_come_back_in_input_order():
+    rng = random.Random(0)
+    model = StubModel(delay=lambda: rng.uniform(0, 0.01))
+    items = list(range(100))
+    outcomes = make_dispatcher().map_batches(items, model, batch_size=7)
+    assert [outcome['start'] for outcome in outcomes] == sorted(outcome['start'] for outcome in outcomes)
+    assert [item for outcome in outcomes for item in outcome['result']] == items
+    assert all(outcome['error'] is None and outcome['retries'] == 0 for outcome in outcomes)
+
+
+def test_failed_batch_is_split_and_retried_once():
+    model = StubModel(fails=lambda batch: len(batch) > 4)
+    items = list(range(8))
+    outcomes = make_dispatcher(max_retries=1).map_batches(items, model, batch_size=8)
+    assert [outcome['items'] for outcome in outcomes] == [items[:4], items[4:]]
+    assert [item for outcome in outcomes for item in outcome['result']] == items
+    # 分割前の2回の呼び出し（初回と再試行）は前半のバッチの再試行回数に含まれる
+    assert [outcome['retries'] for outcome in outcomes] == [2, 0]
+    assert sum(1 + outcome['retries'] for outcome in outcomes) == len(model.calls) == 4
+
+
+def test_split_halves_are_not_split_again():
+    model = StubModel(fails=lambda batch: len(batch) > 2)
+    outcomes = make_dispatcher(max_retries=0).map_batches(list(range(8)), model, batch_size=8)
+    assert [len(outcome['items']) for outcome in outcomes] == [4, 4]
+    assert all(isinstance(outcome['error'], RuntimeError) for outcome in outcomes)
+    assert sum(1 + outcome['retries'] for outcome in outcomes) == len(model.calls) == 3
+
+
+def test_batch_size_grows_when_responses_are_fast():
+    model = StubModel()
+    make_dispatcher(max_workers=1).map_batches(list(range(200)), model, batch_size=4, max_batch_size=16, target_seconds=10)
+    sizes = [len(batch) for batch in model.calls]
+    assert sizes[:5] == [4, 5, 6, 7, 8]
+    assert max(sizes) == 16
+
+
+def test_batch_size_shrinks_when_responses_are_slow():
+    model = StubModel(delay=0.02)
+    make_dispatcher(max_workers=1).map_batches(list(range(40)), model, batch_size=16, min_batch_size=2, target_seconds=0.01)
+    assert [len(batch) for batch in model.calls][:4] == [16, 8, 4, 2]
+
+
+def test_token_bucket_holds_the_rate_limit():
+    bucket = main.TokenBucket(rate_per_second=50, capacity=2)
+    started = time.monotonic()
+    for _ in range(12):
+        bucket.acquire()
+    # 最初の2つはバケットに残っているトークンで、残りの10は毎秒50の補充を待つ
+    assert time.monotonic() - started >= 10 / 50 * 0.9
@@ -0,0 +1,64 @@
+import io
+import itertools
+
+import pandas as pd
+import pytest
+
+import main
+
+
+def make_chunk():
+    return pd.DataFrame({
+        'id': ['1', '2', '3', '4', '5', '6', '7', None],
+        'name': ['apple pie', 'apple', 'banana', 'apple tart', 'cherry', 'apple', None, 'apple'],
+        'date': ['2025/07/01', '2025-07-05', '2025/06/01', 'abc', '2025-08-01', None, '2025-09-01', '2025/07/10'],
+        'due': ['2025-07-20', '2025/07/02', '2025-07-30', '2025-07-30', '2025/06/30', '2025-07-30', '2025-07-30', '2025-07-31'],
+    })
+
+
+def build_pipeline(form_data, diff_index=None):
+    chunk = make_chunk()
+    keywords = [kw for kw in (form_data.get('keywords') or '').splitlines() if kw]
+    matcher = main.KeywordMatcher(keywords, search_type=form_data.get('search_type')) if keywords else None
+    return main.build_filter_pipeline(form_data, list(chunk.columns), diff_index, matcher)
+
+
+def run_in_order(pipeline, names):
+    order = [pipeline.stage(name) for name in names]
+    pipeline.reset()
+    pipeline.ordered = lambda: order
+    return pipeline.run_chunk(make_chunk())
+
+
+def test_mixed_date_formats_do_not_depend_on_predicate_order():
+    form_data = {'filter_date_column_1': 'date', 'filter_date_value_1': '2025-07-01',
+                 'keyword_column': 'name', 'keywords': 'apple', 'search_type': 'OR'}
+    date_first = run_in_order(build_pipeline(form_data), ['①', 'keyword'])
+    keyword_first = run_in_order(build_pipeline(form_data), ['keyword', '①'])
+    pd.testing.assert_frame_equal(date_first, keyword_first)
+    # 「2025/07/01」と「2025-07-05」のどちらも日付として解釈される
+    assert date_first['id'].tolist() == ['1', '2', None]
+
+
+def test_every_predicate_order_gives_the_same_rows():
+    previous = pd.DataFrame({'id': ['2', '5', '8'], 'name': ['apple', 'cherry', 'fig'],
+                             'date': ['2025-07-05', '2025-08-01', '2025-01-01'], 'due': ['2025/07/02', '2025-07-01', '2025-01-01']})
+    diff_index, _ = main.build_previous_diff_index(io.BytesIO(previous.to_csv(index=False).encode('utf-8')), None,
+                                                   list(make_chunk().columns), 'id', [])
+    form_data = {'filter_date_column_1': 'date', 'filter_date_value_1': '2025-07-01',
+                 'filter_date_column_2': 'due', 'filter_date_value_2': '2025-07-01',
+                 'keyword_column': 'name', 'keywords': 'apple\npie', 'search_type': 'OR', 'diff_include_changed': 'on'}
+    names = ['diff', '①', '②', 'keyword']
+    results = [run_in_order(build_pipeline(form_data, diff_index), order) for order in itertools.permutations(names)]
+    for result in results[1:]:
+        pd.testing.assert_frame_equal(results[0], result)
+    assert not results[0].empty
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_dates_are_parsed_per_value(compact):
+    series = pd.Series(['2025/07/01', '2025-07-05', 'abc', None])
+    if compact:
+        series = series.astype('category')
+    parsed = main.parse_dates(series)
+    assert [str(value)[:10] for value in parsed] == ['2025-07-01', '2025-07-05', 'NaT', 'NaT']
@@ -0,0 +1,20 @@
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('H31.4.30', '2019-04-30'),
+    ('S64.1.7', '1989-01-07'),
+    ('令和元年5月1日', '2019-05-01'),
+    ('R8.1.1', '2026-01-01'),
+    ('２０２４／１／２（火）', '2024-01-02'),
+])
+def test_valid_dates_are_normalized(value, expected):
+    assert main.normalize_japanese_dates(pd.Series([value])).tolist() == [expected]
+
+
+@pytest.mark.parametrize('value', ['H35.1.1', '平成32年1月1日', 'S65.1.1', '昭和70年1月1日', 'H0.1.1', 'H30.1.1〜H35.1.1'])
+def test_era_years_past_the_era_are_left_for_the_llm(value):
+    assert main.normalize_japanese_dates(pd.Series([value])).isna().all()
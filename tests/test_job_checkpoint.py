@@ -0,0 +1,109 @@
+import json
+import time
+
+import pandas as pd
+import pytest
+
+import main
+
+# ルールでは整形できず、AIに送られる値
+UNRESOLVED_DATES = ['来月末', '年度末', '着工後30日']
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    """受け取った値を記録し、すべて同じ日付に整形して返すモデルの代わり"""
+
+    def __init__(self):
+        self.sent = []
+
+    def generate_content(self, prompt, request_options=None):
+        values = json.loads(prompt[prompt.rindex('['):])
+        self.sent.extend(values)
+        return StubResponse(json.dumps({value: '2030-03-31' for value in values}, ensure_ascii=False))
+
+
+@pytest.fixture
+def stub_model(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, 'CHECKPOINT_DIR', str(tmp_path / 'checkpoints'))
+    # 日付整形の永続キャッシュにヒットすると、チェックポイントを使わなくてもAIに送られないため空のキャッシュにする
+    monkeypatch.setattr(main, 'date_format_cache', main.PersistentLRUCache(str(tmp_path / 'cache.sqlite3'), 'date_format_cache'))
+    model = StubModel()
+    monkeypatch.setattr(main, 'model', model)
+    return model
+
+
+def format_dates(checkpoint):
+    df = pd.DataFrame({'id': ['1', '2', '3', '4'], 'due': [*UNRESOLVED_DATES, 'R8.1.1']})
+    stage = main.run_ai_date_format(df, {'ai_date_format_enabled': 'on', 'ai_date_format_column': 'due'}, [],
+                                    main.JobProfiler('test-checkpoint'), checkpoint=checkpoint)
+    return df, stage
+
+
+def test_completed_ai_batches_are_not_resent(stub_model):
+    checkpoint = main.JobCheckpoint('fingerprint')
+    checkpoint.save_stage('filter', pd.DataFrame({'due': UNRESOLVED_DATES}), log=['絞り込み'], dateFormatAllowed=True)
+    # 中断前に一部のバッチだけが完了していた状態
+    checkpoint.save_batch('ai_date_format', {'来月末': '2030-01-31'})
+
+    resumed = main.JobCheckpoint('fingerprint')
+    name, restored_df, state = resumed.load_latest_stage(('ai_date_format', 'filter'))
+    assert (name, restored_df['due'].tolist(), state['log']) == ('filter', UNRESOLVED_DATES, ['絞り込み'])
+    df, stage = format_dates(resumed)
+    assert sorted(stub_model.sent) == sorted(['年度末', '着工後30日'])
+    assert df['due'].tolist() == ['2030-01-31', '2030-03-31', '2030-03-31', '2026-01-01']
+    assert stage.counters['modelCalls'] == 1
+
+    # AIの結果もバッチごとに保存されているため、もう一度実行してもAIには送らない
+    stub_model.sent.clear()
+    format_dates(main.JobCheckpoint('fingerprint'))
+    assert stub_model.sent == []
+
+
+def test_load_latest_stage_returns_the_most_advanced_stage(stub_model):
+    checkpoint = main.JobCheckpoint('fingerprint')
+    assert checkpoint.load_latest_stage(('ai_date_format', 'filter')) is None
+    checkpoint.save_stage('ai_date_format', pd.DataFrame({'due': ['2030-03-31']}), log=['整形'])
+    checkpoint.save_stage('filter', pd.DataFrame({'due': ['年度末']}), log=['絞り込み'])
+    name, df, state = checkpoint.load_latest_stage(('ai_date_format', 'filter'))
+    assert (name, df['due'].tolist(), state['log'], state['rows']) == ('ai_date_format', ['2030-03-31'], ['整形'], 1)
+
+
+@pytest.fixture
+def input_files(tmp_path):
+    latest = tmp_path / 'latest.csv'
+    latest.write_text("id,due\n1,来月末\n", encoding='utf-8')
+    return str(latest)
+
+
+def test_fingerprint_changes_with_form_values(input_files):
+    form_data = {'ai_date_format_enabled': 'on', 'ai_date_format_column': 'due'}
+    fingerprint = main.compute_input_fingerprint(input_files, 'latest.csv', None, form_data)
+    assert main.compute_input_fingerprint(input_files, 'latest.csv', None, dict(form_data)) == fingerprint
+    assert main.compute_input_fingerprint(input_files, 'latest.csv', None, {**form_data, 'ai_date_format_column': 'id'}) != fingerprint
+    assert main.compute_input_fingerprint(input_files, 'other.csv', None, form_data) != fingerprint
+
+
+def test_fingerprint_changes_with_the_previous_file_etag(input_files, monkeypatch):
+    etags = {'2024-01-01/previous.csv': '"v1"'}
+    monkeypatch.setattr(main, 's3_client', object())
+    monkeypatch.setattr(main, 'head_s3_object', lambda key: {'ETag': etags[key]})
+    form_data = {'previous_file_key': '2024-01-01/previous.csv'}
+    fingerprint = main.compute_input_fingerprint(input_files, 'latest.csv', None, form_data)
+    assert main.compute_input_fingerprint(input_files, 'latest.csv', None, form_data) == fingerprint
+    etags['2024-01-01/previous.csv'] = '"v2"'
+    assert main.compute_input_fingerprint(input_files, 'latest.csv', None, form_data) != fingerprint
+
+
+def test_is_job_retryable():
+    now = time.time()
+    assert not main.is_job_retryable({'status': 'error'})
+    assert main.is_job_retryable({'status': 'error', 'checkpoint_id': 'x'})
+    assert not main.is_job_retryable({'status': 'completed', 'checkpoint_id': 'x', 'result': {'failedBatches': 0}})
+    assert main.is_job_retryable({'status': 'completed', 'checkpoint_id': 'x', 'result': {'failedBatches': 2}})
+    assert not main.is_job_retryable({'status': 'processing', 'checkpoint_id': 'x', 'updated_at': now})
+    assert main.is_job_retryable({'status': 'processing', 'checkpoint_id': 'x', 'updated_at': now - main.JOB_RESUME_STALE_SECONDS - 1})
@@ -0,0 +1,71 @@
+import random
+import unicodedata
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+def reference_hits(values, keywords, normalize=False):
+    """部分文字列の包含をキーワードごとに素直に判定した結果"""
+    prepare = (lambda text: unicodedata.normalize('NFKC', text)) if normalize else (lambda text: text)
+    return np.array([[prepare(keyword) in prepare(value) for keyword in keywords] for value in values], dtype=bool).reshape(len(values), len(keywords))
+
+
+@pytest.mark.parametrize('search_type', ['AND', 'OR'])
+def test_overlapping_keywords_are_all_counted(search_type):
+    keywords = ['保守', '保守点検', '点検', '検査']
+    values = ['保守点検', '定期点検', '保守', '点検査', '保守点検査', '清掃', None]
+    matcher = main.KeywordMatcher(keywords, search_type=search_type)
+    matched = matcher.match(pd.Series(values))
+    hits = reference_hits([value or '' for value in values], keywords)
+    expected = hits.any(axis=1) if search_type == 'OR' else hits.all(axis=1)
+    assert matched.tolist() == expected.tolist()
+    assert matcher.hit_counts.tolist() == hits.sum(axis=0).tolist()
+
+
+@pytest.mark.parametrize('search_type', ['AND', 'OR'])
+def test_random_values_match_naive_substring_search(search_type):
+    rng = random.Random(0)
+    alphabet = 'abca.+'
+    keywords = ['ab', 'abc', 'bca', 'ca', 'a.', '+', 'cab']
+    values = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))) for _ in range(500)]
+    matcher = main.KeywordMatcher(keywords, search_type=search_type)
+    matched = matcher.match(pd.Series(values))
+    hits = reference_hits(values, keywords)
+    expected = hits.any(axis=1) if search_type == 'OR' else hits.all(axis=1)
+    assert matched.tolist() == expected.tolist()
+    assert matcher.hit_counts.tolist() == hits.sum(axis=0).tolist()
+
+
+def test_metacharacters_are_literal_in_literal_mode():
+    matcher = main.KeywordMatcher(['C++', '(株)', 'a.b'], search_type='OR')
+    matched = matcher.match(pd.Series(['C++開発', 'CCC', '(株)テスト', '株式会社', 'a.b', 'axb']))
+    assert matched.tolist() == [True, False, True, False, True, False]
+    assert matcher.hit_counts.tolist() == [1, 1, 1]
+
+
+def test_regex_mode_uses_patterns():
+    matcher = main.KeywordMatcher([r'a.b', r'^\d+$'], search_type='OR', match_mode='regex')
+    assert matcher.match(pd.Series(['axb', '123', 'ab', '12a'])).tolist() == [True, True, False, False]
+    with pytest.raises(ValueError):
+        main.KeywordMatcher(['('], match_mode='regex')
+
+
+def test_normalize_unifies_full_and_half_width():
+    values = pd.Series(['ＰＣ修理', 'PC修理', 'ｶﾀｶﾅ', 'カタカナ'])
+    assert main.KeywordMatcher(['PC', 'カタカナ'], search_type='OR').match(values).tolist() == [False, True, False, True]
+    matcher = main.KeywordMatcher(['PC', 'カタカナ'], search_type='OR', normalize=True)
+    assert matcher.match(values).tolist() == [True, True, True, True]
+    assert matcher.hit_counts.tolist() == [2, 2]
+
+
+def test_categorical_column_matches_object_column():
+    keywords = ['保守', '点検']
+    values = ['保守点検', '点検', None, '保守点検', '清掃', None]
+    plain = main.KeywordMatcher(keywords, search_type='OR')
+    categorical = main.KeywordMatcher(keywords, search_type='OR')
+    assert categorical.match(pd.Series(values, dtype='category')).tolist() == plain.match(pd.Series(values)).tolist()
+    assert categorical.hit_counts.tolist() == plain.hit_counts.tolist() == [2, 3]
@@ -0,0 +1,133 @@
+import hashlib
+import io
+
+import numpy as np
+import pytest
+from botocore.exceptions import ClientError
+
+import main
+
+OLD_CSV = "id,name,amount\n1,a,10\n2,b,20\n"
+NEW_CSV = "id,name,amount\n1,a,10\n3,c,30\n"
+LATEST_COLUMNS = ['id', 'name', 'amount']
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class StubS3:
+    """キーごとに内容とETagを持ち、Range指定の取得にも応じるS3の代わり"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, key, data):
+        self.objects[key] = (data, f'"{hashlib.md5(data).hexdigest()}"')
+
+    def head_object(self, Bucket, Key, IfMatch=None):
+        if Key not in self.objects:
+            raise client_error('404', 'HeadObject')
+        data, etag = self.objects[Key]
+        return {'ContentLength': len(data), 'ETag': etag}
+
+    def get_object(self, Bucket, Key, IfMatch=None, Range=None):
+        if Key not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        data, etag = self.objects[Key]
+        if IfMatch is not None and IfMatch != etag:
+            raise client_error('PreconditionFailed', 'GetObject')
+        start = int(Range[len('bytes='):-1]) if Range else 0
+        if Range and start >= len(data):
+            raise client_error('InvalidRange', 'GetObject')
+        return {'Body': io.BytesIO(data[start:]), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.put(Key, Body)
+        return {'ETag': self.objects[Key][1]}
+
+    def upload_file(self, path, Bucket, Key, ExtraArgs=None, Config=None):
+        with open(path, 'rb') as f:
+            self.put(Key, f.read())
+
+    def upload_fileobj(self, fileobj, Bucket, Key, Config=None):
+        self.put(Key, fileobj.read())
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3()
+    monkeypatch.setattr(main, 's3_client', stub)
+    return stub
+
+
+def save_csv(s3, key, csv_text, archive=True, record_etag=True):
+    s3.put(key, csv_text.encode('utf-8'))
+    if archive:
+        source_etag = s3.objects[key][1] if record_etag else None
+        main.save_file_to_s3_archive(key, io.BytesIO(csv_text.encode('utf-8')), source_etag=source_etag)
+
+
+def load_index(key, latest_columns=LATEST_COLUMNS):
+    notes = []
+    index, _ = main.build_previous_diff_index(None, key, latest_columns, None, notes)
+    return index, notes
+
+
+def csv_index(csv_text, latest_columns=LATEST_COLUMNS):
+    index, _ = main.build_previous_diff_index(io.BytesIO(csv_text.encode('utf-8')), None, latest_columns, None, [])
+    return index
+
+
+def test_current_sidecar_is_used_without_reading_the_csv(s3):
+    save_csv(s3, 'prev.csv', OLD_CSV)
+    del s3.objects[main.parquet_key('prev.csv')]
+    s3.objects['prev.csv'] = (b'', s3.objects['prev.csv'][1])  # 本体を読んだら空になるため、読んでいないことが分かる
+    index, notes = load_index('prev.csv')
+    assert '行ハッシュインデックス' in notes[0]
+    assert np.array_equal(index.row_hashes, csv_index(OLD_CSV).row_hashes)
+
+
+def test_parquet_copy_is_used_when_the_sidecar_columns_do_not_fit(s3):
+    save_csv(s3, 'prev.csv', OLD_CSV)
+    index, notes = load_index('prev.csv', ['id', 'name'])
+    assert '列指向のコピー' in notes[0]
+    assert np.array_equal(index.row_hashes, csv_index(OLD_CSV, ['id', 'name']).row_hashes)
+
+
+def test_missing_sidecar_and_copy_fall_back_to_the_csv(s3):
+    save_csv(s3, 'prev.csv', OLD_CSV, archive=False)
+    index, notes = load_index('prev.csv')
+    assert 'S3から読み込みました' in notes[0]
+    assert np.array_equal(index.row_hashes, csv_index(OLD_CSV).row_hashes)
+
+
+@pytest.mark.parametrize('record_etag', [True, False], ids=['stale', 'unversioned'])
+def test_sidecar_and_copy_for_another_csv_version_are_not_used(s3, record_etag):
+    save_csv(s3, 'prev.csv', OLD_CSV, record_etag=record_etag)
+    # CSVだけが上書きされ、サイドカーとコピーがまだ作り直されていない状態
+    save_csv(s3, 'prev.csv', NEW_CSV, archive=False)
+    index, notes = load_index('prev.csv')
+    assert 'S3から読み込みました' in notes[0]
+    assert np.array_equal(index.row_hashes, csv_index(NEW_CSV).row_hashes)
+
+
+def test_diff_during_save_reads_the_new_csv(s3, monkeypatch):
+    save_csv(s3, 'prev.csv', OLD_CSV)
+    monkeypatch.setattr(main, 'record_saved_file_in_manifest', lambda key, replaced_object=None: None)
+    monkeypatch.setattr(main, 'record_saved_file_in_seen_ever_index', lambda file_key, row_index: None)
+    save_file_to_s3_archive = main.save_file_to_s3_archive
+    seen_during_save = []
+
+    def diff_then_save(*args, **kwargs):
+        # CSVのアップロードとサイドカーの書き換えの間に、別のジョブが差分抽出を行う
+        seen_during_save.append(load_index('prev.csv')[0].row_hashes)
+        return save_file_to_s3_archive(*args, **kwargs)
+
+    monkeypatch.setattr(main, 'save_file_to_s3_archive', diff_then_save)
+    response = main.app.test_client().post('/api/save_latest_file', data={'file_to_save': (io.BytesIO(NEW_CSV.encode('utf-8')), 'prev.csv')})
+    assert response.status_code == 200 and '失敗' not in response.get_json()['message']
+    assert np.array_equal(seen_during_save[0], csv_index(NEW_CSV).row_hashes)
+    index, notes = load_index('prev.csv')
+    assert '行ハッシュインデックス' in notes[0]
+    assert np.array_equal(index.row_hashes, csv_index(NEW_CSV).row_hashes)
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+import main
+
+PROFILE = {
+    'rowCount': 4,
+    'columns': [
+        {'name': 'name', 'top': []},
+        {'name': 'budget', 'numeric': {}, 'top': []},
+        {'name': 'region', 'top': []},
+    ],
+}
+
+
+def make_df():
+    return pd.DataFrame({'name': ['a', 'b', 'c', 'd'], 'budget': ['1,000', '50', '20,000', None], 'region': ['x', 'y', 'x', 'y']})
+
+
+def test_select_can_be_sorted_by_a_column_outside_the_selection():
+    plan = main.validate_query_plan({'select': ['name'], 'sort': {'by': 'budget', 'desc': True}, 'limit': 3}, PROFILE)
+    result, matched_rows = main.run_query_plan(plan, PROFILE, [make_df()])
+    assert list(result.columns) == ['name']
+    assert result['name'].tolist() == ['c', 'a', 'b']
+    assert matched_rows == 4
+
+
+def test_aggregates_are_sorted_by_result_columns():
+    plan = main.validate_query_plan({'group_by': ['region'], 'aggregates': [{'column': 'budget', 'func': 'sum', 'as': 'total'}],
+                                     'sort': {'by': 'total', 'desc': False}}, PROFILE)
+    result, _ = main.run_query_plan(plan, PROFILE, [make_df()])
+    assert result['region'].tolist() == ['y', 'x']
+
+
+def test_aggregates_cannot_be_sorted_by_a_raw_column():
+    with pytest.raises(ValueError):
+        main.validate_query_plan({'group_by': ['region'], 'aggregates': [{'column': 'budget', 'func': 'sum', 'as': 'total'}],
+                                  'sort': {'by': 'budget'}}, PROFILE)
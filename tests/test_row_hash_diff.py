@@ -0,0 +1,54 @@
+import io
+import time
+
+import pandas as pd
+import pytest
+
+import main
+
+
+def merge_anti_join(latest_csv, previous_csv):
+    """差分エンジン導入前のpd.mergeによる反結合（比較の基準）"""
+    df_latest = main.read_csv_from_stream(io.BytesIO(latest_csv.encode('utf-8')))
+    df_previous = main.read_csv_from_stream(io.BytesIO(previous_csv.encode('utf-8')))
+    common_columns = [col for col in df_latest.columns if col in df_previous.columns]
+    merged = pd.merge(df_latest, df_previous, on=common_columns, how='left', indicator=True)
+    return merged[merged['_merge'] == 'left_only'].drop(columns='_merge')
+
+
+def row_hash_diff(latest_csv, previous_csv):
+    profiler = main.JobProfiler('test-diff')
+    result = main.filter_latest_file('test-diff', time.perf_counter(), profiler, io.BytesIO(latest_csv.encode('utf-8')), 'latest.csv',
+                                     io.BytesIO(previous_csv.encode('utf-8')), {})
+    return result[0]
+
+
+CASES = {
+    'duplicates': (
+        "id,name,amount\n1,a,10\n2,b,20\n2,b,20\n3,c,30\n4,d,40\n4,d,40\n",
+        "id,name,amount\n2,b,20\n2,b,20\n3,c,31\n",
+    ),
+    'nan_keys': (
+        "id,name,amount\n1,,10\n,b,20\n,,\n2,c,\n3,d,30\n",
+        "id,name,amount\n1,,10\n,,\n2,c,5\n",
+    ),
+    'previous_only_columns': (
+        "id,name,amount\n1,a,10\n2,b,20\n3,c,30\n",
+        "memo,name,id,status\nx,a,1,done\ny,b,9,open\n",
+    ),
+    'previous_only_columns_with_nan': (
+        "id,name\n1,\n,b\n3,c\n",
+        "status,id,name\nopen,1,\nclosed,,b\n",
+    ),
+}
+
+
+@pytest.mark.parametrize('compact', [False, True], ids=['plain', 'compact'])
+@pytest.mark.parametrize('case', list(CASES))
+def test_row_hash_diff_matches_merge_anti_join(case, compact, monkeypatch):
+    monkeypatch.setattr(main, 'CSV_COMPACT_DTYPES', compact)
+    latest_csv, previous_csv = CASES[case]
+    expected = merge_anti_join(latest_csv, previous_csv)
+    actual = row_hash_diff(latest_csv, previous_csv)
+    assert list(actual.columns) == list(expected.columns)
+    assert actual.to_csv(index=False) == expected.to_csv(index=False)
@@ -0,0 +1,127 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import main
+
+
+def client_error(code, status, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+
+class StubS3:
+    """テンプレートファイル1つだけを持ち、ETagによる条件付きの取得と書き込みに応じるS3の代わり"""
+
+    def __init__(self, templates):
+        self.body = json.dumps(templates, ensure_ascii=False).encode('utf-8')
+        self.version = 1
+        self.gets = []
+        self.before_put = None  # 書き込みの直前に呼ばれる（他のワーカーの書き込みを割り込ませる）
+        self.always_conflict = False
+
+    @property
+    def etag(self):
+        return f'"v{self.version}"'
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.gets.append(IfNoneMatch)
+        if IfNoneMatch == self.etag:
+            raise client_error('304', 304, 'GetObject')
+        return {'Body': io.BytesIO(self.body), 'ETag': self.etag}
+
+    def put_object(self, Bucket, Key, Body, ContentType, IfMatch=None, IfNoneMatch=None):
+        if self.before_put is not None:
+            before_put, self.before_put = self.before_put, None
+            before_put()
+        if self.always_conflict or (IfMatch is not None and IfMatch != self.etag):
+            raise client_error('PreconditionFailed', 412, 'PutObject')
+        self.body = Body
+        self.version += 1
+        return {'ETag': self.etag}
+
+    def templates(self):
+        return json.loads(self.body)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    stub = StubS3([{'id': 'a', 'name': '保守', 'content': '保守案件だけ残す', 'version': 1},
+                   {'id': 'b', 'name': '清掃', 'content': '清掃案件だけ残す', 'version': 3}])
+    monkeypatch.setattr(main, 's3_client', stub)
+    monkeypatch.setattr(main, 'template_store', main.TemplateStore())
+    return stub
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def test_get_returns_304_when_the_etag_is_unchanged(s3, client):
+    response = client.get('/api/templates')
+    assert response.status_code == 200
+    assert [template['id'] for template in response.get_json()] == ['a', 'b']
+    assert client.get('/api/templates', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_store_revalidates_with_the_cached_etag(s3, monkeypatch):
+    monkeypatch.setattr(main, 'TEMPLATE_CACHE_FRESH_SECONDS', 0)
+    store = main.TemplateStore()
+    first, etag = store.get()
+    second, second_etag = store.get()
+    # 2回目はIfNoneMatchで確認し、304なら読み込み済みの内容をそのまま使う
+    assert s3.gets == [None, etag]
+    assert second is first and second_etag == etag
+
+
+def test_put_with_a_stale_version_is_rejected(s3, client):
+    response = client.put('/api/templates/a', json={'content': '新しい内容', 'version': 0})
+    assert response.status_code == 409
+    assert s3.templates()[0]['content'] == '保守案件だけ残す'
+    response = client.put('/api/templates/a', json={'content': '新しい内容', 'version': 1})
+    assert response.status_code == 200
+    assert response.get_json()['template']['version'] == 2
+
+
+def test_delete_with_a_stale_version_is_rejected(s3, client):
+    assert client.delete('/api/templates/b?version=2').status_code == 409
+    assert [template['id'] for template in s3.templates()] == ['a', 'b']
+    assert client.delete('/api/templates/b?version=3').status_code == 200
+    assert [template['id'] for template in s3.templates()] == ['a']
+    assert client.delete('/api/templates/b').status_code == 404
+
+
+def test_if_match_conflict_reapplies_the_change_on_the_latest_templates(s3, client):
+    client.get('/api/templates')
+
+    def other_worker_adds_a_template():
+        s3.body = json.dumps([*s3.templates(), {'id': 'c', 'name': '点検', 'content': '点検案件だけ残す', 'version': 1}]).encode('utf-8')
+        s3.version += 1
+
+    s3.before_put = other_worker_adds_a_template
+    assert client.put('/api/templates/a', json={'name': '保守（改）', 'version': 1}).status_code == 200
+    # 他のワーカーが追加したテンプレートを上書きせずに残す
+    assert [(template['id'], template['name']) for template in s3.templates()] == [('a', '保守（改）'), ('b', '清掃'), ('c', '点検')]
+
+
+def test_if_match_conflict_on_a_changed_version_returns_409(s3, client):
+    client.get('/api/templates')
+
+    def other_worker_updates_the_template():
+        templates = s3.templates()
+        templates[0].update(content='他のワーカーの内容', version=2)
+        s3.body = json.dumps(templates).encode('utf-8')
+        s3.version += 1
+
+    s3.before_put = other_worker_updates_the_template
+    assert client.put('/api/templates/a', json={'content': '新しい内容', 'version': 1}).status_code == 409
+    assert s3.templates()[0]['content'] == '他のワーカーの内容'
+
+
+def test_repeated_precondition_failures_return_409(s3, client):
+    s3.always_conflict = True
+    response = client.post('/api/templates', json={'name': '点検', 'content': '点検案件だけ残す'})
+    assert response.status_code == 409
+    assert [template['id'] for template in s3.templates()] == ['a', 'b']